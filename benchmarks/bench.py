@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import secrets
+import string
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the currency exchange API in-process")
+    parser.add_argument("--sizes", default="10,1000,100000",
+                        type=lambda sizes: [int(size) for size in sizes.split(",")],
+                        help="comma separated numbers of exchange rate pairs to seed")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="requests per endpoint and size")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reset-database", action="store_true",
+                        help="drop and reseed the configured database instead of a temporary one")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+
+def currency_codes(count: int) -> list[str]:
+    codes = ("".join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3))
+    return list(itertools.islice(codes, count))
+
+
+async def execute_on_server(statement: str) -> None:
+    import asyncpg
+
+    from config import DB_HOST, DB_PASS, DB_PORT, DB_USER
+
+    connection = await asyncpg.connect(host=DB_HOST, port=DB_PORT, user=DB_USER,
+                                       password=DB_PASS, database="postgres")
+    try:
+        await connection.execute(statement)
+    finally:
+        await connection.close()
+
+
+async def seed(size: int, rng: random.Random) -> tuple[list[str], list[tuple[str, str]]]:
+    from sqlalchemy import insert
+
+    from currencies.models import CurrencyORM
+    from database import async_session_maker, create_all_tables, drop_all_tables
+    from exchange_rates.models import ExchangeRateHistoryORM, ExchangeRateORM
+
+    # Enough currencies for `size` distinct ordered pairs
+    codes = currency_codes(max(2, math.ceil(math.sqrt(size)) + 1))
+    pairs = rng.sample([(base, target) for base in range(len(codes))
+                        for target in range(len(codes)) if base != target], size)
+
+    await drop_all_tables()
+    await create_all_tables()
+
+    async with async_session_maker() as session:
+        await session.execute(insert(CurrencyORM), [
+            {"id": index + 1, "code": code, "name": f"Currency {code}", "sign": code[0]}
+            for index, code in enumerate(codes)
+        ])
+        exchange_rates = [
+            {"base_currency_id": base + 1, "target_currency_id": target + 1,
+             "rate": round(rng.uniform(0.01, 100), 6)}
+            for base, target in pairs
+        ]
+        await session.execute(insert(ExchangeRateORM), exchange_rates)
+        await session.execute(insert(ExchangeRateHistoryORM), exchange_rates)
+        await session.commit()
+
+    return codes, [(codes[base], codes[target]) for base, target in pairs]
+
+
+def scenarios(codes: list[str], pairs: list[tuple[str, str]], rng: random.Random):
+    from exchange_rates.repository import ExchangeRateRepository
+
+    def pair():
+        return rng.choice(pairs)
+
+    return {
+        "GET /currencies": ("http", lambda: "/currencies"),
+        "GET /currencies/{code}": ("http", lambda: f"/currencies/{rng.choice(codes)}"),
+        "GET /exchangeRates": ("http", lambda: "/exchangeRates"),
+        "GET /exchangeRates/{pair}": ("http", lambda: "/exchangeRates/{}{}".format(*pair())),
+        "GET /exchange": ("http", lambda: "/exchange?baseCode={}&targetCode={}&amount=10".format(*pair())),
+        "ExchangeRateRepository.get_all": ("repository", lambda: (ExchangeRateRepository.get_all,)),
+        "ExchangeRateRepository.get_by_pair": ("repository",
+                                               lambda: (ExchangeRateRepository.get_by_pair, *pair())),
+    }
+
+
+async def drive(client, kind: str, make_call, total: int, concurrency: int) -> tuple[list[float], int]:
+    from database import async_session_maker
+
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            call = make_call()
+            started = time.perf_counter()
+            if kind == "http":
+                response = await client.get(call)
+                if response.status_code >= 400:
+                    errors += 1
+            else:
+                function, *args = call
+                async with async_session_maker() as session:
+                    await function(session, *args)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def run(args) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    from cache import rate_cache
+    from database import engine
+    from main import app
+
+    rng = random.Random(args.seed)
+    queries = 0
+
+    def count_query(*_):
+        nonlocal queries
+        queries += 1
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+
+        for size in args.sizes:
+            codes, pairs = await seed(size, rng)
+            await rate_cache.resync()
+
+            for name, (kind, make_call) in scenarios(codes, pairs, rng).items():
+                # Warm up connections and caches before measuring
+                await drive(client, kind, make_call, args.concurrency, args.concurrency)
+
+                queries = 0
+                started = time.perf_counter()
+                latencies, errors = await drive(client, kind, make_call, args.requests, args.concurrency)
+                elapsed = time.perf_counter() - started
+
+                p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+                results.append({
+                    "name": name,
+                    "size": size,
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "errors": errors,
+                    "throughput": round(args.requests / elapsed, 1),
+                    "p50_ms": round(p50, 3),
+                    "p95_ms": round(p95, 3),
+                    "p99_ms": round(p99, 3),
+                    "queries_per_request": round(queries / args.requests, 3),
+                })
+
+    return {
+        "sizes": args.sizes,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "results": results,
+    }
+
+
+def main():
+    args = parse_args()
+
+    # The app reads its settings and resolves ../static relative to src on import
+    sys.path.insert(0, str(SRC_DIR))
+    os.chdir(SRC_DIR)
+
+    database_name = None
+    if not args.reset_database:
+        # Set before config is imported, the app builds its engine from it
+        database_name = f"benchmark_{secrets.token_hex(4)}"
+        os.environ["DB_NAME"] = database_name
+        asyncio.run(execute_on_server(f'CREATE DATABASE "{database_name}"'))
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if database_name is not None:
+            asyncio.run(execute_on_server(f'DROP DATABASE IF EXISTS "{database_name}" WITH (FORCE)'))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
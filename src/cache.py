@@ -0,0 +1,334 @@
+import asyncio
+import datetime
+import json
+import logging
+from typing import Awaitable, Callable, NamedTuple
+
+import asyncpg
+from pydantic_core import to_json
+from sqlalchemy import select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import (CACHE_HEALTH_CHECK_INTERVAL, CACHE_NOTIFY_CHANNEL, DB_HOST, DB_NAME,
+                    DB_PASS, DB_PORT, DB_USER, STORAGE_BACKEND)
+from currencies.schemas import CurrencyWithID
+from database import cache_table_version, engine
+from exchange_rates.graph import RateGraph, rate_graph
+from exchange_rates.schemas import ExchangeRateWithCurrencies
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[], Awaitable[tuple[list[CurrencyWithID], list[ExchangeRateWithCurrencies]]]]
+# Called with the cache version when a table version changes, before the graph is updated
+VersionListener = Callable[[int], None]
+
+# NOTIFY payloads are limited to 8000 bytes, bigger change sets make the other workers resync
+MAX_PAYLOAD_SIZE = 7900
+
+# NOTIFY is only delivered on commit, and the version is taken after the write
+# locked its rows, so versions of the same row grow in commit order. The versions of
+# the written tables are raised in the same transaction, for the workers that reload
+NOTIFY_QUERY = text(
+    "WITH next AS (SELECT nextval('cache_version') AS version), "
+    "bumped AS ("
+    "INSERT INTO cache_table_version (table_name, version) "
+    "SELECT table_name, version FROM next, unnest(CAST(:tables AS text[])) AS table_name "
+    "ON CONFLICT (table_name) DO UPDATE "
+    "SET version = GREATEST(cache_table_version.version, EXCLUDED.version)) "
+    "SELECT version, pg_notify(:channel, "
+    "jsonb_set(CAST(:payload AS jsonb), '{version}', to_jsonb(version))::text) "
+    "FROM next"
+)
+
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError,
+                     asyncpg.InterfaceError, DBAPIError)
+
+TABLES = ("currency", "exchange_rate")
+
+
+class TableVersion(NamedTuple):
+    # The highest cache version applied to the table
+    version: int
+    # Bumped when a change arrives with a version that is not newer than the
+    # table version, e.g. a write that committed after a reload took its snapshot
+    revision: int
+    modified_at: datetime.datetime
+
+
+class RateCache:
+    def __init__(self, graph: RateGraph, channel: str, health_check_interval: float):
+        self._graph = graph
+        self._channel = channel
+        self._health_check_interval = health_check_interval
+        self.version = 0
+        # Reads may skip the database only while changes from other workers are received
+        self.ready = False
+        self._versions: dict[tuple, int] = {}
+        self._table_versions: dict[str, TableVersion] = {}
+        self._currencies_json: tuple[str, bytes] | None = None
+        self._loader: Loader | None = None
+        self._listener: asyncio.Task | None = None
+        self._resync_task: asyncio.Task | None = None
+        self._resync_lock = asyncio.Lock()
+        self._buffer: list[dict] | None = None
+        self._listeners: list[VersionListener] = []
+
+    def subscribe(self, listener: VersionListener) -> None:
+        self._listeners.append(listener)
+
+    async def start(self, loader: Loader) -> None:
+        self._loader = loader
+        if STORAGE_BACKEND != "postgres":
+            await self.resync()
+            self.ready = True
+            return
+
+        listening = asyncio.Event()
+        self._listener = asyncio.create_task(self._listen(listening))
+        waiting = asyncio.create_task(listening.wait())
+        try:
+            await asyncio.wait({self._listener, waiting}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiting.cancel()
+        if self._listener.done():
+            # The listener only ends on an error it could not retry, startup fails with it
+            self._listener.result()
+            raise RuntimeError("Rate cache listener stopped before the first load")
+
+    async def stop(self) -> None:
+        self.ready = False
+        for task in (self._listener, self._resync_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def resync(self) -> None:
+        async with self._resync_lock:
+            # Changes received while loading are applied on top of the snapshot
+            self._buffer = []
+            try:
+                versions = await self._read_table_versions()
+                currencies, exchange_rates = await self._loader()
+                self._versions.clear()
+                self._graph.load(currencies, exchange_rates)
+                for table in TABLES:
+                    self._reset_table(table, versions.get(table, 0))
+            finally:
+                buffer, self._buffer = self._buffer, None
+
+            for changes in buffer:
+                self._apply(changes)
+
+    async def publish(self,
+                      session: AsyncSession,
+                      currencies: list[CurrencyWithID] = (),
+                      removed_currencies: list[int] = (),
+                      exchange_rates: list[ExchangeRateWithCurrencies] = (),
+                      removed_exchange_rates: list[tuple[int, int]] = ()) -> int:
+        if STORAGE_BACKEND != "postgres":
+            self.version += 1
+            return self.version
+
+        changes = {
+            "currencies": [currency.model_dump() for currency in currencies],
+            "removed_currencies": list(removed_currencies),
+            "exchange_rates": [
+                [exchange_rate.base_currency.id, exchange_rate.target_currency.id, float(exchange_rate.rate)]
+                for exchange_rate in exchange_rates
+            ],
+            "removed_exchange_rates": [list(pair) for pair in removed_exchange_rates],
+        }
+        payload = json.dumps(changes, separators=(",", ":"))
+        if len(payload) > MAX_PAYLOAD_SIZE:
+            payload = json.dumps({"resync": True})
+
+        tables = []
+        if currencies or removed_currencies:
+            tables.append("currency")
+        # Rates of a removed currency are removed along with it
+        if exchange_rates or removed_exchange_rates or removed_currencies:
+            tables.append("exchange_rate")
+
+        result = await session.execute(NOTIFY_QUERY, {"channel": self._channel, "payload": payload,
+                                                      "tables": tables})
+        return result.scalar_one()
+
+    def add_currency(self, currency: CurrencyWithID, version: int) -> None:
+        if self._is_newer(("currency", currency.id), version):
+            self._graph.add_currency(currency)
+
+    def remove_currency(self, currency_id: int, version: int) -> None:
+        if self._is_newer(("currency", currency_id), version):
+            self._graph.remove_currency(currency_id)
+            # Rates of the currency are removed along with it
+            self._bump_table("exchange_rate", version)
+
+    def set_rates(self, exchange_rates: list[ExchangeRateWithCurrencies], version: int) -> None:
+        exchange_rates = [
+            exchange_rate for exchange_rate in exchange_rates
+            if self._is_newer(("exchange_rate", exchange_rate.base_currency.id, exchange_rate.target_currency.id),
+                              version)
+        ]
+        if exchange_rates:
+            self._graph.set_rates(exchange_rates)
+
+    def remove_rate(self,
+                    base_currency: CurrencyWithID,
+                    target_currency: CurrencyWithID,
+                    version: int) -> None:
+        if self._is_newer(("exchange_rate", base_currency.id, target_currency.id), version):
+            self._graph.remove_rate(base_currency, target_currency)
+
+    def get_currencies(self) -> list[CurrencyWithID]:
+        return self._graph.get_currencies()
+
+    def get_currencies_json(self) -> bytes:
+        # Encoded once per version of the currency table
+        tag, _ = self.get_table_version("currency")
+        if self._currencies_json is None or self._currencies_json[0] != tag:
+            self._currencies_json = (tag, to_json(self._graph.get_currencies()))
+        return self._currencies_json[1]
+
+    def get_currency(self, code: str) -> CurrencyWithID | None:
+        return self._graph.get_currency_by_code(code)
+
+    def get_exchange_rate(self,
+                          base_currency_code: str,
+                          target_currency_code: str) -> ExchangeRateWithCurrencies:
+        return self._graph.get_rate(base_currency_code, target_currency_code)
+
+    def get_table_version(self, *tables: str) -> tuple[str, datetime.datetime]:
+        table_versions = [self._table_versions[table] for table in tables]
+        tag = "-".join(f"{table_version.version}.{table_version.revision}"
+                       for table_version in table_versions)
+        modified_at = max(table_version.modified_at for table_version in table_versions)
+        return tag, modified_at
+
+    def _is_newer(self, key: tuple, version: int) -> bool:
+        self.version = max(self.version, version)
+        if version <= self._versions.get(key, 0):
+            return False
+        self._versions[key] = version
+        self._bump_table(key[0], version)
+        return True
+
+    def _bump_table(self, table: str, version: int) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        current = self._table_versions.get(table)
+        if current is None or version > current.version:
+            self._table_versions[table] = TableVersion(version, 0, now)
+        else:
+            self._table_versions[table] = TableVersion(current.version, current.revision + 1, now)
+        self._version_changed()
+
+    def _reset_table(self, table: str, version: int) -> None:
+        self.version = max(self.version, version)
+        current = self._table_versions.get(table)
+        # A reload that missed no change keeps the tag
+        if current is None or current.version != version:
+            self._table_versions[table] = TableVersion(version, 0, datetime.datetime.now(datetime.timezone.utc))
+        self._version_changed()
+
+    def _version_changed(self) -> None:
+        for listener in self._listeners:
+            try:
+                listener(self.version)
+            except Exception:
+                logger.exception("Rate cache listener %r failed", listener)
+
+    async def _read_table_versions(self) -> dict[str, int]:
+        if STORAGE_BACKEND != "postgres":
+            return {table: self.version for table in TABLES}
+
+        async with engine.connect() as connection:
+            result = await connection.execute(
+                select(cache_table_version.c.table_name, cache_table_version.c.version)
+            )
+            return dict(result.all())
+
+    def _apply(self, changes: dict) -> None:
+        if changes.get("resync"):
+            self._schedule_resync()
+            return
+
+        version = changes["version"]
+        for currency in changes["currencies"]:
+            self.add_currency(CurrencyWithID(**currency), version)
+        for currency_id in changes["removed_currencies"]:
+            self.remove_currency(currency_id, version)
+
+        try:
+            self.set_rates([
+                ExchangeRateWithCurrencies(
+                    rate=rate,
+                    base_currency=self._graph.get_currency(base_currency_id),
+                    target_currency=self._graph.get_currency(target_currency_id)
+                )
+                for base_currency_id, target_currency_id, rate in changes["exchange_rates"]
+            ], version)
+            for base_currency_id, target_currency_id in changes["removed_exchange_rates"]:
+                self.remove_rate(self._graph.get_currency(base_currency_id),
+                                 self._graph.get_currency(target_currency_id),
+                                 version)
+        except KeyError:
+            # A currency that is not cached yet, the cache is out of sync
+            self._schedule_resync()
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        changes = json.loads(payload)
+        if self._buffer is not None:
+            self._buffer.append(changes)
+        else:
+            self._apply(changes)
+
+    def _schedule_resync(self) -> None:
+        if self._resync_task is None or self._resync_task.done():
+            self._resync_task = asyncio.create_task(self.resync())
+
+    async def _listen(self, listening: asyncio.Event) -> None:
+        while True:
+            try:
+                connection = await asyncpg.connect(host=DB_HOST, port=DB_PORT, user=DB_USER,
+                                                   password=DB_PASS, database=DB_NAME)
+            except CONNECTION_ERRORS:
+                logger.warning("Could not open the cache LISTEN connection, retrying")
+                await asyncio.sleep(self._health_check_interval)
+                continue
+
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            failed = False
+            try:
+                await connection.add_listener(self._channel, self._on_notification)
+                # Whatever was missed while disconnected is picked up by a full reload
+                await self.resync()
+                self.ready = True
+                listening.set()
+
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), self._health_check_interval)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(connection.fetchval("SELECT 1"),
+                                               self._health_check_interval)
+                logger.warning("Cache LISTEN connection closed, reconnecting")
+            except CONNECTION_ERRORS:
+                logger.warning("Cache LISTEN connection lost, reconnecting")
+            except Exception:
+                # E.g. a reload that failed on the data, retried on a new connection
+                logger.exception("Rate cache reload failed, retrying")
+                failed = True
+            finally:
+                self.ready = False
+                connection.terminate()
+            if failed:
+                await asyncio.sleep(self._health_check_interval)
+
+
+rate_cache = RateCache(rate_graph,
+                       channel=CACHE_NOTIFY_CHANNEL,
+                       health_check_interval=CACHE_HEALTH_CHECK_INTERVAL)
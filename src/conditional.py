@@ -0,0 +1,50 @@
+import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+from cache import rate_cache
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _not_modified_since(if_modified_since: str, last_modified: datetime.datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+
+# Returns a 304 response when the client already has the current version of the
+# tables, otherwise sets ETag and Last-Modified on the response. Responses sent in
+# several content encodings take a weak ETag
+def not_modified(request: Request, response: Response, *tables: str, weak: bool = False) -> Response | None:
+    if not rate_cache.ready:
+        return None
+
+    tag, last_modified = rate_cache.get_table_version(*tables)
+    etag = f'"{tag}"'
+    headers = {
+        "ETag": f"W/{etag}" if weak else etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        matches = _etag_matches(if_none_match, etag)
+    else:
+        matches = if_modified_since is not None and _not_modified_since(if_modified_since, last_modified)
+
+    if matches:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -9,3 +9,65 @@ DB_PORT = os.environ.get("DB_PORT")
 DB_USER = os.environ.get("DB_USER")
 DB_PASS = os.environ.get("DB_PASS")
 DB_NAME = os.environ.get("DB_NAME")
+
+# postgres, sqlite or memory
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "./database.db")
+
+# migrate applies pending migrations and seeds missing rows, reset drops and recreates everything
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "migrate")
+SEED_FILE = os.environ.get("SEED_FILE", "../data/seed.json")
+
+# Comma separated SQLAlchemy URLs of Postgres read replicas, reads of GET requests use them
+DB_REPLICA_URLS = [url for url in os.environ.get("DB_REPLICA_URLS", "").split(",") if url]
+# Seconds, a replica further behind the primary stops serving reads until it catches up
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+DB_REPLICA_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_HEALTH_CHECK_INTERVAL", 5))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
+CACHE_NOTIFY_CHANNEL = os.environ.get("CACHE_NOTIFY_CHANNEL", "rate_cache")
+CACHE_HEALTH_CHECK_INTERVAL = float(os.environ.get("CACHE_HEALTH_CHECK_INTERVAL", 5))
+# Memory-mapped file the workers of one host share the rates through, empty disables it.
+# /dev/shm keeps it off the disk
+RATE_SNAPSHOT_PATH = os.environ.get("RATE_SNAPSHOT_PATH", "")
+# Bytes per snapshot, the file holds two
+RATE_SNAPSHOT_SIZE = int(os.environ.get("RATE_SNAPSHOT_SIZE", 16 * 1024 * 1024))
+
+EXCHANGE_PIVOT_CURRENCIES = os.environ.get("EXCHANGE_PIVOT_CURRENCIES", "USD").split(",")
+
+# half_even, half_up, half_down, down, up, floor or ceiling
+EXCHANGE_ROUNDING = os.environ.get("EXCHANGE_ROUNDING", "half_even")
+
+# Seconds to keep pair and currency lookups that bypass the rate cache, 0 only coalesces
+# concurrent lookups. Every write clears them
+LOOKUP_CACHE_TTL = float(os.environ.get("LOOKUP_CACHE_TTL", 0))
+LOOKUP_CACHE_MAX_SIZE = int(os.environ.get("LOOKUP_CACHE_MAX_SIZE", 10000))
+# Seconds to collect concurrent pair and currency lookups into one query
+DATALOADER_WINDOW = float(os.environ.get("DATALOADER_WINDOW", 0.001))
+DATALOADER_MAX_BATCH_SIZE = int(os.environ.get("DATALOADER_MAX_BATCH_SIZE", 100))
+
+EXCHANGE_RATES_PAGE_SIZE = int(os.environ.get("EXCHANGE_RATES_PAGE_SIZE", 100))
+EXCHANGE_RATES_MAX_PAGE_SIZE = int(os.environ.get("EXCHANGE_RATES_MAX_PAGE_SIZE", 1000))
+# Currencies per /exchangeRates/matrix request
+EXCHANGE_RATE_MATRIX_MAX_CODES = int(os.environ.get("EXCHANGE_RATE_MATRIX_MAX_CODES", 200))
+
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 1000))
+
+STREAM_MAX_PENDING = int(os.environ.get("STREAM_MAX_PENDING", 1000))
+STREAM_KEEPALIVE_INTERVAL = float(os.environ.get("STREAM_KEEPALIVE_INTERVAL", 15))
+
+ANOMALY_MAX_CYCLE_LENGTH = int(os.environ.get("ANOMALY_MAX_CYCLE_LENGTH", 4))
+ANOMALY_TOLERANCE = float(os.environ.get("ANOMALY_TOLERANCE", 1e-6))
+ANOMALY_FULL_SCAN_THRESHOLD = int(os.environ.get("ANOMALY_FULL_SCAN_THRESHOLD", 100))
+
+# Fraction of requests whose SQL is profiled, 0 disables the profiler
+SQL_PROFILE_SAMPLE_RATE = float(os.environ.get("SQL_PROFILE_SAMPLE_RATE", 0))
+SQL_PROFILE_HISTORY = int(os.environ.get("SQL_PROFILE_HISTORY", 100))
+SQL_PROFILE_N_PLUS_ONE_THRESHOLD = int(os.environ.get("SQL_PROFILE_N_PLUS_ONE_THRESHOLD", 5))
+# Seconds, statements at least this slow are logged with their plan, 0 disables the log
+SQL_SLOW_QUERY_THRESHOLD = float(os.environ.get("SQL_SLOW_QUERY_THRESHOLD", 0))
@@ -0,0 +1,83 @@
+from typing import AsyncIterator
+
+from cache import rate_cache
+from exceptions import CurrencyInUseError, CurrencyNotFound, EntityExistsError
+from memory_store import memory_store
+
+from .schemas import Currency, CurrencyWithID
+
+
+# Same contract as CurrencyRepository, sessions are accepted and ignored
+class InMemoryCurrencyRepository:
+    @classmethod
+    async def get_all(cls, session) -> list[CurrencyWithID]:
+        return list(memory_store.currencies.values())
+
+    @classmethod
+    async def stream_all(cls, session, chunk_size: int) -> AsyncIterator[list[CurrencyWithID]]:
+        currencies = list(memory_store.currencies.values())
+        for start in range(0, len(currencies), chunk_size):
+            yield currencies[start:start + chunk_size]
+
+    @classmethod
+    async def add(cls, session, data: Currency) -> CurrencyWithID:
+        if data.code in memory_store.currency_ids:
+            raise EntityExistsError("Currency with this code already exists")
+
+        currency = CurrencyWithID(id=next(memory_store.currency_id_sequence), **data.model_dump())
+        memory_store.currencies[currency.id] = currency
+        memory_store.currency_ids[currency.code] = currency.id
+
+        version = await rate_cache.publish(session, currencies=[currency])
+        rate_cache.add_currency(currency, version)
+        return currency
+
+    @classmethod
+    async def add_missing(cls, session, data: list[Currency]) -> list[CurrencyWithID]:
+        currencies = []
+        for currency_data in data:
+            if currency_data.code in memory_store.currency_ids:
+                continue
+            currency = CurrencyWithID(id=next(memory_store.currency_id_sequence), **currency_data.model_dump())
+            memory_store.currencies[currency.id] = currency
+            memory_store.currency_ids[currency.code] = currency.id
+            currencies.append(currency)
+
+        if currencies:
+            version = await rate_cache.publish(session, currencies=currencies)
+            for currency in currencies:
+                rate_cache.add_currency(currency, version)
+        return currencies
+
+    @classmethod
+    async def get_by_code(cls, session, code: str) -> CurrencyWithID:
+        currency_id = memory_store.currency_ids.get(code)
+        if currency_id is None:
+            raise CurrencyNotFound
+        return memory_store.currencies[currency_id]
+
+    @classmethod
+    async def load_by_code(cls, code: str) -> CurrencyWithID:
+        return await cls.get_by_code(None, code)
+
+    @classmethod
+    async def exists_by_code(cls, session, code: str) -> bool:
+        return code in memory_store.currency_ids
+
+    @classmethod
+    async def delete(cls, session, code: str) -> CurrencyWithID:
+        currency_id = memory_store.currency_ids.get(code)
+        if currency_id is None:
+            raise CurrencyNotFound
+        # Rates are not removed along with their currencies, their history is
+        if any(currency_id in pair for pair in memory_store.exchange_rates):
+            raise CurrencyInUseError("Currency is used by exchange rates")
+
+        del memory_store.currency_ids[code]
+        currency = memory_store.currencies.pop(currency_id)
+        for pair in [pair for pair in memory_store.history if currency_id in pair]:
+            del memory_store.history[pair]
+
+        version = await rate_cache.publish(session, removed_currencies=[currency_id])
+        rate_cache.remove_currency(currency_id, version)
+        return currency
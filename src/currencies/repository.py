@@ -1,7 +1,15 @@
-from sqlalchemy import select
+from typing import AsyncIterator
 
-from database import async_session_maker
-from exceptions import CurrencyNotFound, EntityExistsError
+from sqlalchemy import or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import rate_cache
+from database import async_session_maker, use_replica
+from dataloader import DataLoader
+from exceptions import CurrencyInUseError, CurrencyNotFound, EntityExistsError
+from exchange_rates.models import ExchangeRateORM
 
 from .models import CurrencyORM
 from .schemas import Currency, CurrencyWithID
@@ -9,69 +17,136 @@ from .schemas import Currency, CurrencyWithID
 
 class CurrencyRepository:
     @classmethod
-    async def get_all(cls) -> list[CurrencyWithID]:
-        async with async_session_maker() as session:
-            query = select(CurrencyORM)
-            result = await session.execute(query)
+    async def get_all(cls, session: AsyncSession) -> list[CurrencyWithID]:
+        query = select(CurrencyORM)
+        result = await session.execute(query)
 
-            currencies_orm = result.scalars().all()
-            currencies = [
-                CurrencyWithID.model_validate(currency_orm) for currency_orm in currencies_orm
-            ]
-            return currencies
+        currencies_orm = result.scalars().all()
+        currencies = [
+            CurrencyWithID.model_validate(currency_orm) for currency_orm in currencies_orm
+        ]
+        return currencies
 
     @classmethod
-    async def add(cls, data: Currency) -> CurrencyWithID:
-        async with async_session_maker() as session:
-            query = select(CurrencyORM).filter(CurrencyORM.code == data.code)
-            result = await session.execute(query)
+    async def stream_all(cls,
+                         session: AsyncSession,
+                         chunk_size: int) -> AsyncIterator[list[CurrencyWithID]]:
+        query = select(CurrencyORM).order_by(CurrencyORM.id).execution_options(yield_per=chunk_size)
+        result = await session.stream_scalars(query)
 
-            if result.scalar_one_or_none() is not None:
-                raise EntityExistsError("Currency with this code already exists")
+        async for currencies_orm in result.partitions():
+            yield [CurrencyWithID.model_validate(currency_orm) for currency_orm in currencies_orm]
 
-            currency_dict = data.model_dump()
-            currency_orm = CurrencyORM(**currency_dict)
+    @classmethod
+    async def add(cls, session: AsyncSession, data: Currency) -> CurrencyWithID:
+        query = select(CurrencyORM).filter(CurrencyORM.code == data.code)
+        result = await session.execute(query)
 
-            session.add(currency_orm)
-            await session.flush()
-            await session.commit()
-            return currency_orm
+        if result.scalar_one_or_none() is not None:
+            raise EntityExistsError("Currency with this code already exists")
+
+        currency_dict = data.model_dump()
+        currency_orm = CurrencyORM(**currency_dict)
+
+        session.add(currency_orm)
+        await session.flush()
+
+        currency = CurrencyWithID.model_validate(currency_orm)
+        version = await rate_cache.publish(session, currencies=[currency])
+        await session.commit()
+        rate_cache.add_currency(currency, version)
+        return currency_orm
 
     @classmethod
-    async def get_by_code(cls, code: str) -> CurrencyWithID:
-        async with async_session_maker() as session:
-            query = select(CurrencyORM).filter(CurrencyORM.code == code)
-            result = await session.execute(query)
-            currency_orm = result.scalar_one_or_none()
+    async def add_missing(cls, session: AsyncSession, data: list[Currency]) -> list[CurrencyWithID]:
+        if not data:
+            return []
+
+        insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+        query = insert(CurrencyORM).values([currency.model_dump() for currency in data])
+        query = query.on_conflict_do_nothing(index_elements=[CurrencyORM.code]).returning(CurrencyORM)
+        result = await session.execute(query)
+        currencies = [CurrencyWithID.model_validate(currency_orm) for currency_orm in result.scalars()]
+        if not currencies:
+            return []
+
+        version = await rate_cache.publish(session, currencies=currencies)
+        await session.commit()
+        for currency in currencies:
+            rate_cache.add_currency(currency, version)
+        return currencies
 
-            if currency_orm is None:
-                raise CurrencyNotFound
+    @classmethod
+    async def get_by_code(cls, session: AsyncSession, code: str) -> CurrencyWithID:
+        query = select(CurrencyORM).filter(CurrencyORM.code == code)
+        result = await session.execute(query)
+        currency_orm = result.scalar_one_or_none()
 
-            currency = CurrencyWithID.model_validate(currency_orm)
-            return currency
+        if currency_orm is None:
+            raise CurrencyNotFound
 
+        currency = CurrencyWithID.model_validate(currency_orm)
+        return currency
+
+    # Batched with the lookups of other requests on a session of its own, so it does not
+    # see the caller's uncommitted writes
     @classmethod
-    async def exists_by_code(cls, code: str) -> bool:
-        async with async_session_maker() as session:
-            query = select(CurrencyORM).filter(CurrencyORM.code == code)
-            result = await session.execute(query)
-            currency_orm = result.scalar_one_or_none()
+    async def load_by_code(cls, code: str) -> CurrencyWithID:
+        currency = await _code_loader.load(code)
 
-            if currency_orm is None:
-                return False
-            else:
-                return True
+        if currency is None:
+            raise CurrencyNotFound
+
+        return currency
 
     @classmethod
-    async def delete(cls, code: str) -> CurrencyWithID:
+    async def _get_many_by_codes(cls, codes: list[str]) -> dict[str, CurrencyWithID]:
+        query = select(CurrencyORM).filter(CurrencyORM.code.in_(codes))
+
         async with async_session_maker() as session:
-            query = select(CurrencyORM).filter(CurrencyORM.code == code)
+            use_replica(session)
             result = await session.execute(query)
-            currency = result.scalar_one_or_none()
+            return {currency_orm.code: CurrencyWithID.model_validate(currency_orm)
+                    for currency_orm in result.scalars()}
+
+    @classmethod
+    async def exists_by_code(cls, session: AsyncSession, code: str) -> bool:
+        query = select(CurrencyORM.id).filter(CurrencyORM.code == code)
+        result = await session.execute(query)
+        currency_id = result.scalar_one_or_none()
+
+        if currency_id is None:
+            return False
+        else:
+            return True
+
+    @classmethod
+    async def delete(cls, session: AsyncSession, code: str) -> CurrencyWithID:
+        query = select(CurrencyORM).filter(CurrencyORM.code == code)
+        result = await session.execute(query)
+        currency = result.scalar_one_or_none()
+
+        if currency is None:
+            raise CurrencyNotFound
+
+        # Rates are not removed along with their currencies, their history is
+        rate_query = select(ExchangeRateORM.id).filter(or_(ExchangeRateORM.base_currency_id == currency.id,
+                                                           ExchangeRateORM.target_currency_id == currency.id))
+        if (await session.execute(rate_query.limit(1))).first() is not None:
+            raise CurrencyInUseError("Currency is used by exchange rates")
+
+        await session.delete(currency)
+        try:
+            await session.flush()
+        except IntegrityError:
+            # A rate added since the check
+            await session.rollback()
+            raise CurrencyInUseError("Currency is used by exchange rates")
+
+        version = await rate_cache.publish(session, removed_currencies=[currency.id])
+        await session.commit()
+        rate_cache.remove_currency(currency.id, version)
+        return currency
 
-            if currency is None:
-                raise CurrencyNotFound
 
-            await session.delete(currency)
-            await session.commit()
-            return currency
+_code_loader = DataLoader(CurrencyRepository._get_many_by_codes)
@@ -1,11 +1,19 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Body, Path
+from fastapi import APIRouter, Body, Depends, Path, Query, Request, Response
 from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from exceptions import CurrencyNotFound, EntityExistsError
+from cache import rate_cache
+from conditional import not_modified
+from database import get_async_session
+from exceptions import CurrencyInUseError, CurrencyNotFound, EntityExistsError
+from export import ExportFormat, export_response
+from metrics import record_error
+from responses import json_response
+from singleflight import currency_lookups
+from storage import CurrencyRepository
 
-from .repository import CurrencyRepository
 from .schemas import Currency, CurrencyWithID
 
 router = APIRouter(
@@ -15,35 +23,77 @@ router = APIRouter(
 
 
 @router.get("", response_model=list[CurrencyWithID])
-async def get_currencies():
-    currencies = await CurrencyRepository.get_all()
-    return currencies
+async def get_currencies(session: Annotated[AsyncSession, Depends(get_async_session)],
+                         request: Request,
+                         response: Response):
+    not_modified_response = not_modified(request, response, "currency")
+    if not_modified_response is not None:
+        return not_modified_response
+
+    if rate_cache.ready:
+        return json_response(rate_cache.get_currencies_json(), response)
+
+    currencies = await CurrencyRepository.get_all(session)
+    return json_response(currencies, response)
 
 
 @router.post("", response_model=CurrencyWithID)
-async def post_currency(currency: Annotated[Currency, Body()]):
+async def post_currency(session: Annotated[AsyncSession, Depends(get_async_session)],
+                        currency: Annotated[Currency, Body()]):
     try:
-        currency_with_id = await CurrencyRepository.add(currency)
-    except EntityExistsError:
+        currency_with_id = await CurrencyRepository.add(session, currency)
+    except EntityExistsError as exc:
+        record_error(exc)
         return JSONResponse(status_code=409,
                             content={"message": "Валюта с таким кодом уже существует"})
     return currency_with_id
 
 
+@router.get("/export")
+async def export_currencies(format: Annotated[ExportFormat, Query()] = "ndjson"):
+    return export_response(
+        CurrencyRepository.stream_all,
+        format,
+        filename="currencies",
+        csv_header=["id", "code", "name", "sign"],
+        to_csv_row=lambda currency: [currency.id, currency.code, currency.name, currency.sign]
+    )
+
+
 @router.get("/{code}", response_model=CurrencyWithID)
-async def get_currency(code: Annotated[str, Path()]):
+async def get_currency(request: Request,
+                       response: Response,
+                       code: Annotated[str, Path()]):
+    not_modified_response = not_modified(request, response, "currency")
+    if not_modified_response is not None:
+        return not_modified_response
+
+    if rate_cache.ready:
+        currency = rate_cache.get_currency(code)
+        if currency is None:
+            record_error(CurrencyNotFound())
+            return JSONResponse(status_code=404, content={"message": "Currency not found"})
+        return json_response(currency, response)
+
     try:
-        currency = await CurrencyRepository.get_by_code(code=code)
-    except CurrencyNotFound:
+        currency = await currency_lookups.do(code, lambda: CurrencyRepository.load_by_code(code))
+    except CurrencyNotFound as exc:
+        record_error(exc)
         return JSONResponse(status_code=404, content={"message": "Currency not found"})
-    return currency
+    return json_response(currency, response)
 
 
 @router.delete("/{code}", response_model=CurrencyWithID)
-async def delete_currency(code: Annotated[str, Path()]):
+async def delete_currency(session: Annotated[AsyncSession, Depends(get_async_session)],
+                          code: Annotated[str, Path()]):
     try:
-        currency = await CurrencyRepository.delete(code=code)
-    except CurrencyNotFound:
+        currency = await CurrencyRepository.delete(session, code=code)
+    except CurrencyNotFound as exc:
+        record_error(exc)
         return JSONResponse(status_code=404,
                             content={"message": "Валюта не найдена"})
+    except CurrencyInUseError as exc:
+        record_error(exc)
+        return JSONResponse(status_code=409,
+                            content={"message": "Валюта используется в обменных курсах"})
     return currency
@@ -1,31 +1,227 @@
+import asyncio
+import contextlib
+import os
+import sys
+import time
+from pathlib import Path
 from typing import AsyncGenerator
-from sqlalchemy.pool import NullPool
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import BigInteger, Column, Select, Sequence, String, Table, event, func, inspect, select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.requests import HTTPConnection
 
-from config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from config import (DB_HOST, DB_MAX_OVERFLOW, DB_NAME, DB_PASS, DB_POOL_PRE_PING,
+                    DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_PORT, DB_REPLICA_URLS, DB_USER,
+                    SQL_PROFILE_SAMPLE_RATE, SQL_SLOW_QUERY_THRESHOLD, SQLITE_PATH, STORAGE_BACKEND)
+import metrics
+import profiler
+from memory_store import memory_store
+from replicas import ReplicaSet
 
 Base = declarative_base()
 
-# DATABASE_URL = "sqlite:///./database.db"
-# engine = create_async_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-# async_session_maker = async_sessionmaker(engine, autoflush=False)
+# Shared by all workers to order cache invalidations, see cache.py
+cache_version_sequence = Sequence("cache_version", metadata=Base.metadata)
+# The highest committed cache version of each cached table. Written with the NOTIFY, so
+# workers that reload agree on the versions with the ones that applied the notifications
+cache_table_version = Table(
+    "cache_table_version", Base.metadata,
+    Column("table_name", String, primary_key=True),
+    Column("version", BigInteger, nullable=False),
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run alongside the single writer
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.pool_checkout_wait.observe(time.perf_counter() - started)
+
+
+def _create_postgres_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        poolclass=_TimedQueuePool,
+    )
+
+
+replica_engines = []
+if STORAGE_BACKEND == "postgres":
+    DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    engine = _create_postgres_engine(DATABASE_URL)
+    replica_engines = [_create_postgres_engine(url) for url in DB_REPLICA_URLS]
+    pool = engine.sync_engine.pool
+    metrics.pool_size.set_function(pool.size)
+    metrics.pool_checked_out.set_function(pool.checkedout)
+    metrics.pool_utilisation.set_function(lambda: pool.checkedout() / (pool.size() + DB_MAX_OVERFLOW))
+elif STORAGE_BACKEND == "sqlite":
+    DATABASE_URL = f"sqlite+aiosqlite:///{SQLITE_PATH}"
+    engine = create_async_engine(DATABASE_URL)
+    event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+elif STORAGE_BACKEND == "memory":
+    # Repositories keep everything in memory_store, there is no database
+    DATABASE_URL = None
+    engine = None
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+replica_set = ReplicaSet(replica_engines)
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not isinstance(clause, Select):
+            # Anything but a plain select pins the session to the primary, so it reads its own writes
+            self.info["replica"] = False
+        elif self.info.get("replica"):
+            # One replica for the whole session, another one may be further behind and
+            # undo what the earlier reads have shown
+            replica = self.info.get("replica_engine")
+            if replica is None:
+                replica = self.info["replica_engine"] = replica_set.choose()
+            if replica is not None and replica in replica_set.healthy:
+                return replica.sync_engine
+            # The primary is never behind any replica, later reads stay on it
+            self.info["replica"] = False
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+
+if engine is not None:
+    for instrumented_engine in [engine, *replica_engines]:
+        event.listen(instrumented_engine.sync_engine, "before_cursor_execute", metrics.before_cursor_execute)
+        event.listen(instrumented_engine.sync_engine, "after_cursor_execute", metrics.after_cursor_execute)
+        event.listen(instrumented_engine.sync_engine, "handle_error", metrics.handle_error)
+        if SQL_PROFILE_SAMPLE_RATE > 0 or SQL_SLOW_QUERY_THRESHOLD > 0:
+            profiler.install(instrumented_engine)
+    async_session_maker = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=RoutingSession)
+else:
+    # Sessions are None, so `async with async_session_maker() as session` works everywhere
+    async_session_maker = contextlib.nullcontext
 
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
-async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
+# Reads of the session may go to a replica until it writes. Sessions start on the
+# primary, the cache reloads after NOTIFY must not see a lagging replica
+def use_replica(session: AsyncSession | None) -> None:
+    if session is not None:
+        session.info["replica"] = True
 
-async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+
+# Responses tagged with the cache version must not be read from a replica that is behind it
+def use_primary(session: AsyncSession | None) -> None:
+    if session is not None:
+        session.info["replica"] = False
+
+
+async def get_async_session(connection: HTTPConnection) -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
+        if connection.scope.get("method", "GET") in ("GET", "HEAD"):
+            use_replica(session)
         yield session
 
 
 async def create_all_tables():
+    if engine is None:
+        return
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
 async def drop_all_tables():
+    if engine is None:
+        memory_store.clear()
+        return
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+# Any constant works, it only has to be the same for every worker
+MIGRATION_LOCK_ID = 7_140_215_331
+# The first migration, the schema the app created with create_all before it had migrations
+BASELINE_REVISION = "6c62ac3c6e51"
+
+
+def _pending_migrations(connection) -> bool:
+    alembic_config = Config(ROOT_DIR / "alembic.ini")
+    alembic_config.set_main_option("script_location", str(ROOT_DIR / "migrations"))
+    heads = set(ScriptDirectory.from_config(alembic_config).get_heads())
+    return set(MigrationContext.configure(connection).get_current_heads()) != heads
+
+
+def _unstamped_revision(connection) -> str | None:
+    # Databases created from the models have tables but no Alembic history. They are
+    # stamped at the newest migration whose schema objects they already have
+    if MigrationContext.configure(connection).get_current_heads():
+        return None
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    if "currency" not in tables:
+        return None
+    if "cache_table_version" in tables:
+        return "e2b7c4a90d15"
+    if "cache_version" in inspector.get_sequence_names():
+        return "5d2a8f6e1c39"
+    if "exchange_rate_history" in tables:
+        return "9b7e41c05d2f"
+    if any(index["name"] == "ix_base_currency_id_target_currency_id"
+           for index in inspector.get_indexes("exchange_rate")):
+        return "3f1d9c2a7b84"
+    return BASELINE_REVISION
+
+
+async def _alembic(*args: str):
+    # In a subprocess, like the alembic CLI: env.py imports the app through the src package
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [
+        str(ROOT_DIR / "src"), os.environ.get("PYTHONPATH")
+    ]))}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "alembic", *args, cwd=ROOT_DIR, env=env
+    )
+    if await process.wait() != 0:
+        raise RuntimeError(f"alembic {' '.join(args)} failed")
+
+
+async def run_migrations():
+    if engine is None:
+        return
+    if engine.dialect.name != "postgresql":
+        # The migrations are written for Postgres, other databases get the current schema
+        await create_all_tables()
+        return
+
+    # Workers starting together wait for the first one, then find nothing pending
+    async with engine.connect() as conn:
+        await conn.execute(select(func.pg_advisory_lock(MIGRATION_LOCK_ID)))
+        try:
+            unstamped_revision = await conn.run_sync(_unstamped_revision)
+            pending = await conn.run_sync(_pending_migrations)
+            # Release the read lock on alembic_version, the advisory lock outlives the transaction
+            await conn.commit()
+            if unstamped_revision is not None:
+                await _alembic("stamp", unstamped_revision)
+            if pending:
+                await _alembic("upgrade", "head")
+        finally:
+            await conn.execute(select(func.pg_advisory_unlock(MIGRATION_LOCK_ID)))
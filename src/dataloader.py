@@ -0,0 +1,63 @@
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from config import DATALOADER_MAX_BATCH_SIZE, DATALOADER_WINDOW
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+# Keys loaded within `window` seconds of each other, or until `max_batch_size` of them are
+# waiting, are resolved by one call of batch_load. Keys missing from its result load as None
+class DataLoader(Generic[K, V]):
+    def __init__(self,
+                 batch_load: Callable[[list[K]], Awaitable[dict[K, V]]],
+                 window: float = DATALOADER_WINDOW,
+                 max_batch_size: int = DATALOADER_MAX_BATCH_SIZE):
+        self.batch_load = batch_load
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: dict[K, asyncio.Future] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._batches: set[asyncio.Task] = set()
+
+    async def load(self, key: K) -> V | None:
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch_size:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._dispatch)
+        # A cancelled caller must not cancel the other callers waiting for the same key
+        return await asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        # The batch serves several requests, it is not counted towards the one that started it
+        task = asyncio.get_running_loop().create_task(self._run(batch), context=contextvars.Context())
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch: dict[K, asyncio.Future]) -> None:
+        try:
+            results = await self.batch_load(list(batch))
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as exc:
+            for future in batch.values():
+                future.set_exception(exc)
+                # Marks the exception as retrieved when every caller was cancelled
+                future.exception()
+            return
+
+        for key, future in batch.items():
+            future.set_result(results.get(key))
@@ -2,6 +2,10 @@ class EntityExistsError(BaseException):
     pass
 
 
+class CurrencyInUseError(BaseException):
+    pass
+
+
 class _EntityNotFound(BaseException):
     pass
 
@@ -0,0 +1,119 @@
+import math
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import Literal, get_args
+
+import numpy as np
+
+from config import EXCHANGE_ROUNDING
+
+RoundingMode = Literal["half_even", "half_up", "half_down", "down", "up", "floor", "ceiling"]
+
+if EXCHANGE_ROUNDING not in get_args(RoundingMode):
+    raise ValueError(f"Unknown EXCHANGE_ROUNDING: {EXCHANGE_ROUNDING}")
+
+# Rates are fixed-point with this many decimal places, or this many significant digits
+# when that takes more, so that small rates do not round to 0
+RATE_DECIMALS = 9
+RATE_SCALE = 10 ** RATE_DECIMALS
+
+DEFAULT_MINOR_UNITS = 2
+# ISO 4217 exponents that differ from the default
+MINOR_UNITS = {
+    "BHD": 3, "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "IQD": 3, "ISK": 0, "JOD": 3,
+    "JPY": 0, "KMF": 0, "KRW": 0, "KWD": 3, "LYD": 3, "OMR": 3, "PYG": 0, "RWF": 0,
+    "TND": 3, "UGX": 0, "UYI": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+}
+
+INT64_MAX = np.iinfo(np.int64).max
+# Largest power of ten in int64
+INT64_MAX_EXPONENT = 18
+# Largest accepted amount, in minor units it stays within int64 for any exponent above
+MAX_AMOUNT = 10 ** 15
+
+
+def minor_units(code: str) -> int:
+    return MINOR_UNITS.get(code, DEFAULT_MINOR_UNITS)
+
+
+# The rate as an integer and its number of decimal places
+def scale_rate(rate: float) -> tuple[int, int]:
+    if rate >= 10 ** -1:
+        return round(rate * RATE_SCALE), RATE_DECIMALS
+    decimals = RATE_DECIMALS - 1 - math.floor(math.log10(rate))
+    return int(Decimal(rate).scaleb(decimals).to_integral_value(ROUND_HALF_EVEN)), decimals
+
+
+def to_major(amount: int, units: int) -> float:
+    return amount / 10 ** units
+
+
+# numerator / denominator rounded to an integer. Only uses operators that behave the same
+# on Python ints and int64 arrays, so the exact and the vectorized paths share it.
+# denominator must be positive
+def _round_divide(numerator, denominator, rounding: RoundingMode):
+    quotient = numerator // denominator
+    remainder = numerator - quotient * denominator
+    if rounding == "floor":
+        return quotient
+
+    inexact = remainder > 0
+    if rounding == "ceiling":
+        return quotient + inexact
+    if rounding == "down":
+        return quotient + (inexact & (numerator < 0))
+    if rounding == "up":
+        return quotient + (inexact & (numerator > 0))
+
+    above_half = 2 * remainder > denominator
+    tie = 2 * remainder == denominator
+    if rounding == "half_up":
+        return quotient + (above_half | (tie & (numerator > 0)))
+    if rounding == "half_down":
+        return quotient + (above_half | (tie & (numerator < 0)))
+    return quotient + (above_half | (tie & (quotient % 2 == 1)))
+
+
+def convert(amount: Decimal,
+            rate: float,
+            target_units: int,
+            rounding: RoundingMode = EXCHANGE_ROUNDING) -> int:
+    # Exact for any amount: the decimal is split into an integer and a power of ten
+    sign, digits, exponent = amount.as_tuple()
+    mantissa = int("".join(map(str, digits))) * (-1 if sign else 1)
+    scaled_rate, rate_decimals = scale_rate(rate)
+    numerator = mantissa * scaled_rate * 10 ** (target_units + max(exponent, 0))
+    denominator = 10 ** (rate_decimals - min(exponent, 0))
+    return _round_divide(numerator, denominator, rounding)
+
+
+def convert_many(amounts: np.ndarray,
+                 base_units: np.ndarray,
+                 rates: np.ndarray,
+                 rate_decimals: np.ndarray,
+                 target_units: np.ndarray,
+                 rounding: RoundingMode = EXCHANGE_ROUNDING) -> np.ndarray:
+    # amounts are int64 in base minor units, rates and rate_decimals come from scale_rate.
+    # rates is an object array of Python ints when some of them do not fit in int64
+    exponents = (base_units + rate_decimals - target_units).astype(np.int64)
+    if rates.dtype == object:
+        fits = np.fromiter((rate <= INT64_MAX for rate in rates.tolist()), dtype=bool, count=len(rates))
+        int64_rates = np.where(fits, rates, 0).astype(np.int64)
+    else:
+        fits = np.ones(len(rates), dtype=bool)
+        int64_rates = rates
+    fits &= exponents <= INT64_MAX_EXPONENT
+    denominators = 10 ** np.where(fits, exponents, 0)
+    converted = np.zeros(len(amounts), dtype=np.int64)
+
+    # The product has to fit in int64, the few amounts and rates that are too large take the exact path
+    fits &= np.abs(amounts) <= INT64_MAX // np.maximum(int64_rates, 1)
+    converted[fits] = _round_divide(amounts[fits] * int64_rates[fits], denominators[fits], rounding)
+    indexes = np.flatnonzero(~fits).tolist()
+    exact = [_round_divide(int(amounts[index]) * int(rates[index]), 10 ** int(exponents[index]), rounding)
+             for index in indexes]
+    # Results that do not fit in int64 are kept as Python ints
+    if any(abs(value) > INT64_MAX for value in exact):
+        converted = converted.astype(object)
+    for index, value in zip(indexes, exact):
+        converted[index] = value
+    return converted
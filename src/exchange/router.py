@@ -1,11 +1,25 @@
+import asyncio
+import datetime
+from decimal import Decimal
 from typing import Annotated
 
-from fastapi import APIRouter, Query
+import numpy as np
+from fastapi import APIRouter, Body, Depends, Query
 from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from cache import rate_cache
+from config import EXCHANGE_PIVOT_CURRENCIES
+from database import get_async_session
 from exceptions import ExchangeRateNotFound
-from exchange.schemas import Exchange
-from exchange_rates.repository import ExchangeRateRepository
+from exchange.conversion import (EXCHANGE_ROUNDING, INT64_MAX, MAX_AMOUNT, RoundingMode, convert,
+                                 convert_many, minor_units, scale_rate, to_major)
+from exchange.schemas import Exchange, ExchangeBatch, ExchangeBatchResult
+from exchange_rates.schemas import ExchangeRateWithCurrencies, UTCDatetime
+from exchange_rates.snapshot import rate_snapshot
+from metrics import record_error
+from singleflight import pair_lookups
+from storage import ExchangeRateRepository
 
 router = APIRouter(
     prefix="/exchange",
@@ -14,23 +28,193 @@ router = APIRouter(
 
 
 @router.get("", response_model=Exchange)
-async def get_exchange(baseCode: Annotated[str, Query()],
+async def get_exchange(session: Annotated[AsyncSession, Depends(get_async_session)],
+                       baseCode: Annotated[str, Query()],
                        targetCode: Annotated[str, Query()],
-                       amount: Annotated[float, Query()]):
+                       amount: Annotated[Decimal, Query(allow_inf_nan=False, ge=-MAX_AMOUNT, le=MAX_AMOUNT)],
+                       at: Annotated[UTCDatetime | None, Query()] = None,
+                       rounding: Annotated[RoundingMode, Query()] = EXCHANGE_ROUNDING):
     try:
-        exchange_rate = await ExchangeRateRepository.get_by_pair(baseCode, targetCode)
-    except ExchangeRateNotFound:
+        if at is None and rate_cache.ready:
+            exchange_rate = rate_snapshot.get_by_pair(baseCode, targetCode)
+        elif at is None:
+            exchange_rate = await pair_lookups.do(("conversion", baseCode, targetCode),
+                                                  lambda: _get_exchange_rate(baseCode, targetCode))
+        else:
+            exchange_rate = await pair_lookups.do(
+                ("conversion_at", baseCode, targetCode, at),
+                lambda: _get_exchange_rate_at(session, baseCode, targetCode, at)
+            )
+    except ExchangeRateNotFound as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=404,
             content={"message": "Обменный курс для пары не найден"}
         )
 
+    target_units = minor_units(exchange_rate.target_currency.code)
+    converted_amount = convert(amount, exchange_rate.rate, target_units, rounding)
+
     exchange_dict = {
         "base_currency": exchange_rate.base_currency,
         "target_currency": exchange_rate.target_currency,
         "rate": exchange_rate.rate,
         "amount": amount,
-        "converted_amount": round(float(exchange_rate.rate) * amount, 2)
+        "converted_amount": to_major(converted_amount, target_units)
     }
 
     return exchange_dict
+
+
+# While the rate cache is not current: the stored pair, its inverse, or through a pivot currency
+async def _get_exchange_rate(base_currency_code: str, target_currency_code: str) -> ExchangeRateWithCurrencies:
+    if base_currency_code != target_currency_code:
+        exchange_rate = await _get_edge(base_currency_code, target_currency_code)
+        if exchange_rate is not None:
+            return exchange_rate
+
+        for pivot_code in EXCHANGE_PIVOT_CURRENCIES:
+            if pivot_code in (base_currency_code, target_currency_code):
+                continue
+            to_pivot, from_pivot = await asyncio.gather(_get_edge(base_currency_code, pivot_code),
+                                                        _get_edge(pivot_code, target_currency_code))
+            if to_pivot is not None and from_pivot is not None:
+                return ExchangeRateWithCurrencies(
+                    rate=to_pivot.rate * from_pivot.rate,
+                    base_currency=to_pivot.base_currency,
+                    target_currency=from_pivot.target_currency
+                )
+
+    raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+
+async def _get_edge(base_currency_code: str, target_currency_code: str) -> ExchangeRateWithCurrencies | None:
+    # Both directions are loaded in the same batch
+    exchange_rate, inverse_rate = await asyncio.gather(_load_pair(base_currency_code, target_currency_code),
+                                                       _load_pair(target_currency_code, base_currency_code))
+    if exchange_rate is not None:
+        return exchange_rate
+    if inverse_rate is not None:
+        return ExchangeRateWithCurrencies(
+            rate=1 / inverse_rate.rate,
+            base_currency=inverse_rate.target_currency,
+            target_currency=inverse_rate.base_currency
+        )
+    return None
+
+
+async def _load_pair(base_currency_code: str, target_currency_code: str) -> ExchangeRateWithCurrencies | None:
+    try:
+        return await ExchangeRateRepository.load_by_pair(base_currency_code, target_currency_code)
+    except ExchangeRateNotFound:
+        return None
+
+
+def _get_cached_rate(base_currency_code: str, target_currency_code: str) -> float | None:
+    try:
+        return rate_snapshot.get_by_pair(base_currency_code, target_currency_code).rate
+    except ExchangeRateNotFound:
+        return None
+
+
+async def _get_stored_rate(base_currency_code: str, target_currency_code: str) -> float | None:
+    try:
+        exchange_rate = await pair_lookups.do(
+            ("conversion", base_currency_code, target_currency_code),
+            lambda: _get_exchange_rate(base_currency_code, target_currency_code)
+        )
+    except ExchangeRateNotFound:
+        return None
+    return exchange_rate.rate
+
+
+async def _get_exchange_rate_at(session: AsyncSession,
+                                base_currency_code: str,
+                                target_currency_code: str,
+                                at: datetime.datetime) -> ExchangeRateWithCurrencies:
+    try:
+        return await ExchangeRateRepository.get_by_pair_at(session,
+                                                           base_currency_code,
+                                                           target_currency_code,
+                                                           at)
+    except ExchangeRateNotFound:
+        inverse_rate = await ExchangeRateRepository.get_by_pair_at(session,
+                                                                   target_currency_code,
+                                                                   base_currency_code,
+                                                                   at)
+
+    return ExchangeRateWithCurrencies(
+        rate=1 / inverse_rate.rate,
+        base_currency=inverse_rate.target_currency,
+        target_currency=inverse_rate.base_currency
+    )
+
+
+@router.post("/batch", response_model=list[ExchangeBatchResult])
+async def post_exchange_batch(batch: Annotated[ExchangeBatch, Body()]):
+    if batch.items is not None:
+        pairs = [(item.baseCode, item.targetCode) for item in batch.items]
+        amounts = np.fromiter((item.amount for item in batch.items), dtype=np.float64,
+                              count=len(batch.items))
+    else:
+        pairs = [(batch.baseCode, batch.targetCode)] * len(batch.amounts)
+        amounts = np.array(batch.amounts, dtype=np.float64)
+
+    pair_indexes: dict[tuple[str, str], int] = {}
+    item_pair_indexes = np.fromiter((pair_indexes.setdefault(pair, len(pair_indexes)) for pair in pairs),
+                                    dtype=np.intp, count=len(pairs))
+
+    pair_rates = np.empty(len(pair_indexes), dtype=np.float64)
+    missing_pairs = []
+    if rate_cache.ready:
+        found_rates = [_get_cached_rate(base_code, target_code) for base_code, target_code in pair_indexes]
+    else:
+        found_rates = await asyncio.gather(*(_get_stored_rate(base_code, target_code)
+                                             for base_code, target_code in pair_indexes))
+    for ((base_code, target_code), index), rate in zip(pair_indexes.items(), found_rates):
+        if rate is None:
+            missing_pairs.append(base_code + target_code)
+        else:
+            pair_rates[index] = rate
+
+    if missing_pairs:
+        record_error(ExchangeRateNotFound())
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Обменный курс для пары не найден", "pairs": missing_pairs}
+        )
+
+    scaled_rates = [scale_rate(rate) for rate in pair_rates.tolist()]
+    # Rates too large for int64 are kept as Python ints, convert_many converts them exactly
+    pair_scaled_rates = np.array([scaled_rate for scaled_rate, _ in scaled_rates],
+                                 dtype=object if any(scaled_rate > INT64_MAX for scaled_rate, _ in scaled_rates)
+                                 else np.int64)
+    pair_rate_decimals = np.fromiter((rate_decimals for _, rate_decimals in scaled_rates),
+                                     dtype=np.int64, count=len(scaled_rates))
+    pair_base_units = np.fromiter((minor_units(base_code) for base_code, _ in pair_indexes),
+                                  dtype=np.int64, count=len(pair_indexes))
+    pair_target_units = np.fromiter((minor_units(target_code) for _, target_code in pair_indexes),
+                                    dtype=np.int64, count=len(pair_indexes))
+
+    base_units = pair_base_units[item_pair_indexes]
+    target_units = pair_target_units[item_pair_indexes]
+    # Amounts are taken in the base currency's minor units
+    minor_amounts = np.rint(amounts * 10.0 ** base_units).astype(np.int64)
+    converted_minor_amounts = convert_many(minor_amounts, base_units, pair_scaled_rates[item_pair_indexes],
+                                           pair_rate_decimals[item_pair_indexes], target_units,
+                                           batch.rounding or EXCHANGE_ROUNDING)
+
+    rates = pair_rates[item_pair_indexes]
+    converted_amounts = converted_minor_amounts / 10.0 ** target_units
+
+    return [
+        {
+            "baseCode": base_code,
+            "targetCode": target_code,
+            "rate": rate,
+            "amount": amount,
+            "converted_amount": converted_amount
+        }
+        for (base_code, target_code), rate, amount, converted_amount
+        in zip(pairs, rates.tolist(), amounts.tolist(), converted_amounts.tolist())
+    ]
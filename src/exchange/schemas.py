@@ -1,7 +1,13 @@
-from pydantic import BaseModel
+from typing import Annotated
+
+from pydantic import BaseModel, Field, model_validator
 
 from currencies.schemas import Currency
 
+from .conversion import MAX_AMOUNT, RoundingMode
+
+Amount = Annotated[float, Field(ge=-MAX_AMOUNT, le=MAX_AMOUNT)]
+
 
 class Exchange(BaseModel):
     base_currency: Currency
@@ -9,3 +15,32 @@ class Exchange(BaseModel):
     rate: float
     amount: float
     converted_amount: float
+
+
+class ExchangeBatchItem(BaseModel):
+    baseCode: str
+    targetCode: str
+    amount: Amount
+
+
+class ExchangeBatch(BaseModel):
+    items: list[ExchangeBatchItem] | None = None
+    baseCode: str | None = None
+    targetCode: str | None = None
+    amounts: list[Amount] | None = None
+    rounding: RoundingMode | None = None
+
+    @model_validator(mode="after")
+    def check_items_or_amounts(self) -> "ExchangeBatch":
+        single_pair = self.baseCode is not None and self.targetCode is not None and self.amounts is not None
+        if (self.items is None) == (not single_pair):
+            raise ValueError("Pass either items or baseCode, targetCode and amounts")
+        return self
+
+
+class ExchangeBatchResult(BaseModel):
+    baseCode: str
+    targetCode: str
+    rate: float
+    amount: float
+    converted_amount: float
@@ -0,0 +1,219 @@
+import asyncio
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from config import ANOMALY_FULL_SCAN_THRESHOLD, ANOMALY_MAX_CYCLE_LENGTH, ANOMALY_TOLERANCE
+
+from .graph import RateChange, RateGraph, rate_graph
+from .schemas import ExchangeRateAnomaly
+
+Cycle = tuple[int, ...]
+
+
+def _canonical(cycle: list[int]) -> Cycle:
+    start = cycle.index(min(cycle))
+    return tuple(cycle[start:] + cycle[:start])
+
+
+def find_negative_cycles(size: int,
+                         sources: np.ndarray,
+                         targets: np.ndarray,
+                         weights: np.ndarray) -> list[Cycle]:
+    # Bellman-Ford from a virtual source connected to every node, vectorized
+    # over the edges. Nodes still relaxing after `size` rounds lead back into
+    # a negative cycle through their predecessors.
+    epsilon = 1e-12
+    distances = np.zeros(size)
+    predecessors = np.full(size, -1)
+
+    for _ in range(size):
+        candidates = distances[sources] + weights
+        improving = candidates < distances[targets] - epsilon
+        if not improving.any():
+            return []
+
+        improved_sources = sources[improving]
+        improved_targets = targets[improving]
+        improved_candidates = candidates[improving]
+        np.minimum.at(distances, improved_targets, improved_candidates)
+        best = improved_candidates == distances[improved_targets]
+        predecessors[improved_targets[best]] = improved_sources[best]
+
+    candidates = distances[sources] + weights
+    relaxing = np.unique(targets[candidates < distances[targets] - epsilon])
+
+    cycles = set()
+    for node in relaxing.tolist():
+        for _ in range(size):
+            node = int(predecessors[node])
+            if node < 0:
+                break
+        if node < 0:
+            continue
+
+        cycle = [node]
+        current = int(predecessors[node])
+        while current != node and current >= 0 and len(cycle) <= size:
+            cycle.append(current)
+            current = int(predecessors[current])
+        if current == node:
+            cycles.add(_canonical(cycle[::-1]))
+
+    return list(cycles)
+
+
+class AnomalyDetector:
+    def __init__(self,
+                 graph: RateGraph,
+                 max_cycle_length: int,
+                 tolerance: float,
+                 full_scan_threshold: int):
+        self._graph = graph
+        self._max_cycle_length = max_cycle_length
+        self._min_log_profit = math.log1p(tolerance)
+        self._full_scan_threshold = full_scan_threshold
+        self._anomalies: dict[Cycle, float] = {}
+        self._executor: ProcessPoolExecutor | None = None
+        self._scan: asyncio.Task | None = None
+        self._rescan = False
+        self._pending: set[tuple[int, int]] = set()
+
+        graph.subscribe(self._on_change)
+
+    def get_all(self) -> list[ExchangeRateAnomaly]:
+        anomalies = []
+        for cycle, log_profit in sorted(self._anomalies.items(), key=lambda item: -item[1]):
+            codes = [self._graph.get_currency(currency_id).code for currency_id in cycle]
+            anomalies.append(ExchangeRateAnomaly(codes=codes + codes[:1], profit=math.expm1(log_profit)))
+        return anomalies
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _on_change(self, changes: list[RateChange] | None) -> None:
+        if changes is None or len(changes) > self._full_scan_threshold:
+            self._schedule_full_scan()
+            return
+
+        for change in changes:
+            edge = (change.base_currency.id, change.target_currency.id)
+            if self._scan is not None:
+                self._pending.add(edge)
+            self._check_edge(*edge)
+
+    def _check_edge(self, base_id: int, target_id: int) -> None:
+        self._anomalies = {
+            cycle: log_profit for cycle, log_profit in self._anomalies.items()
+            if not self._cycle_uses(cycle, base_id, target_id)
+        }
+
+        for start_id, next_id in ((base_id, target_id), (target_id, base_id)):
+            for cycle, log_profit in self._cycles_through(start_id, next_id):
+                self._anomalies[_canonical(cycle)] = log_profit
+
+    @staticmethod
+    def _cycle_uses(cycle: Cycle, base_id: int, target_id: int) -> bool:
+        steps = zip(cycle, cycle[1:] + cycle[:1])
+        return any({step_from, step_to} == {base_id, target_id} for step_from, step_to in steps)
+
+    def _cycles_through(self, start_id: int, next_id: int):
+        first_rate = self._graph.get_conversion_rate(start_id, next_id)
+        # Only positive rates have a log, anything else is not a usable conversion
+        if first_rate is None or first_rate <= 0:
+            return
+
+        # Depth-first search over simple paths back to start_id, bounded by
+        # the maximum cycle length, summing log rates along the way
+        stack = [(next_id, [start_id, next_id], math.log(first_rate))]
+        while stack:
+            node_id, path, log_product = stack.pop()
+            for neighbour_id in self._graph.get_neighbours(node_id):
+                rate = self._graph.get_conversion_rate(node_id, neighbour_id)
+                if rate is None or rate <= 0:
+                    continue
+
+                if neighbour_id == start_id:
+                    if log_product + math.log(rate) > self._min_log_profit:
+                        yield path, log_product + math.log(rate)
+                elif neighbour_id not in path and len(path) < self._max_cycle_length:
+                    stack.append((neighbour_id, path + [neighbour_id], log_product + math.log(rate)))
+
+    def _schedule_full_scan(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        if self._scan is None:
+            self._pending.clear()
+            self._scan = loop.create_task(self._full_scan())
+        else:
+            self._rescan = True
+
+    async def _full_scan(self) -> None:
+        try:
+            await self._run_full_scan()
+        finally:
+            self._scan = None
+
+        if self._rescan:
+            self._rescan = False
+            self._schedule_full_scan()
+
+    async def _run_full_scan(self) -> None:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+        positions: dict[int, int] = {}
+        sources, targets, weights = [], [], []
+        for base_id in list(self._graph.get_currency_ids().values()):
+            for target_id in self._graph.get_neighbours(base_id):
+                rate = self._graph.get_conversion_rate(base_id, target_id)
+                if rate is not None and rate > 0:
+                    sources.append(positions.setdefault(base_id, len(positions)))
+                    targets.append(positions.setdefault(target_id, len(positions)))
+                    weights.append(-math.log(rate))
+        ids = list(positions)
+
+        cycles = await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            find_negative_cycles,
+            len(ids),
+            np.array(sources, dtype=np.intp),
+            np.array(targets, dtype=np.intp),
+            np.array(weights, dtype=np.float64)
+        )
+
+        anomalies = {}
+        for cycle in cycles:
+            cycle = [ids[position] for position in cycle]
+            log_profit = self._log_profit(cycle)
+            if log_profit is not None and log_profit > self._min_log_profit:
+                anomalies[_canonical(cycle)] = log_profit
+        self._anomalies = anomalies
+
+        # Pairs changed while the scan was running are re-checked on top of it
+        pending, self._pending = self._pending, set()
+        for edge in pending:
+            self._check_edge(*edge)
+
+    def _log_profit(self, cycle: list[int]) -> float | None:
+        log_profit = 0.0
+        for step_from, step_to in zip(cycle, cycle[1:] + cycle[:1]):
+            rate = self._graph.get_conversion_rate(step_from, step_to)
+            if rate is None or rate <= 0:
+                return None
+            log_profit += math.log(rate)
+        return log_profit
+
+
+anomaly_detector = AnomalyDetector(rate_graph,
+                                   max_cycle_length=ANOMALY_MAX_CYCLE_LENGTH,
+                                   tolerance=ANOMALY_TOLERANCE,
+                                   full_scan_threshold=ANOMALY_FULL_SCAN_THRESHOLD)
@@ -0,0 +1,90 @@
+import asyncio
+from typing import NamedTuple
+
+from config import STREAM_MAX_PENDING
+
+from .graph import RateChange, RateGraph, rate_graph
+
+
+class RateDelta(NamedTuple):
+    base: str
+    target: str
+    # None when the pair was removed
+    rate: float | None
+
+
+class RateEvent(NamedTuple):
+    version: int
+    # True when deltas were dropped and the subscriber has to re-fetch /exchangeRates
+    resync: bool
+    deltas: list[RateDelta]
+
+
+class Subscription:
+    def __init__(self, max_pending: int):
+        self._max_pending = max_pending
+        self._pending: dict[tuple[str, str], RateDelta] = {}
+        self._resync = False
+        self._version = 0
+        self._ready = asyncio.Event()
+
+    def push(self, version: int, deltas: list[RateDelta] | None) -> None:
+        self._version = version
+        if deltas is None:
+            self._resync = True
+            self._pending.clear()
+        elif not self._resync:
+            # Only the latest rate of a pair is kept, so a slow consumer gets
+            # one delta per changed pair instead of every intermediate update
+            for delta in deltas:
+                self._pending[delta.base, delta.target] = delta
+            if len(self._pending) > self._max_pending:
+                self._resync = True
+                self._pending.clear()
+        self._ready.set()
+
+    async def get(self, timeout: float | None = None) -> RateEvent | None:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        event = RateEvent(self._version, self._resync, list(self._pending.values()))
+        self._pending = {}
+        self._resync = False
+        self._ready.clear()
+        return event
+
+
+class RateBroadcaster:
+    def __init__(self, graph: RateGraph, max_pending: int):
+        self._graph = graph
+        self._max_pending = max_pending
+        self._subscriptions: set[Subscription] = set()
+
+        graph.subscribe(self._on_change)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self._max_pending)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    def _on_change(self, changes: list[RateChange] | None) -> None:
+        if not self._subscriptions:
+            return
+
+        deltas = None
+        if changes is not None:
+            deltas = [
+                RateDelta(change.base_currency.code, change.target_currency.code, change.rate)
+                for change in changes
+            ]
+
+        for subscription in self._subscriptions:
+            subscription.push(self._graph.version, deltas)
+
+
+rate_broadcaster = RateBroadcaster(rate_graph, max_pending=STREAM_MAX_PENDING)
@@ -0,0 +1,41 @@
+import datetime
+from typing import Iterable
+
+from .schemas import ExchangeRateCandle
+
+
+# Same buckets as Postgres date_trunc
+def truncate(moment: datetime.datetime, interval: str) -> datetime.datetime:
+    if interval == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if interval == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "day":
+        return day
+    if interval == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Unknown interval: {interval}")
+
+
+# Builds candles from (valid_from, rate) entries sorted by valid_from, for
+# backends without date_trunc and ordered aggregates
+def build_candles(entries: Iterable[tuple[datetime.datetime, float]],
+                  interval: str) -> list[ExchangeRateCandle]:
+    candles: list[ExchangeRateCandle] = []
+    for valid_from, rate in entries:
+        rate = float(rate)
+        bucket = truncate(valid_from, interval)
+        if candles and candles[-1].time == bucket:
+            candle = candles[-1]
+            candle.high = max(candle.high, rate)
+            candle.low = min(candle.low, rate)
+            candle.close = rate
+            candle.count += 1
+        else:
+            candles.append(ExchangeRateCandle(time=bucket, open=rate, high=rate, low=rate,
+                                              close=rate, count=1))
+    return candles
@@ -0,0 +1,270 @@
+import logging
+from collections import deque
+from typing import Callable, Iterable, NamedTuple
+
+from config import EXCHANGE_PIVOT_CURRENCIES
+from currencies.schemas import CurrencyWithID
+from exceptions import ExchangeRateNotFound
+
+from .schemas import ExchangeRateWithCurrencies
+
+logger = logging.getLogger(__name__)
+
+
+class RateChange(NamedTuple):
+    base_currency: CurrencyWithID
+    target_currency: CurrencyWithID
+    # None when the pair was removed
+    rate: float | None
+
+
+# Called with the changed pairs, or with None when the whole graph was reloaded
+RateListener = Callable[[list[RateChange] | None], None]
+
+
+# A stored pair or its inverse, then through a pivot currency, then the shortest path
+def find_path(base_id: int,
+              target_id: int,
+              pivot_ids: list[int | None],
+              edge: Callable[[int, int], float | None],
+              neighbours: Callable[[int], Iterable[int]]) -> list[int] | None:
+    if edge(base_id, target_id) is not None:
+        return [base_id, target_id]
+
+    for pivot_id in pivot_ids:
+        if pivot_id is None or pivot_id in (base_id, target_id):
+            continue
+        if edge(base_id, pivot_id) is not None and edge(pivot_id, target_id) is not None:
+            return [base_id, pivot_id, target_id]
+
+    previous: dict[int, int | None] = {base_id: None}
+    queue = deque([base_id])
+    while queue:
+        node_id = queue.popleft()
+        for neighbour_id in neighbours(node_id):
+            if neighbour_id in previous or edge(node_id, neighbour_id) is None:
+                continue
+            previous[neighbour_id] = node_id
+            if neighbour_id == target_id:
+                path = [target_id]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                return path[::-1]
+            queue.append(neighbour_id)
+
+    return None
+
+
+class RateGraph:
+    max_cached_paths = 100_000
+
+    def __init__(self, pivots: list[str]):
+        self.pivots = pivots
+        self.version = 0
+        self._currencies: dict[int, CurrencyWithID] = {}
+        self._ids: dict[str, int] = {}
+        self._rates: dict[int, dict[int, float]] = {}
+        self._adjacent: dict[int, set[int]] = {}
+        self._paths: dict[tuple[int, int], list[int] | None] = {}
+        self._listeners: list[RateListener] = []
+
+    def subscribe(self, listener: RateListener) -> None:
+        self._listeners.append(listener)
+
+    def load(self,
+             currencies: list[CurrencyWithID],
+             exchange_rates: list[ExchangeRateWithCurrencies]) -> None:
+        self._currencies.clear()
+        self._ids.clear()
+        self._rates.clear()
+        self._adjacent.clear()
+
+        for currency in currencies:
+            self._add_currency(currency)
+        for exchange_rate in exchange_rates:
+            self._set_rate(exchange_rate)
+        self._changed(None)
+
+    def add_currency(self, currency: CurrencyWithID) -> None:
+        self._add_currency(currency)
+        self._changed([])
+
+    def remove_currency(self, currency_id: int) -> None:
+        currency = self._currencies.get(currency_id)
+        if currency is None:
+            return
+
+        changes = []
+        for neighbour_id in list(self._adjacent.get(currency_id, ())):
+            neighbour = self._currencies[neighbour_id]
+            if self._remove_rate(currency_id, neighbour_id):
+                changes.append(RateChange(currency, neighbour, None))
+            if self._remove_rate(neighbour_id, currency_id):
+                changes.append(RateChange(neighbour, currency, None))
+
+        del self._currencies[currency_id]
+        self._adjacent.pop(currency_id, None)
+        self._rates.pop(currency_id, None)
+        if self._ids.get(currency.code) == currency_id:
+            del self._ids[currency.code]
+        self._changed(changes)
+
+    def set_rate(self, exchange_rate: ExchangeRateWithCurrencies) -> None:
+        self.set_rates([exchange_rate])
+
+    def set_rates(self, exchange_rates: list[ExchangeRateWithCurrencies]) -> None:
+        for exchange_rate in exchange_rates:
+            self._set_rate(exchange_rate)
+        self._changed([
+            RateChange(exchange_rate.base_currency, exchange_rate.target_currency, float(exchange_rate.rate))
+            for exchange_rate in exchange_rates
+        ])
+
+    def remove_rate(self, base_currency: CurrencyWithID, target_currency: CurrencyWithID) -> None:
+        self._remove_rate(base_currency.id, target_currency.id)
+        self._changed([RateChange(base_currency, target_currency, None)])
+
+    def get_currency(self, currency_id: int) -> CurrencyWithID:
+        return self._currencies[currency_id]
+
+    def get_currencies(self) -> list[CurrencyWithID]:
+        return sorted(self._currencies.values(), key=lambda currency: currency.id)
+
+    def get_currency_by_code(self, code: str) -> CurrencyWithID | None:
+        currency_id = self._ids.get(code)
+        if currency_id is None:
+            return None
+        return self._currencies[currency_id]
+
+    def get_rate(self,
+                 base_currency_code: str,
+                 target_currency_code: str) -> ExchangeRateWithCurrencies:
+        base_id = self._ids.get(base_currency_code)
+        target_id = self._ids.get(target_currency_code)
+        rate = self._rates.get(base_id, {}).get(target_id)
+        if rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        return ExchangeRateWithCurrencies(
+            rate=rate,
+            base_currency=self._currencies[base_id],
+            target_currency=self._currencies[target_id]
+        )
+
+    def get_neighbours(self, currency_id: int) -> set[int]:
+        return self._adjacent.get(currency_id, set())
+
+    def get_conversion_rate(self, base_id: int, target_id: int) -> float | None:
+        return self._edge(base_id, target_id)
+
+    def get_by_pair(self,
+                    base_currency_code: str,
+                    target_currency_code: str) -> ExchangeRateWithCurrencies:
+        base_id = self._ids.get(base_currency_code)
+        target_id = self._ids.get(target_currency_code)
+        if base_id is None or target_id is None or base_id == target_id:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        rate = self.get_path_rate(base_id, target_id)
+        if rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        return ExchangeRateWithCurrencies(
+            rate=rate,
+            base_currency=self._currencies[base_id],
+            target_currency=self._currencies[target_id]
+        )
+
+    # The rate along the path /exchange converts through, None when there is none
+    def get_path_rate(self, base_id: int, target_id: int) -> float | None:
+        key = (base_id, target_id)
+        if key in self._paths:
+            path = self._paths[key]
+        else:
+            if len(self._paths) >= self.max_cached_paths:
+                self._paths.clear()
+            path = self._paths[key] = self._find_path(base_id, target_id)
+
+        if path is None:
+            return None
+
+        rate = 1.0
+        for step_from, step_to in zip(path, path[1:]):
+            rate *= self._edge(step_from, step_to)
+        return rate
+
+    def get_currency_ids(self) -> dict[str, int]:
+        return dict(self._ids)
+
+    def get_pivot_ids(self) -> list[int]:
+        return [self._ids[pivot_code] for pivot_code in self.pivots if pivot_code in self._ids]
+
+    def get_stored_rates(self, base_id: int) -> dict[int, float]:
+        return self._rates.get(base_id, {})
+
+    # Rates from base_id along the breadth-first search of the path lookup. Where the stored
+    # pair and the pivots give no rate, the path to every target is the one in this tree
+    def get_search_rates(self, base_id: int) -> dict[int, float]:
+        rates = {base_id: 1.0}
+        queue = deque([base_id])
+        while queue:
+            node_id = queue.popleft()
+            for neighbour_id in self._adjacent.get(node_id, ()):
+                if neighbour_id in rates:
+                    continue
+                rate = self._edge(node_id, neighbour_id)
+                if rate is None:
+                    continue
+                rates[neighbour_id] = rates[node_id] * rate
+                queue.append(neighbour_id)
+        return rates
+
+    def _add_currency(self, currency: CurrencyWithID) -> None:
+        self._currencies[currency.id] = currency
+        self._ids[currency.code] = currency.id
+
+    def _set_rate(self, exchange_rate: ExchangeRateWithCurrencies) -> None:
+        base_id = exchange_rate.base_currency.id
+        target_id = exchange_rate.target_currency.id
+
+        self._add_currency(exchange_rate.base_currency)
+        self._add_currency(exchange_rate.target_currency)
+        self._rates.setdefault(base_id, {})[target_id] = float(exchange_rate.rate)
+        self._adjacent.setdefault(base_id, set()).add(target_id)
+        self._adjacent.setdefault(target_id, set()).add(base_id)
+
+    def _remove_rate(self, base_id: int, target_id: int) -> bool:
+        rate = self._rates.get(base_id, {}).pop(target_id, None)
+        if base_id not in self._rates.get(target_id, {}):
+            self._adjacent.get(base_id, set()).discard(target_id)
+            self._adjacent.get(target_id, set()).discard(base_id)
+        return rate is not None
+
+    def _changed(self, changes: list[RateChange] | None) -> None:
+        self.version += 1
+        self._paths.clear()
+
+        if changes is None or changes:
+            for listener in self._listeners:
+                # The graph has changed already, one failing listener must not keep it from the others
+                try:
+                    listener(changes)
+                except Exception:
+                    logger.exception("Rate graph listener %r failed", listener)
+
+    def _edge(self, base_id: int, target_id: int) -> float | None:
+        rate = self._rates.get(base_id, {}).get(target_id)
+        if rate is not None:
+            return rate
+
+        inverse_rate = self._rates.get(target_id, {}).get(base_id)
+        if inverse_rate:
+            return 1 / inverse_rate
+        return None
+
+    def _find_path(self, base_id: int, target_id: int) -> list[int] | None:
+        pivot_ids = [self._ids.get(pivot_code) for pivot_code in self.pivots]
+        return find_path(base_id, target_id, pivot_ids, self._edge, lambda node_id: self._adjacent.get(node_id, ()))
+
+
+rate_graph = RateGraph(pivots=EXCHANGE_PIVOT_CURRENCIES)
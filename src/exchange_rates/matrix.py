@@ -0,0 +1,70 @@
+import numpy as np
+
+from exceptions import CurrencyNotFound
+
+from .graph import RateGraph, rate_graph
+
+
+class RateMatrix:
+    max_cached_matrices = 256
+
+    def __init__(self, graph: RateGraph):
+        self._graph = graph
+        self._version = None
+        self._matrices: dict[tuple[str, ...], np.ndarray] = {}
+
+    async def get(self, codes: tuple[str, ...]) -> np.ndarray:
+        if self._version != self._graph.version:
+            self._matrices = {}
+            self._version = self._graph.version
+
+        matrix = self._matrices.get(codes)
+        if matrix is None:
+            ids = self._graph.get_currency_ids()
+            try:
+                currency_ids = [ids[code] for code in codes]
+            except KeyError:
+                raise CurrencyNotFound
+
+            matrix = self._cross_rates(currency_ids)
+            if len(self._matrices) >= self.max_cached_matrices:
+                self._matrices.clear()
+            self._matrices[codes] = matrix
+
+        return matrix
+
+    # Cross rates take the same path as /exchange, so both agree on every pair: the stored
+    # pair or its inverse, then the pivots in order, then the breadth-first search.
+    # NaN where there is no path
+    def _cross_rates(self, currency_ids: list[int]) -> np.ndarray:
+        pivot_ids = self._graph.get_pivot_ids()
+        node_ids = list(dict.fromkeys(currency_ids + pivot_ids))
+        positions = {node_id: position for position, node_id in enumerate(node_ids)}
+
+        stored = np.full((len(node_ids), len(node_ids)), np.nan)
+        for base_position, base_id in enumerate(node_ids):
+            for target_id, rate in self._graph.get_stored_rates(base_id).items():
+                target_position = positions.get(target_id)
+                if target_position is not None:
+                    stored[base_position, target_position] = rate
+        inverse = np.divide(1.0, stored.T, out=np.full_like(stored, np.nan), where=stored.T > 0)
+        edges = np.where(np.isnan(stored), inverse, stored)
+
+        indexes = np.array([positions[currency_id] for currency_id in currency_ids], dtype=np.intp)
+        matrix = edges[np.ix_(indexes, indexes)]
+        for pivot_id in pivot_ids:
+            pivot = positions[pivot_id]
+            through_pivot = edges[indexes, pivot][:, None] * edges[pivot, indexes][None, :]
+            missing = np.isnan(matrix) & (indexes != pivot)[:, None] & (indexes != pivot)[None, :]
+            matrix[missing] = through_pivot[missing]
+
+        same = indexes[:, None] == indexes[None, :]
+        matrix[same] = 1.0
+        for row in np.flatnonzero(np.isnan(matrix).any(axis=1)).tolist():
+            search_rates = self._graph.get_search_rates(currency_ids[row])
+            for column in np.flatnonzero(np.isnan(matrix[row])).tolist():
+                matrix[row, column] = search_rates.get(currency_ids[column], np.nan)
+        return matrix
+
+
+rate_matrix = RateMatrix(rate_graph)
@@ -0,0 +1,231 @@
+import datetime
+import itertools
+from typing import AsyncIterator
+
+from cache import rate_cache
+from exceptions import CurrencyNotFound, EntityExistsError, ExchangeRateNotFound
+from memory_store import StoredExchangeRate, memory_store
+
+from .candles import build_candles
+from .schemas import ExchangeRate, ExchangeRateCandle, ExchangeRateWithCurrencies
+
+
+# Same contract as ExchangeRateRepository, sessions are accepted and ignored
+class InMemoryExchangeRateRepository:
+    @classmethod
+    def _pair(cls, base_currency_code, target_currency_code) -> tuple[int, int] | None:
+        base_currency_id = memory_store.currency_ids.get(base_currency_code)
+        target_currency_id = memory_store.currency_ids.get(target_currency_code)
+        if base_currency_id is None or target_currency_id is None:
+            return None
+        return base_currency_id, target_currency_id
+
+    @classmethod
+    def _to_response(cls, pair: tuple[int, int], rate: float) -> ExchangeRateWithCurrencies:
+        return ExchangeRateWithCurrencies(
+            rate=rate,
+            base_currency=memory_store.currencies[pair[0]],
+            target_currency=memory_store.currencies[pair[1]]
+        )
+
+    @classmethod
+    async def get_all(cls, session) -> list[ExchangeRateWithCurrencies]:
+        return [
+            cls._to_response(pair, exchange_rate.rate)
+            for pair, exchange_rate in memory_store.exchange_rates.items()
+        ]
+
+    @classmethod
+    async def stream_all(cls,
+                         session,
+                         chunk_size: int) -> AsyncIterator[list[ExchangeRateWithCurrencies]]:
+        exchange_rates = await cls.get_all(session)
+        for start in range(0, len(exchange_rates), chunk_size):
+            yield exchange_rates[start:start + chunk_size]
+
+    @classmethod
+    async def get_page(cls,
+                       session,
+                       base_currency_code: str | None = None,
+                       target_currency_code: str | None = None,
+                       after: int | None = None,
+                       limit: int = 100) -> tuple[list[dict], int | None]:
+        base_currency_id = memory_store.currency_ids.get(base_currency_code)
+        target_currency_id = memory_store.currency_ids.get(target_currency_code)
+
+        # Pairs are kept in id order
+        rows = (
+            (pair, exchange_rate) for pair, exchange_rate in memory_store.exchange_rates.items()
+            if (after is None or exchange_rate.id > after)
+            and (base_currency_code is None or pair[0] == base_currency_id)
+            and (target_currency_code is None or pair[1] == target_currency_id)
+        )
+        rows = list(itertools.islice(rows, limit + 1))
+
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][1].id
+
+        exchange_rates = [
+            cls._to_response(pair, exchange_rate.rate).model_dump() for pair, exchange_rate in rows
+        ]
+        return exchange_rates, next_after
+
+    @classmethod
+    async def add(cls, session, exchange_rate: ExchangeRate) -> ExchangeRateWithCurrencies:
+        pair = cls._pair(exchange_rate.baseCurrencyCode, exchange_rate.targetCurrencyCode)
+        if pair is None:
+            raise CurrencyNotFound("Одна (или обе) валюта из валютной пары не существует в БД")
+        if pair in memory_store.exchange_rates:
+            raise EntityExistsError("Валютная пара с таким кодом уже существует")
+
+        memory_store.exchange_rates[pair] = StoredExchangeRate(
+            next(memory_store.exchange_rate_id_sequence),
+            exchange_rate.rate
+        )
+        memory_store.add_history(pair, exchange_rate.rate)
+
+        exchange_rate_response = cls._to_response(pair, exchange_rate.rate)
+        version = await rate_cache.publish(session, exchange_rates=[exchange_rate_response])
+        rate_cache.set_rates([exchange_rate_response], version)
+        return exchange_rate_response
+
+    @classmethod
+    async def add_missing(cls, session, exchange_rates: list[ExchangeRate]) -> list[ExchangeRateWithCurrencies]:
+        added = []
+        for exchange_rate in exchange_rates:
+            pair = cls._pair(exchange_rate.baseCurrencyCode, exchange_rate.targetCurrencyCode)
+            if pair is None or pair in memory_store.exchange_rates:
+                continue
+            memory_store.exchange_rates[pair] = StoredExchangeRate(
+                next(memory_store.exchange_rate_id_sequence), exchange_rate.rate
+            )
+            memory_store.add_history(pair, exchange_rate.rate)
+            added.append(cls._to_response(pair, exchange_rate.rate))
+
+        if added:
+            version = await rate_cache.publish(session, exchange_rates=added)
+            rate_cache.set_rates(added, version)
+        return added
+
+    @classmethod
+    async def exists_by_pair(cls, session, base_currency_code, target_currency_code) -> bool:
+        return cls._pair(base_currency_code, target_currency_code) in memory_store.exchange_rates
+
+    @classmethod
+    async def get_by_pair(cls,
+                          session,
+                          base_currency_code,
+                          target_currency_code) -> ExchangeRateWithCurrencies:
+        pair = cls._pair(base_currency_code, target_currency_code)
+        exchange_rate = memory_store.exchange_rates.get(pair)
+        if exchange_rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+        return cls._to_response(pair, exchange_rate.rate)
+
+    @classmethod
+    async def load_by_pair(cls, base_currency_code, target_currency_code) -> ExchangeRateWithCurrencies:
+        return await cls.get_by_pair(None, base_currency_code, target_currency_code)
+
+    @classmethod
+    async def get_by_pair_at(cls,
+                             session,
+                             base_currency_code,
+                             target_currency_code,
+                             at: datetime.datetime) -> ExchangeRateWithCurrencies:
+        pair = cls._pair(base_currency_code, target_currency_code)
+        entries = [entry for entry in memory_store.history.get(pair, []) if entry.valid_from <= at]
+        if not entries or entries[-1].rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+        return cls._to_response(pair, entries[-1].rate)
+
+    @classmethod
+    async def get_candles(cls,
+                          session,
+                          base_currency_code,
+                          target_currency_code,
+                          start: datetime.datetime,
+                          end: datetime.datetime,
+                          interval: str) -> list[ExchangeRateCandle]:
+        pair = cls._pair(base_currency_code, target_currency_code)
+        entries = [
+            entry for entry in memory_store.history.get(pair, [])
+            if start <= entry.valid_from < end and entry.rate is not None
+        ]
+        return build_candles(entries, interval)
+
+    @classmethod
+    async def patch_by_pair(cls,
+                            session,
+                            base_currency_code,
+                            target_currency_code,
+                            new_rate) -> ExchangeRateWithCurrencies:
+        pair = cls._pair(base_currency_code, target_currency_code)
+        if pair is None:
+            raise CurrencyNotFound
+        exchange_rate = memory_store.exchange_rates.get(pair)
+        if exchange_rate is None:
+            raise ExchangeRateNotFound
+
+        memory_store.exchange_rates[pair] = exchange_rate._replace(rate=float(new_rate))
+        memory_store.add_history(pair, float(new_rate))
+
+        exchange_rate_response = cls._to_response(pair, float(new_rate))
+        version = await rate_cache.publish(session, exchange_rates=[exchange_rate_response])
+        rate_cache.set_rates([exchange_rate_response], version)
+        return exchange_rate_response
+
+    @classmethod
+    async def delete_by_pair(cls,
+                             session,
+                             base_currency_code,
+                             target_currency_code) -> ExchangeRateWithCurrencies:
+        pair = cls._pair(base_currency_code, target_currency_code)
+        exchange_rate = memory_store.exchange_rates.pop(pair, None)
+        if exchange_rate is None:
+            raise ExchangeRateNotFound
+        memory_store.add_history(pair, None)
+
+        exchange_rate_response = cls._to_response(pair, exchange_rate.rate)
+        version = await rate_cache.publish(session, removed_exchange_rates=[pair])
+        rate_cache.remove_rate(exchange_rate_response.base_currency,
+                               exchange_rate_response.target_currency,
+                               version)
+        return exchange_rate_response
+
+    @classmethod
+    async def upsert_many(cls, session, exchange_rates: list[ExchangeRate]) -> list[str]:
+        statuses = ["currency_not_found"] * len(exchange_rates)
+        pairs: dict[tuple[int, int], int] = {}
+        for index, exchange_rate in enumerate(exchange_rates):
+            pair = cls._pair(exchange_rate.baseCurrencyCode, exchange_rate.targetCurrencyCode)
+            if pair is None:
+                continue
+
+            # Same semantics as the SQL upsert, the last row of a pair wins
+            if pair in pairs:
+                statuses[pairs[pair]] = "duplicate"
+            pairs[pair] = index
+
+        if not pairs:
+            return statuses
+
+        upserted = []
+        for pair, index in pairs.items():
+            rate = exchange_rates[index].rate
+            exchange_rate = memory_store.exchange_rates.get(pair)
+            if exchange_rate is None:
+                memory_store.exchange_rates[pair] = StoredExchangeRate(
+                    next(memory_store.exchange_rate_id_sequence), rate
+                )
+                statuses[index] = "created"
+            else:
+                memory_store.exchange_rates[pair] = exchange_rate._replace(rate=rate)
+                statuses[index] = "updated"
+            memory_store.add_history(pair, rate)
+            upserted.append(cls._to_response(pair, rate))
+
+        version = await rate_cache.publish(session, exchange_rates=upserted)
+        rate_cache.set_rates(upserted, version)
+        return statuses
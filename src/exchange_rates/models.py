@@ -1,6 +1,8 @@
+import datetime
 import decimal
+from typing import Optional
 
-from sqlalchemy import ForeignKey, Index
+from sqlalchemy import DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 from database import Base
@@ -14,6 +16,28 @@ class ExchangeRateORM(Base):
     target_currency_id: Mapped[int] = mapped_column(ForeignKey("currency.id"), nullable=False)
     rate: Mapped[decimal.Decimal] = mapped_column(nullable=False)
 
+    __table_args__ = (
+        Index("ix_base_currency_id_target_currency_id",
+              "base_currency_id", "target_currency_id", unique=True),
+    )
 
-Index("ix_base_currency_id_target_currency_id",
-      "exchange_rate.base_currency_id", "exchange_rate.target_currency_id", unique=True)
+
+class ExchangeRateHistoryORM(Base):
+    __tablename__ = "exchange_rate_history"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    base_currency_id: Mapped[int] = mapped_column(ForeignKey("currency.id", ondelete="CASCADE"),
+                                                  nullable=False)
+    target_currency_id: Mapped[int] = mapped_column(ForeignKey("currency.id", ondelete="CASCADE"),
+                                                    nullable=False)
+    # NULL marks the moment the pair was deleted
+    rate: Mapped[Optional[decimal.Decimal]]
+    valid_from: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True),
+                                                          server_default=func.now(),
+                                                          nullable=False)
+
+    __table_args__ = (
+        Index("ix_exchange_rate_history_pair_valid_from",
+              "base_currency_id", "target_currency_id", "valid_from",
+              postgresql_include=["rate"]),
+    )
@@ -1,227 +1,540 @@
+import datetime
 from decimal import Decimal
+from typing import AsyncIterator
 
-from sqlalchemy import select
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy import Integer, Numeric, bindparam, func, literal_column, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import aliased
 
+from cache import rate_cache
 from currencies.models import CurrencyORM
 from currencies.repository import CurrencyRepository
 from currencies.schemas import CurrencyWithID
-from database import async_session_maker
+from database import async_session_maker, use_replica
+from dataloader import DataLoader
 from exceptions import CurrencyNotFound, EntityExistsError, ExchangeRateNotFound
 
-from .models import ExchangeRateORM
-from .schemas import ExchangeRate, ExchangeRateWithCurrencies, ExchangeRateWithID
+from .candles import build_candles
+from .models import ExchangeRateHistoryORM, ExchangeRateORM
+from .schemas import ExchangeRate, ExchangeRateCandle, ExchangeRateWithCurrencies
 
 
 class ExchangeRateRepository:
     @classmethod
-    async def get_all(cls) -> list[ExchangeRateWithCurrencies]:
-        async with async_session_maker() as session:
-            query = select(ExchangeRateORM)
-            result = await session.execute(query)
-            exchange_rates_orm = result.scalars().all()
-            exchange_rates = [
-                ExchangeRateWithID.model_validate(exchange_rate) for exchange_rate in exchange_rates_orm
-            ]
+    def _select_with_currencies(cls):
+        base_currency_alias = aliased(CurrencyORM)
+        target_currency_alias = aliased(CurrencyORM)
 
-            exchange_rates_response: list[ExchangeRateWithCurrencies] = []
+        query = select(ExchangeRateORM, base_currency_alias, target_currency_alias) \
+            .join(base_currency_alias,
+                  ExchangeRateORM.base_currency_id == base_currency_alias.id) \
+            .join(target_currency_alias,
+                  ExchangeRateORM.target_currency_id == target_currency_alias.id)
 
-            for exchange_rate in exchange_rates:
-                query = select(CurrencyORM).filter(
-                    CurrencyORM.id == int(exchange_rate.base_currency_id))
-                result = await session.execute(query)
-                base_currency_orm = result.scalar_one()
-                base_currency = CurrencyWithID.model_validate(base_currency_orm)
+        return query, base_currency_alias, target_currency_alias
 
-                query = select(CurrencyORM).filter(
-                    CurrencyORM.id == int(exchange_rate.target_currency_id))
-                result = await session.execute(query)
-                target_currency_orm = result.scalar_one()
-                target_currency = CurrencyWithID.model_validate(target_currency_orm)
+    @classmethod
+    def _to_response(cls,
+                     exchange_rate_orm,
+                     base_currency_orm,
+                     target_currency_orm) -> ExchangeRateWithCurrencies:
+        return ExchangeRateWithCurrencies(
+            rate=exchange_rate_orm.rate,
+            base_currency=CurrencyWithID.model_validate(base_currency_orm),
+            target_currency=CurrencyWithID.model_validate(target_currency_orm)
+        )
+
+    @classmethod
+    async def _get_row_by_pair(cls,
+                               session: AsyncSession,
+                               base_currency_code,
+                               target_currency_code):
+        query, base_currency_alias, target_currency_alias = cls._select_with_currencies()
+        query = query.filter(base_currency_alias.code == base_currency_code,
+                             target_currency_alias.code == target_currency_code)
 
-                exchange_rate_response = ExchangeRateWithCurrencies(
-                    rate=exchange_rate.rate,
-                    base_currency=base_currency,
-                    target_currency=target_currency
-                )
+        result = await session.execute(query)
+        return result.one_or_none()
 
-                exchange_rates_response.append(exchange_rate_response)
+    @classmethod
+    async def get_all(cls, session: AsyncSession) -> list[ExchangeRateWithCurrencies]:
+        query, _, _ = cls._select_with_currencies()
+        result = await session.execute(query.order_by(ExchangeRateORM.id))
+
+        return [cls._to_response(*row) for row in result.all()]
+
+    @classmethod
+    async def stream_all(cls,
+                         session: AsyncSession,
+                         chunk_size: int) -> AsyncIterator[list[ExchangeRateWithCurrencies]]:
+        query, _, _ = cls._select_with_currencies()
+        query = query.order_by(ExchangeRateORM.id).execution_options(yield_per=chunk_size)
+        result = await session.stream(query)
 
-            return exchange_rates_response
+        async for rows in result.partitions():
+            yield [cls._to_response(*row) for row in rows]
+
+    @classmethod
+    def _currency_to_dict(cls, code, name, sign, currency_id) -> dict:
+        return {"code": code, "name": name, "sign": sign, "id": currency_id}
+
+    @classmethod
+    async def get_page(cls,
+                       session: AsyncSession,
+                       base_currency_code: str | None = None,
+                       target_currency_code: str | None = None,
+                       after: int | None = None,
+                       limit: int = 100) -> tuple[list[dict], int | None]:
+        base_currency_alias = aliased(CurrencyORM)
+        target_currency_alias = aliased(CurrencyORM)
+
+        # Plain columns instead of ORM entities, the rows are turned straight
+        # into dicts of the ExchangeRateWithCurrencies shape
+        query = select(
+            ExchangeRateORM.id,
+            ExchangeRateORM.rate,
+            base_currency_alias.code, base_currency_alias.name,
+            base_currency_alias.sign, base_currency_alias.id,
+            target_currency_alias.code, target_currency_alias.name,
+            target_currency_alias.sign, target_currency_alias.id,
+        ) \
+            .join(base_currency_alias,
+                  ExchangeRateORM.base_currency_id == base_currency_alias.id) \
+            .join(target_currency_alias,
+                  ExchangeRateORM.target_currency_id == target_currency_alias.id)
+
+        if base_currency_code is not None:
+            query = query.filter(base_currency_alias.code == base_currency_code)
+        if target_currency_code is not None:
+            query = query.filter(target_currency_alias.code == target_currency_code)
+        if after is not None:
+            query = query.filter(ExchangeRateORM.id > after)
+
+        # One extra row tells whether there is a next page
+        query = query.order_by(ExchangeRateORM.id).limit(limit + 1)
+        result = await session.execute(query)
+        rows = result.all()
+
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][0]
+
+        exchange_rates = [
+            {
+                "rate": float(row[1]),
+                "base_currency": cls._currency_to_dict(*row[2:6]),
+                "target_currency": cls._currency_to_dict(*row[6:10]),
+            }
+            for row in rows
+        ]
+        return exchange_rates, next_after
 
     @classmethod
     async def add(cls,
+                  session: AsyncSession,
                   exchange_rate: ExchangeRate) -> ExchangeRateWithCurrencies:
-        async with async_session_maker() as session:
-            try:
-                base_currency = await CurrencyRepository.get_by_code(
-                    exchange_rate.baseCurrencyCode
-                )
-                target_currency = await CurrencyRepository.get_by_code(
-                    exchange_rate.targetCurrencyCode
-                )
-            except CurrencyNotFound:
-                raise CurrencyNotFound("Одна (или обе) валюта из валютной пары не существует в БД")
-
-            exists = await ExchangeRateRepository.exists_by_pair(
-                exchange_rate.baseCurrencyCode,
-                exchange_rate.targetCurrencyCode
-            )
-            if exists:
-                raise EntityExistsError("Валютная пара с таким кодом уже существует")
-
-            exchange_rate_orm = ExchangeRateORM(
-                base_currency_id=base_currency.id,
-                target_currency_id=target_currency.id,
-                rate=exchange_rate.rate
+        try:
+            base_currency = await CurrencyRepository.get_by_code(
+                session,
+                exchange_rate.baseCurrencyCode
             )
-            session.add(exchange_rate_orm)
-            await session.flush()
-            await session.commit()
-
-            exchange_rate_response = ExchangeRateWithCurrencies(
-                base_currency=base_currency,
-                target_currency=target_currency,
-                rate=exchange_rate.rate
+            target_currency = await CurrencyRepository.get_by_code(
+                session,
+                exchange_rate.targetCurrencyCode
             )
-
-            return exchange_rate_response
+        except CurrencyNotFound:
+            raise CurrencyNotFound("Одна (или обе) валюта из валютной пары не существует в БД")
+
+        exists = await ExchangeRateRepository.exists_by_pair(
+            session,
+            exchange_rate.baseCurrencyCode,
+            exchange_rate.targetCurrencyCode
+        )
+        if exists:
+            raise EntityExistsError("Валютная пара с таким кодом уже существует")
+
+        exchange_rate_orm = ExchangeRateORM(
+            base_currency_id=base_currency.id,
+            target_currency_id=target_currency.id,
+            rate=exchange_rate.rate
+        )
+        session.add(exchange_rate_orm)
+        session.add(ExchangeRateHistoryORM(
+            base_currency_id=base_currency.id,
+            target_currency_id=target_currency.id,
+            rate=exchange_rate.rate
+        ))
+        await session.flush()
+
+        exchange_rate_response = ExchangeRateWithCurrencies(
+            base_currency=base_currency,
+            target_currency=target_currency,
+            rate=exchange_rate.rate
+        )
+        version = await rate_cache.publish(session, exchange_rates=[exchange_rate_response])
+        await session.commit()
+        rate_cache.set_rates([exchange_rate_response], version)
+
+        return exchange_rate_response
 
     @classmethod
     async def exists_by_pair(cls,
+                             session: AsyncSession,
                              base_currency_code,
                              target_currency_code) -> bool:
-        async with async_session_maker() as session:
-            base_currency_alias = aliased(CurrencyORM)
-            target_curency_alias = aliased(CurrencyORM)
-
-            query = select(ExchangeRateORM) \
-                .join(base_currency_alias,
-                      ExchangeRateORM.base_currency_id == base_currency_alias.id) \
-                .join(target_curency_alias,
-                      ExchangeRateORM.target_currency_id == target_curency_alias.id) \
-                .filter(base_currency_alias.code == base_currency_code,
-                        target_curency_alias.code == target_currency_code)
-
-            result = await session.execute(query)
-            exchange_rate_orm = result.scalar_one_or_none()
-
-            if exchange_rate_orm is None:
-                return False
-            else:
-                return True
+        row = await cls._get_row_by_pair(session, base_currency_code, target_currency_code)
+        return row is not None
 
     @classmethod
     async def get_by_pair(cls,
+                          session: AsyncSession,
                           base_currency_code,
                           target_currency_code) -> ExchangeRateWithCurrencies:
-        async with async_session_maker() as session:
-            base_currency_alias = aliased(CurrencyORM)
-            target_curency_alias = aliased(CurrencyORM)
-
-            query = select(ExchangeRateORM) \
-                .join(base_currency_alias,
-                      ExchangeRateORM.base_currency_id == base_currency_alias.id) \
-                .join(target_curency_alias,
-                      ExchangeRateORM.target_currency_id == target_curency_alias.id) \
-                .filter(base_currency_alias.code == base_currency_code,
-                        target_curency_alias.code == target_currency_code)
+        row = await cls._get_row_by_pair(session, base_currency_code, target_currency_code)
 
-            result = await session.execute(query)
-            exchange_rate_orm = result.scalar_one_or_none()
+        if row is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
 
-            if exchange_rate_orm is None:
-                raise ExchangeRateNotFound("Exchange rate for this pair not found")
+        return cls._to_response(*row)
 
-            exchange_rate_with_id = ExchangeRateWithID.model_validate(exchange_rate_orm)
+    # Batched with the lookups of other requests on a session of its own, so it does not
+    # see the caller's uncommitted writes
+    @classmethod
+    async def load_by_pair(cls, base_currency_code, target_currency_code) -> ExchangeRateWithCurrencies:
+        exchange_rate = await _pair_loader.load((base_currency_code, target_currency_code))
 
-            query = select(CurrencyORM).filter(
-                CurrencyORM.id == int(exchange_rate_with_id.base_currency_id))
-            result = await session.execute(query)
-            base_currency_orm = result.scalar_one()
-            base_currency = CurrencyWithID.model_validate(base_currency_orm)
+        if exchange_rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        return exchange_rate
+
+    @classmethod
+    async def _get_many_by_pairs(
+            cls,
+            pairs: list[tuple[str, str]]
+    ) -> dict[tuple[str, str], ExchangeRateWithCurrencies]:
+        query, base_currency_alias, target_currency_alias = cls._select_with_currencies()
+        query = query.filter(tuple_(base_currency_alias.code, target_currency_alias.code).in_(pairs))
 
-            query = select(CurrencyORM).filter(
-                CurrencyORM.id == int(exchange_rate_with_id.target_currency_id))
+        async with async_session_maker() as session:
+            use_replica(session)
             result = await session.execute(query)
-            target_currency_orm = result.scalar_one()
-            target_currency = CurrencyWithID.model_validate(target_currency_orm)
+            return {
+                (base_currency_orm.code, target_currency_orm.code):
+                    cls._to_response(exchange_rate_orm, base_currency_orm, target_currency_orm)
+                for exchange_rate_orm, base_currency_orm, target_currency_orm in result
+            }
 
-            exchange_rate_response = ExchangeRateWithCurrencies(
-                rate=exchange_rate_with_id.rate,
-                base_currency=base_currency,
-                target_currency=target_currency
-            )
+    @classmethod
+    async def get_by_pair_at(cls,
+                             session: AsyncSession,
+                             base_currency_code,
+                             target_currency_code,
+                             at: datetime.datetime) -> ExchangeRateWithCurrencies:
+        base_currency_alias = aliased(CurrencyORM)
+        target_currency_alias = aliased(CurrencyORM)
+
+        # Served by the (base, target, valid_from) index, which also carries the rate
+        query = select(ExchangeRateHistoryORM.rate, base_currency_alias, target_currency_alias) \
+            .join(base_currency_alias,
+                  ExchangeRateHistoryORM.base_currency_id == base_currency_alias.id) \
+            .join(target_currency_alias,
+                  ExchangeRateHistoryORM.target_currency_id == target_currency_alias.id) \
+            .filter(base_currency_alias.code == base_currency_code,
+                    target_currency_alias.code == target_currency_code,
+                    ExchangeRateHistoryORM.valid_from <= at) \
+            .order_by(ExchangeRateHistoryORM.valid_from.desc()) \
+            .limit(1)
+
+        result = await session.execute(query)
+        row = result.one_or_none()
+
+        if row is None or row.rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        rate, base_currency_orm, target_currency_orm = row
+        return ExchangeRateWithCurrencies(
+            rate=rate,
+            base_currency=CurrencyWithID.model_validate(base_currency_orm),
+            target_currency=CurrencyWithID.model_validate(target_currency_orm)
+        )
 
-            return exchange_rate_response
+    @classmethod
+    async def get_candles(cls,
+                          session: AsyncSession,
+                          base_currency_code,
+                          target_currency_code,
+                          start: datetime.datetime,
+                          end: datetime.datetime,
+                          interval: str) -> list[ExchangeRateCandle]:
+        history = ExchangeRateHistoryORM
+        base_currency_alias = aliased(CurrencyORM)
+        target_currency_alias = aliased(CurrencyORM)
+
+        if session.bind.dialect.name != "postgresql":
+            query = select(history.valid_from, history.rate) \
+                .join(base_currency_alias, history.base_currency_id == base_currency_alias.id) \
+                .join(target_currency_alias, history.target_currency_id == target_currency_alias.id) \
+                .filter(base_currency_alias.code == base_currency_code,
+                        target_currency_alias.code == target_currency_code,
+                        history.valid_from >= start,
+                        history.valid_from < end,
+                        history.rate.is_not(None)) \
+                .order_by(history.valid_from)
+            result = await session.execute(query)
+            return build_candles(result.all(), interval)
+
+        bucket = func.date_trunc(interval, history.valid_from)
+
+        query = select(
+            bucket.label("time"),
+            func.array_agg(aggregate_order_by(history.rate, history.valid_from.asc()))[1].label("open"),
+            func.max(history.rate).label("high"),
+            func.min(history.rate).label("low"),
+            func.array_agg(aggregate_order_by(history.rate, history.valid_from.desc()))[1].label("close"),
+            func.count().label("count")
+        ) \
+            .join(base_currency_alias, history.base_currency_id == base_currency_alias.id) \
+            .join(target_currency_alias, history.target_currency_id == target_currency_alias.id) \
+            .filter(base_currency_alias.code == base_currency_code,
+                    target_currency_alias.code == target_currency_code,
+                    history.valid_from >= start,
+                    history.valid_from < end,
+                    history.rate.is_not(None)) \
+            .group_by(bucket) \
+            .order_by(bucket)
+
+        result = await session.execute(query)
+        return [ExchangeRateCandle.model_validate(row, from_attributes=True) for row in result.all()]
 
     @classmethod
     async def patch_by_pair(cls,
+                            session: AsyncSession,
                             base_currency_code,
                             target_currency_code,
                             new_rate) -> ExchangeRateWithCurrencies:
-        async with async_session_maker() as session:
-            base_currency_exists = await CurrencyRepository.exists_by_code(base_currency_code)
-            target_currency_exists = await CurrencyRepository.exists_by_code(target_currency_code)
+        row = await cls._get_row_by_pair(session, base_currency_code, target_currency_code)
+
+        if row is None:
+            base_currency_exists = await CurrencyRepository.exists_by_code(session, base_currency_code)
+            target_currency_exists = await CurrencyRepository.exists_by_code(session, target_currency_code)
             if not base_currency_exists or not target_currency_exists:
                 raise CurrencyNotFound
+            raise ExchangeRateNotFound
 
-            try:
-                exchange_rate_with_currencies = await ExchangeRateRepository.get_by_pair(
-                    base_currency_code,
-                    target_currency_code
-                )
-            except ExchangeRateNotFound:
-                raise ExchangeRateNotFound
-
-            query = select(ExchangeRateORM).filter(
-                ExchangeRateORM.base_currency_id == exchange_rate_with_currencies.base_currency.id,
-                ExchangeRateORM.target_currency_id == exchange_rate_with_currencies.target_currency.id
-            )
-            result = await session.execute(query)
-            exchange_rate_orm = result.scalar_one()
-
-            exchange_rate_orm.rate = Decimal(new_rate)
-            # await session.flush()
-            await session.commit()
+        exchange_rate_orm = row[0]
+        exchange_rate_orm.rate = Decimal(str(new_rate))
+        session.add(ExchangeRateHistoryORM(
+            base_currency_id=exchange_rate_orm.base_currency_id,
+            target_currency_id=exchange_rate_orm.target_currency_id,
+            rate=exchange_rate_orm.rate
+        ))
+        await session.flush()
 
-            exchange_rate_with_currencies = await ExchangeRateRepository.get_by_pair(
-                base_currency_code,
-                target_currency_code
-            )
+        exchange_rate_with_currencies = cls._to_response(*row)
+        version = await rate_cache.publish(session, exchange_rates=[exchange_rate_with_currencies])
+        await session.commit()
+        rate_cache.set_rates([exchange_rate_with_currencies], version)
 
-            return exchange_rate_with_currencies
+        return exchange_rate_with_currencies
 
     @classmethod
     async def delete_by_pair(cls,
+                             session: AsyncSession,
                              base_currency_code,
                              target_currency_code) -> ExchangeRateWithCurrencies:
-        async with async_session_maker() as session:
-            try:
-                exchange_rate = await ExchangeRateRepository.get_by_pair(
-                    base_currency_code,
-                    target_currency_code
-                )
-            except ExchangeRateNotFound:
-                raise ExchangeRateNotFound
-
-            base_currency_alias = aliased(CurrencyORM)
-            target_curency_alias = aliased(CurrencyORM)
-
-            query = select(ExchangeRateORM) \
-                .join(base_currency_alias,
-                      ExchangeRateORM.base_currency_id == base_currency_alias.id) \
-                .join(target_curency_alias,
-                      ExchangeRateORM.target_currency_id == target_curency_alias.id) \
-                .filter(base_currency_alias.code == base_currency_code,
-                        target_curency_alias.code == target_currency_code)
+        row = await cls._get_row_by_pair(session, base_currency_code, target_currency_code)
 
-            result = await session.execute(query)
+        if row is None:
+            raise ExchangeRateNotFound
+
+        exchange_rate = cls._to_response(*row)
+
+        await session.delete(row[0])
+        session.add(ExchangeRateHistoryORM(
+            base_currency_id=row[0].base_currency_id,
+            target_currency_id=row[0].target_currency_id,
+            rate=None
+        ))
+        await session.flush()
+
+        version = await rate_cache.publish(session, removed_exchange_rates=[
+            (row[0].base_currency_id, row[0].target_currency_id)
+        ])
+        await session.commit()
+        rate_cache.remove_rate(exchange_rate.base_currency, exchange_rate.target_currency, version)
+
+        return exchange_rate
+
+    @classmethod
+    async def upsert_many(cls,
+                          session: AsyncSession,
+                          exchange_rates: list[ExchangeRate]) -> list[str]:
+        if not exchange_rates:
+            return []
+
+        codes = {exchange_rate.baseCurrencyCode for exchange_rate in exchange_rates} \
+            | {exchange_rate.targetCurrencyCode for exchange_rate in exchange_rates}
+        result = await session.execute(select(CurrencyORM).filter(CurrencyORM.code.in_(codes)))
+        currencies = {currency_orm.code: currency_orm for currency_orm in result.scalars()}
+
+        statuses = ["currency_not_found"] * len(exchange_rates)
+        pairs: dict[tuple[int, int], int] = {}
+        for index, exchange_rate in enumerate(exchange_rates):
+            base_currency = currencies.get(exchange_rate.baseCurrencyCode)
+            target_currency = currencies.get(exchange_rate.targetCurrencyCode)
+            if base_currency is None or target_currency is None:
+                continue
+
+            # A pair can only be upserted once per statement, the last row wins
+            pair = (base_currency.id, target_currency.id)
+            if pair in pairs:
+                statuses[pairs[pair]] = "duplicate"
+            pairs[pair] = index
+
+        if not pairs:
+            return statuses
+
+        if session.bind.dialect.name == "postgresql":
+            await cls._upsert_pairs_postgresql(session, exchange_rates, pairs, statuses)
+        else:
+            await cls._upsert_pairs(session, exchange_rates, pairs, statuses)
+
+        currencies_by_id = {currency_orm.id: currency_orm for currency_orm in currencies.values()}
+        upserted = [
+            ExchangeRateWithCurrencies(
+                rate=exchange_rates[index].rate,
+                base_currency=CurrencyWithID.model_validate(currencies_by_id[base_currency_id]),
+                target_currency=CurrencyWithID.model_validate(currencies_by_id[target_currency_id])
+            )
+            for (base_currency_id, target_currency_id), index in pairs.items()
+        ]
+        version = await rate_cache.publish(session, exchange_rates=upserted)
+        await session.commit()
+        rate_cache.set_rates(upserted, version)
+
+        return statuses
 
-            exchange_rate_orm = result.scalar_one_or_none()
+    @classmethod
+    async def add_missing(cls,
+                          session: AsyncSession,
+                          exchange_rates: list[ExchangeRate]) -> list[ExchangeRateWithCurrencies]:
+        if not exchange_rates:
+            return []
+
+        codes = {exchange_rate.baseCurrencyCode for exchange_rate in exchange_rates} \
+            | {exchange_rate.targetCurrencyCode for exchange_rate in exchange_rates}
+        result = await session.execute(select(CurrencyORM).filter(CurrencyORM.code.in_(codes)))
+        currencies = {currency_orm.code: currency_orm for currency_orm in result.scalars()}
+
+        rows = [
+            {"base_currency_id": currencies[exchange_rate.baseCurrencyCode].id,
+             "target_currency_id": currencies[exchange_rate.targetCurrencyCode].id,
+             "rate": Decimal(str(exchange_rate.rate))}
+            for exchange_rate in exchange_rates
+            if exchange_rate.baseCurrencyCode in currencies and exchange_rate.targetCurrencyCode in currencies
+        ]
+        if not rows:
+            return []
+
+        # Existing pairs keep their rate, only the missing ones are inserted
+        insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+        query = insert(ExchangeRateORM).values(rows).on_conflict_do_nothing(
+            index_elements=[ExchangeRateORM.base_currency_id, ExchangeRateORM.target_currency_id]
+        ).returning(ExchangeRateORM.base_currency_id, ExchangeRateORM.target_currency_id, ExchangeRateORM.rate)
+        result = await session.execute(query)
+        inserted = [row._asdict() for row in result.all()]
+        if not inserted:
+            return []
+
+        await session.execute(insert(ExchangeRateHistoryORM).values(inserted))
+
+        currencies_by_id = {currency_orm.id: currency_orm for currency_orm in currencies.values()}
+        added = [
+            ExchangeRateWithCurrencies(
+                rate=row["rate"],
+                base_currency=CurrencyWithID.model_validate(currencies_by_id[row["base_currency_id"]]),
+                target_currency=CurrencyWithID.model_validate(currencies_by_id[row["target_currency_id"]])
+            )
+            for row in inserted
+        ]
+        version = await rate_cache.publish(session, exchange_rates=added)
+        await session.commit()
+        rate_cache.set_rates(added, version)
+        return added
+
+    @classmethod
+    async def _upsert_pairs_postgresql(cls,
+                                       session: AsyncSession,
+                                       exchange_rates: list[ExchangeRate],
+                                       pairs: dict[tuple[int, int], int],
+                                       statuses: list[str]) -> None:
+        rows = func.unnest(
+            bindparam("base_currency_ids", [pair[0] for pair in pairs],
+                      type_=postgresql.ARRAY(Integer)),
+            bindparam("target_currency_ids", [pair[1] for pair in pairs],
+                      type_=postgresql.ARRAY(Integer)),
+            bindparam("rates", [Decimal(str(exchange_rates[index].rate)) for index in pairs.values()],
+                      type_=postgresql.ARRAY(Numeric)),
+        ).table_valued("base_currency_id", "target_currency_id", "rate")
+
+        query = postgresql.insert(ExchangeRateORM).from_select(
+            ["base_currency_id", "target_currency_id", "rate"],
+            select(rows.c.base_currency_id, rows.c.target_currency_id, rows.c.rate)
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[ExchangeRateORM.base_currency_id, ExchangeRateORM.target_currency_id],
+            set_={"rate": query.excluded.rate}
+        ).returning(
+            ExchangeRateORM.base_currency_id,
+            ExchangeRateORM.target_currency_id,
+            # xmax is only zero for rows that did not exist before the statement
+            literal_column("xmax = 0").label("inserted")
+        )
+
+        result = await session.execute(query)
+        for base_currency_id, target_currency_id, inserted in result.all():
+            statuses[pairs[(base_currency_id, target_currency_id)]] = "created" if inserted else "updated"
+
+        await session.execute(postgresql.insert(ExchangeRateHistoryORM).from_select(
+            ["base_currency_id", "target_currency_id", "rate"],
+            select(rows.c.base_currency_id, rows.c.target_currency_id, rows.c.rate)
+        ))
+
+    @classmethod
+    async def _upsert_pairs(cls,
+                            session: AsyncSession,
+                            exchange_rates: list[ExchangeRate],
+                            pairs: dict[tuple[int, int], int],
+                            statuses: list[str]) -> None:
+        # Portable version for SQLite: one query for the existing pairs, then
+        # plain inserts and updates through the unit of work
+        result = await session.execute(select(ExchangeRateORM).filter(
+            tuple_(ExchangeRateORM.base_currency_id, ExchangeRateORM.target_currency_id).in_(list(pairs))
+        ))
+        existing = {
+            (exchange_rate_orm.base_currency_id, exchange_rate_orm.target_currency_id): exchange_rate_orm
+            for exchange_rate_orm in result.scalars()
+        }
+
+        for (base_currency_id, target_currency_id), index in pairs.items():
+            rate = Decimal(str(exchange_rates[index].rate))
+            exchange_rate_orm = existing.get((base_currency_id, target_currency_id))
+            if exchange_rate_orm is None:
+                session.add(ExchangeRateORM(base_currency_id=base_currency_id,
+                                            target_currency_id=target_currency_id,
+                                            rate=rate))
+                statuses[index] = "created"
+            else:
+                exchange_rate_orm.rate = rate
+                statuses[index] = "updated"
+            session.add(ExchangeRateHistoryORM(base_currency_id=base_currency_id,
+                                               target_currency_id=target_currency_id,
+                                               rate=rate))
+        await session.flush()
 
-            await session.delete(exchange_rate_orm)
-            await session.commit()
 
-            return exchange_rate
+_pair_loader = DataLoader(ExchangeRateRepository._get_many_by_pairs)
@@ -1,12 +1,32 @@
-from typing import Annotated
+import asyncio
+import json
+from typing import Annotated, AsyncIterator, Literal
 
-from fastapi import APIRouter, Body, Path
-from fastapi.responses import JSONResponse
+import numpy as np
 
+from fastapi import APIRouter, Body, Depends, Path, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import rate_cache
+from conditional import not_modified
+from config import (EXCHANGE_RATE_MATRIX_MAX_CODES, EXCHANGE_RATES_MAX_PAGE_SIZE, EXCHANGE_RATES_PAGE_SIZE,
+                    STREAM_KEEPALIVE_INTERVAL)
+from database import get_async_session, use_primary
 from exceptions import CurrencyNotFound, EntityExistsError, ExchangeRateNotFound
+from export import ExportFormat, export_response
+from metrics import record_error
+from responses import json_response
+from singleflight import pair_lookups
+from storage import ExchangeRateRepository
 
-from .repository import ExchangeRateRepository
-from .schemas import ExchangeRate, ExchangeRateWithCurrencies
+from .anomalies import anomaly_detector
+from .broadcaster import RateEvent, Subscription, rate_broadcaster
+from .matrix import rate_matrix
+from .schemas import (ExchangeRate, ExchangeRateAnomaly, ExchangeRateBulkResult, ExchangeRateCandle,
+                      ExchangeRateMatrix, ExchangeRateWithCurrencies, UTCDatetime)
+from .snapshot import rate_snapshot
 
 router = APIRouter(
     prefix="/exchangeRates",
@@ -15,21 +35,42 @@ router = APIRouter(
 
 
 @router.get("", response_model=list[ExchangeRateWithCurrencies])
-async def get_exchange_rates():
-    exchange_rates_dict = await ExchangeRateRepository.get_all()
-    return exchange_rates_dict
+async def get_exchange_rates(
+        session: Annotated[AsyncSession, Depends(get_async_session)],
+        request: Request,
+        response: Response,
+        base: Annotated[str | None, Query()] = None,
+        target: Annotated[str | None, Query()] = None,
+        after: Annotated[int | None, Query()] = None,
+        limit: Annotated[int, Query(ge=1, le=EXCHANGE_RATES_MAX_PAGE_SIZE)] = EXCHANGE_RATES_PAGE_SIZE
+):
+    not_modified_response = not_modified(request, response, "currency", "exchange_rate")
+    if not_modified_response is not None:
+        return not_modified_response
+    if "ETag" in response.headers:
+        use_primary(session)
+
+    exchange_rates, next_after = await ExchangeRateRepository.get_page(session, base, target, after, limit)
+
+    if next_after is not None:
+        next_url = request.url.include_query_params(after=next_after)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return json_response(exchange_rates, response)
 
 
 @router.post("", response_model=ExchangeRateWithCurrencies)
-async def post_exchange_rate(exchange_rate: Annotated[ExchangeRate, Body()]):
+async def post_exchange_rate(session: Annotated[AsyncSession, Depends(get_async_session)],
+                             exchange_rate: Annotated[ExchangeRate, Body()]):
     try:
-        exchange_rate_response = await ExchangeRateRepository.add(exchange_rate)
-    except EntityExistsError:
+        exchange_rate_response = await ExchangeRateRepository.add(session, exchange_rate)
+    except EntityExistsError as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=409,
             content={"message": "Валютная пара с таким кодом уже существует"}
         )
-    except CurrencyNotFound:
+    except CurrencyNotFound as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=404,
             content={"message": "Одна (или обе) валюта из валютной пары не существует в БД"}
@@ -37,38 +78,246 @@ async def post_exchange_rate(exchange_rate: Annotated[ExchangeRate, Body()]):
     return exchange_rate_response
 
 
+@router.get("/export")
+async def export_exchange_rates(format: Annotated[ExportFormat, Query()] = "ndjson"):
+    return export_response(
+        ExchangeRateRepository.stream_all,
+        format,
+        filename="exchange_rates",
+        csv_header=["base_currency_code", "target_currency_code", "rate"],
+        to_csv_row=lambda exchange_rate: [exchange_rate.base_currency.code,
+                                          exchange_rate.target_currency.code,
+                                          exchange_rate.rate]
+    )
+
+
+@router.get("/matrix", response_model=ExchangeRateMatrix)
+async def get_exchange_rate_matrix(codes: Annotated[str, Query()],
+                                   format: Annotated[Literal["json", "binary"], Query()] = "json"):
+    currency_codes = tuple(dict.fromkeys(code.strip() for code in codes.split(",") if code.strip()))
+    if len(currency_codes) > EXCHANGE_RATE_MATRIX_MAX_CODES:
+        return JSONResponse(
+            status_code=422,
+            content={"message": f"Не больше {EXCHANGE_RATE_MATRIX_MAX_CODES} валют в матрице"}
+        )
+
+    try:
+        matrix = await rate_matrix.get(currency_codes)
+    except CurrencyNotFound as exc:
+        record_error(exc)
+        return JSONResponse(status_code=404, content={"message": "Валюта не найдена"})
+
+    if format == "binary":
+        # Row-major float64, NaN where no conversion path exists
+        return Response(content=matrix.tobytes(),
+                        media_type="application/octet-stream",
+                        headers={"X-Currency-Codes": ",".join(currency_codes)})
+
+    return {
+        "codes": currency_codes,
+        "rates": np.where(np.isnan(matrix), None, matrix).tolist()
+    }
+
+
+@router.get("/anomalies", response_model=list[ExchangeRateAnomaly])
+async def get_exchange_rate_anomalies():
+    return anomaly_detector.get_all()
+
+
+def _encode_rate_event(event: RateEvent) -> str:
+    return json.dumps({
+        "version": event.version,
+        "resync": event.resync,
+        "rates": [delta._asdict() for delta in event.deltas]
+    }, separators=(",", ":"))
+
+
+async def _stream_sse() -> AsyncIterator[str]:
+    subscription = rate_broadcaster.subscribe()
+    try:
+        while True:
+            event = await subscription.get(timeout=STREAM_KEEPALIVE_INTERVAL)
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {event.version}\nevent: rates\ndata: {_encode_rate_event(event)}\n\n"
+    finally:
+        rate_broadcaster.unsubscribe(subscription)
+
+
+@router.get("/stream")
+async def stream_exchange_rates():
+    return StreamingResponse(
+        _stream_sse(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def _send_rate_events(websocket: WebSocket, subscription: Subscription) -> None:
+    while True:
+        event = await subscription.get()
+        await websocket.send_text(_encode_rate_event(event))
+
+
+@router.websocket("/stream")
+async def stream_exchange_rates_websocket(websocket: WebSocket):
+    await websocket.accept()
+    subscription = rate_broadcaster.subscribe()
+    sender = asyncio.create_task(_send_rate_events(websocket, subscription))
+    try:
+        # Incoming messages are ignored, receiving only detects the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        rate_broadcaster.unsubscribe(subscription)
+
+
+async def _read_ndjson(request: Request) -> AsyncIterator:
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_json_line(line)
+    if buffer.strip():
+        yield _parse_json_line(buffer)
+
+
+def _parse_json_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+@router.put("/bulk", response_model=list[ExchangeRateBulkResult])
+async def put_exchange_rates_bulk(session: Annotated[AsyncSession, Depends(get_async_session)],
+                                  request: Request):
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = [item async for item in _read_ndjson(request)]
+    else:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            return JSONResponse(
+                status_code=400,
+                content={"message": "Expected a JSON array or an NDJSON body"}
+            )
+
+    results = []
+    exchange_rates = []
+    for item in items:
+        try:
+            exchange_rate = ExchangeRate.model_validate(item)
+        except ValidationError:
+            results.append({
+                "baseCurrencyCode": item.get("baseCurrencyCode") if isinstance(item, dict) else None,
+                "targetCurrencyCode": item.get("targetCurrencyCode") if isinstance(item, dict) else None,
+                "status": "invalid"
+            })
+            continue
+
+        results.append({
+            "baseCurrencyCode": exchange_rate.baseCurrencyCode,
+            "targetCurrencyCode": exchange_rate.targetCurrencyCode,
+            "status": None
+        })
+        exchange_rates.append(exchange_rate)
+
+    statuses = iter(await ExchangeRateRepository.upsert_many(session, exchange_rates))
+    for result in results:
+        if result["status"] is None:
+            result["status"] = next(statuses)
+
+    return results
+
+
 @router.get("/{exchange_pair}", response_model=ExchangeRateWithCurrencies)
-async def get_exchange_rate(exchange_pair: Annotated[str, Path()]):
+async def get_exchange_rate(session: Annotated[AsyncSession, Depends(get_async_session)],
+                            request: Request,
+                            response: Response,
+                            exchange_pair: Annotated[str, Path()],
+                            at: Annotated[UTCDatetime | None, Query()] = None):
+    if at is None:
+        not_modified_response = not_modified(request, response, "currency", "exchange_rate")
+        if not_modified_response is not None:
+            return not_modified_response
+
     base_currency_code = exchange_pair[:3]
     target_currency_code = exchange_pair[3:]
 
     try:
-        exchange_rate = await ExchangeRateRepository.get_by_pair(base_currency_code,
-                                                                 target_currency_code)
-    except ExchangeRateNotFound:
+        if at is None and rate_cache.ready:
+            exchange_rate = rate_snapshot.get_rate(base_currency_code, target_currency_code)
+        elif at is None:
+            exchange_rate = await pair_lookups.do(
+                ("pair", base_currency_code, target_currency_code),
+                lambda: ExchangeRateRepository.load_by_pair(base_currency_code, target_currency_code)
+            )
+        else:
+            exchange_rate = await pair_lookups.do(
+                ("pair_at", base_currency_code, target_currency_code, at),
+                lambda: ExchangeRateRepository.get_by_pair_at(session,
+                                                              base_currency_code,
+                                                              target_currency_code,
+                                                              at)
+            )
+    except ExchangeRateNotFound as exc:
+        record_error(exc)
         return JSONResponse(status_code=404,
                             content={"message": "Exchange rate for this pair not found"})
-    return exchange_rate
+    return json_response(exchange_rate, response)
+
+
+@router.get("/{exchange_pair}/history", response_model=list[ExchangeRateCandle])
+async def get_exchange_rate_history(
+        session: Annotated[AsyncSession, Depends(get_async_session)],
+        exchange_pair: Annotated[str, Path()],
+        start: Annotated[UTCDatetime, Query()],
+        end: Annotated[UTCDatetime, Query()],
+        interval: Annotated[Literal["minute", "hour", "day", "week", "month"], Query()] = "day"
+):
+    base_currency_code = exchange_pair[:3]
+    target_currency_code = exchange_pair[3:]
+
+    candles = await ExchangeRateRepository.get_candles(session,
+                                                      base_currency_code,
+                                                      target_currency_code,
+                                                      start,
+                                                      end,
+                                                      interval)
+    return candles
 
 
 @router.patch("/{exchange_pair}", response_model=ExchangeRateWithCurrencies)
-async def patch_exchange_rate(exchange_pair: Annotated[str, Path()],
-                              new_rate: Annotated[float, Body()]):
+async def patch_exchange_rate(session: Annotated[AsyncSession, Depends(get_async_session)],
+                              exchange_pair: Annotated[str, Path()],
+                              new_rate: Annotated[float, Body(gt=0)]):
     base_currency_code = exchange_pair[:3]
     target_currency_code = exchange_pair[3:]
 
     try:
         exchange_rate = await ExchangeRateRepository.patch_by_pair(
+            session,
             base_currency_code,
             target_currency_code,
             new_rate
         )
-    except CurrencyNotFound:
+    except CurrencyNotFound as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=404,
             content={"message": "Одна (или обе) валюта из валютной пары не существует в БД"}
         )
-    except ExchangeRateNotFound:
+    except ExchangeRateNotFound as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=404,
             content={"message": "Обменный курс для пары не найден"}
@@ -77,16 +326,19 @@ async def patch_exchange_rate(exchange_pair: Annotated[str, Path()],
 
 
 @router.delete("/{exchange_pair}", response_model=ExchangeRateWithCurrencies)
-async def delete_currency(exchange_pair: Annotated[str, Path()]):
+async def delete_currency(session: Annotated[AsyncSession, Depends(get_async_session)],
+                          exchange_pair: Annotated[str, Path()]):
     base_currency_code = exchange_pair[:3]
     target_currency_code = exchange_pair[3:]
 
     try:
         exchange_rate = await ExchangeRateRepository.delete_by_pair(
+            session,
             base_currency_code,
             target_currency_code
         )
-    except ExchangeRateNotFound:
+    except ExchangeRateNotFound as exc:
+        record_error(exc)
         return JSONResponse(
             status_code=404,
             content={"message": "Обменный курс для пары не найден"}
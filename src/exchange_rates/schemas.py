@@ -1,13 +1,28 @@
-from pydantic import BaseModel, ConfigDict
+import datetime
+from typing import Annotated
+
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field
 
 from currencies.schemas import CurrencyWithID
 
 
+def _assume_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+# Naive query datetimes are taken as UTC, as the databases do, so every backend compares
+# them with the stored timezone-aware times
+UTCDatetime = Annotated[datetime.datetime, AfterValidator(_assume_utc)]
+
+
 class _ExchangeRate(BaseModel):
     rate: float
 
 
 class ExchangeRate(_ExchangeRate):
+    rate: float = Field(gt=0)
     baseCurrencyCode: str
     targetCurrencyCode: str
 
@@ -22,3 +37,28 @@ class ExchangeRateWithID(_ExchangeRate):
     target_currency_id: int
 
     model_config = ConfigDict(from_attributes=True)
+
+
+class ExchangeRateBulkResult(BaseModel):
+    baseCurrencyCode: str | None
+    targetCurrencyCode: str | None
+    status: str
+
+
+class ExchangeRateCandle(BaseModel):
+    time: datetime.datetime
+    open: float
+    high: float
+    low: float
+    close: float
+    count: int
+
+
+class ExchangeRateMatrix(BaseModel):
+    codes: list[str]
+    rates: list[list[float | None]]
+
+
+class ExchangeRateAnomaly(BaseModel):
+    codes: list[str]
+    profit: float
@@ -0,0 +1,356 @@
+import asyncio
+import bisect
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Callable, TypeVar
+
+import numpy as np
+from pydantic_core import to_json
+
+from cache import RateCache, rate_cache
+from config import CACHE_HEALTH_CHECK_INTERVAL, RATE_SNAPSHOT_PATH, RATE_SNAPSHOT_SIZE, STORAGE_BACKEND
+from currencies.schemas import CurrencyWithID
+from exceptions import ExchangeRateNotFound
+
+from .graph import RateGraph, find_path, rate_graph
+from .schemas import ExchangeRateWithCurrencies
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAGIC = b"RATESNP2"
+# Magic and the active slot, then the sequence and length of each of the two slots
+HEADER_SIZE = 64
+ACTIVE_OFFSET = 8
+SEQUENCE_OFFSETS = (16, 32)
+LENGTH_OFFSETS = (24, 40)
+# Cache version, currencies, stored rates, neighbour entries and currency table bytes
+SLOT_HEADER = struct.Struct("<qQQQQ")
+U64 = struct.Struct("<Q")
+# A read that keeps overlapping rewrites is answered by the worker's own graph
+READ_ATTEMPTS = 3
+
+
+def _encode(graph: RateGraph, version: int) -> bytes:
+    # Currencies are numbered by their position in the table. Stored rates and
+    # neighbours are kept per currency, sorted by position
+    currencies = graph.get_currencies()
+    positions = {currency.id: position for position, currency in enumerate(currencies)}
+    stored_rates = [sorted((positions[target_id], rate)
+                           for target_id, rate in graph.get_stored_rates(currency.id).items())
+                    for currency in currencies]
+    neighbours = [sorted(positions[neighbour_id] for neighbour_id in graph.get_neighbours(currency.id))
+                  for currency in currencies]
+
+    size = len(currencies)
+    rate_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, stored_rates), dtype=np.int64, count=size), out=rate_offsets[1:])
+    rate_count = int(rate_offsets[-1])
+    rate_targets = np.fromiter((target for currency_rates in stored_rates for target, _ in currency_rates),
+                               dtype=np.int64, count=rate_count)
+    rates = np.fromiter((rate for currency_rates in stored_rates for _, rate in currency_rates),
+                        dtype=np.float64, count=rate_count)
+    neighbour_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, neighbours), dtype=np.int64, count=size), out=neighbour_offsets[1:])
+    neighbour_positions = np.fromiter((position for currency_neighbours in neighbours
+                                       for position in currency_neighbours),
+                                      dtype=np.int64, count=int(neighbour_offsets[-1]))
+    currency_table = to_json(currencies)
+
+    return b"".join([
+        SLOT_HEADER.pack(version, size, rate_count, len(neighbour_positions), len(currency_table)),
+        rate_offsets.tobytes(), rate_targets.tobytes(), rates.tobytes(),
+        neighbour_offsets.tobytes(), neighbour_positions.tobytes(),
+        currency_table,
+    ])
+
+
+class CurrencyTable:
+    def __init__(self, encoded: bytes, pivots: list[str]):
+        self.encoded = encoded
+        self.currencies = [CurrencyWithID(**currency) for currency in json.loads(encoded)]
+        self.positions = {currency.code: position for position, currency in enumerate(self.currencies)}
+        self.pivot_positions = [self.positions.get(pivot_code) for pivot_code in pivots]
+
+
+# One published slot. The rate arrays are read in place, nothing in it is checked for
+# a concurrent rewrite, RateSnapshot compares the slot sequence around every lookup
+class SnapshotView:
+    max_cached_paths = 100_000
+
+    def __init__(self, memory: memoryview, offset: int, end: int, table: Callable[[bytes], CurrencyTable]):
+        self.version, size, rate_count, neighbour_count, table_size = SLOT_HEADER.unpack_from(memory, offset)
+        offset += SLOT_HEADER.size
+        if offset + 8 * (2 * size + 2 + 2 * rate_count + neighbour_count) + table_size > end:
+            raise ValueError("Rate snapshot slot overflows its buffer")
+
+        def array(format: str, count: int) -> memoryview:
+            nonlocal offset
+            view = memory[offset:offset + 8 * count].cast(format)
+            offset += 8 * count
+            return view
+
+        self._rate_offsets = array("q", size + 1)
+        self._rate_targets = array("q", rate_count)
+        self._rates = array("d", rate_count)
+        self._neighbour_offsets = array("q", size + 1)
+        self._neighbours = array("q", neighbour_count)
+        self._table = table(memory[offset:offset + table_size].tobytes())
+        self._path_rates: dict[tuple[int, int], float | None] = {}
+
+    def get_rate(self,
+                 base_currency_code: str,
+                 target_currency_code: str) -> ExchangeRateWithCurrencies:
+        base = self._table.positions.get(base_currency_code)
+        target = self._table.positions.get(target_currency_code)
+        rate = None if base is None or target is None else self._stored_rate(base, target)
+        if rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+        return self._to_response(rate, base, target)
+
+    def get_by_pair(self,
+                    base_currency_code: str,
+                    target_currency_code: str) -> ExchangeRateWithCurrencies:
+        base = self._table.positions.get(base_currency_code)
+        target = self._table.positions.get(target_currency_code)
+        if base is None or target is None or base == target:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+        # The slot does not change under a view, so neither do the rates found in it
+        key = (base, target)
+        if key in self._path_rates:
+            rate = self._path_rates[key]
+        else:
+            if len(self._path_rates) >= self.max_cached_paths:
+                self._path_rates.clear()
+            rate = self._path_rates[key] = self._path_rate(base, target)
+        if rate is None:
+            raise ExchangeRateNotFound("Exchange rate for this pair not found")
+        return self._to_response(rate, base, target)
+
+    def _path_rate(self, base: int, target: int) -> float | None:
+        path = find_path(base, target, self._table.pivot_positions, self._edge, self._neighbours_of)
+        if path is None:
+            return None
+
+        rate = 1.0
+        for step_from, step_to in zip(path, path[1:]):
+            rate *= self._edge(step_from, step_to)
+        return rate
+
+    def _to_response(self, rate: float, base: int, target: int) -> ExchangeRateWithCurrencies:
+        return ExchangeRateWithCurrencies(
+            rate=rate,
+            base_currency=self._table.currencies[base],
+            target_currency=self._table.currencies[target]
+        )
+
+    def _stored_rate(self, base: int, target: int) -> float | None:
+        end = self._rate_offsets[base + 1]
+        index = bisect.bisect_left(self._rate_targets, target, self._rate_offsets[base], end)
+        if index < end and self._rate_targets[index] == target:
+            return self._rates[index]
+        return None
+
+    def _edge(self, base: int, target: int) -> float | None:
+        rate = self._stored_rate(base, target)
+        if rate is not None:
+            return rate
+
+        inverse_rate = self._stored_rate(target, base)
+        if inverse_rate:
+            return 1 / inverse_rate
+        return None
+
+    def _neighbours_of(self, position: int) -> memoryview:
+        return self._neighbours[self._neighbour_offsets[position]:self._neighbour_offsets[position + 1]]
+
+
+# Rates shared by the workers of one host through a memory-mapped file. The worker holding
+# the lock file writes its rate graph to the inactive of two slots and then flips the
+# active one. The others read the active slot in place, and use their own graph while it
+# is behind their rate cache or keeps being rewritten under them
+class RateSnapshot:
+    def __init__(self, graph: RateGraph, cache: RateCache, path: str, size: int):
+        self._graph = graph
+        self._cache = cache
+        self.path = path
+        # Slots start on an 8 byte boundary, the arrays in them are read as 8 byte items
+        self.size = size - size % 8
+        self.leading = False
+        self._lock_file: int | None = None
+        self._buffer: mmap.mmap | None = None
+        self._memory: memoryview | None = None
+        self._inode: int | None = None
+        self._view: tuple[int, int, SnapshotView] | None = None
+        self._table: CurrencyTable | None = None
+        self._publish_scheduled = False
+        self._checker: asyncio.Task | None = None
+        cache.subscribe(self._changed)
+
+    def get_rate(self, base_currency_code: str, target_currency_code: str) -> ExchangeRateWithCurrencies:
+        return self._read(lambda rates: rates.get_rate(base_currency_code, target_currency_code))
+
+    def get_by_pair(self, base_currency_code: str, target_currency_code: str) -> ExchangeRateWithCurrencies:
+        return self._read(lambda rates: rates.get_by_pair(base_currency_code, target_currency_code))
+
+    def _read(self, lookup: Callable[[RateGraph | SnapshotView], T]) -> T:
+        buffer = self._buffer
+        if buffer is not None and not self.leading:
+            for _ in range(READ_ATTEMPTS):
+                slot = U64.unpack_from(buffer, ACTIVE_OFFSET)[0]
+                sequence = U64.unpack_from(buffer, SEQUENCE_OFFSETS[slot])[0]
+                if sequence == 0:
+                    break
+                if sequence % 2 == 1:
+                    # The active slot was flipped and is rewritten already, the other one is current
+                    continue
+                # Whatever was read from a slot that was rewritten meanwhile is discarded,
+                # not found included, it may come from a half written table
+                try:
+                    view = self._get_view(slot, sequence)
+                    if view.version < self._cache.version:
+                        break
+                    result = lookup(view)
+                except (Exception, ExchangeRateNotFound):
+                    if U64.unpack_from(buffer, SEQUENCE_OFFSETS[slot])[0] == sequence:
+                        raise
+                    continue
+                if U64.unpack_from(buffer, SEQUENCE_OFFSETS[slot])[0] == sequence:
+                    return result
+        return lookup(self._graph)
+
+    def _get_view(self, slot: int, sequence: int) -> SnapshotView:
+        if self._view is not None and self._view[:2] == (slot, sequence):
+            return self._view[2]
+        offset = HEADER_SIZE + slot * self.size
+        view = SnapshotView(self._memory, offset, offset + self.size, self._get_table)
+        self._view = (slot, sequence, view)
+        return view
+
+    def _get_table(self, encoded: bytes) -> CurrencyTable:
+        # Decoded again only when the currencies changed
+        if self._table is None or self._table.encoded != encoded:
+            self._table = CurrencyTable(encoded, self._graph.pivots)
+        return self._table
+
+    def open(self) -> None:
+        if self._lock_file is None:
+            self._lock_file = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        if not self.leading:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                self._lead()
+        if not self.leading:
+            self._attach()
+
+    def _lead(self) -> None:
+        self.leading = True
+        file_size = HEADER_SIZE + 2 * self.size
+        try:
+            current_size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            current_size = None
+        if current_size != file_size:
+            # Replaced rather than resized, workers still reading the old file must not fault
+            temporary_path = f"{self.path}.{os.getpid()}"
+            with open(temporary_path, "wb") as file:
+                file.write(MAGIC)
+                file.truncate(file_size)
+            os.replace(temporary_path, self.path)
+        self._map(writable=True)
+        self._publish()
+
+    def _attach(self) -> None:
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self._inode:
+            self._map(writable=False)
+
+    def _map(self, writable: bool) -> None:
+        with open(self.path, "r+b" if writable else "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            inode = os.fstat(file.fileno()).st_ino
+        if buffer[:len(MAGIC)] != MAGIC or len(buffer) != HEADER_SIZE + 2 * self.size:
+            return
+        # The previous buffer is not closed, lookups may still be reading it
+        self._view = None
+        self._buffer = buffer
+        self._memory = memoryview(buffer)
+        self._inode = inode
+
+    def _changed(self, version: int) -> None:
+        if not self.leading or self._publish_scheduled:
+            return
+        # Scheduled so the graph is updated first, and a burst of changes is published once
+        self._publish_scheduled = True
+        asyncio.get_running_loop().call_soon(self._publish)
+
+    def _publish(self) -> None:
+        self._publish_scheduled = False
+        if not self.leading:
+            return
+
+        payload = _encode(self._graph, self._cache.version)
+        if len(payload) > self.size:
+            logger.error("Rate snapshot needs %d bytes, RATE_SNAPSHOT_SIZE is %d", len(payload), self.size)
+            return
+
+        buffer = self._buffer
+        slot = 1 - U64.unpack_from(buffer, ACTIVE_OFFSET)[0]
+        sequence = U64.unpack_from(buffer, SEQUENCE_OFFSETS[slot])[0]
+        # Odd while the slot is written
+        sequence += 1 if sequence % 2 == 0 else 2
+        U64.pack_into(buffer, SEQUENCE_OFFSETS[slot], sequence)
+        offset = HEADER_SIZE + slot * self.size
+        buffer[offset:offset + len(payload)] = payload
+        U64.pack_into(buffer, LENGTH_OFFSETS[slot], len(payload))
+        U64.pack_into(buffer, SEQUENCE_OFFSETS[slot], sequence + 1)
+        U64.pack_into(buffer, ACTIVE_OFFSET, slot)
+
+    async def start(self) -> None:
+        if not self.path:
+            return
+        if STORAGE_BACKEND != "postgres":
+            # Only Postgres tells every worker about the writes of the others
+            logger.warning("RATE_SNAPSHOT_PATH is ignored without the postgres storage backend")
+            return
+        self.open()
+        self._checker = asyncio.create_task(self._check_periodically())
+
+    async def stop(self) -> None:
+        if self._checker is not None:
+            self._checker.cancel()
+            try:
+                await self._checker
+            except asyncio.CancelledError:
+                pass
+            self._checker = None
+        if self._lock_file is not None:
+            # Closing the lock file lets another worker take over
+            os.close(self._lock_file)
+            self._lock_file = None
+        self.leading = False
+        self._view = None
+        self._buffer = None
+        self._memory = None
+        self._inode = None
+
+    async def _check_periodically(self) -> None:
+        # Takes over when the writing worker exits, and follows a replaced file
+        while True:
+            await asyncio.sleep(CACHE_HEALTH_CHECK_INTERVAL)
+            self.open()
+
+
+rate_snapshot = RateSnapshot(rate_graph, rate_cache, RATE_SNAPSHOT_PATH, RATE_SNAPSHOT_SIZE)
@@ -0,0 +1,52 @@
+import csv
+import io
+from typing import AsyncIterator, Callable, Iterable, Literal
+
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from config import EXPORT_CHUNK_SIZE
+from database import async_session_maker, use_replica
+
+ExportFormat = Literal["ndjson", "csv"]
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _encode_ndjson(chunk: list[BaseModel]) -> bytes:
+    return "".join(item.model_dump_json() + "\n" for item in chunk).encode()
+
+
+def _encode_csv(rows: Iterable[list]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def export_response(stream_all: Callable[..., AsyncIterator[list[BaseModel]]],
+                    export_format: ExportFormat,
+                    filename: str,
+                    csv_header: list[str],
+                    to_csv_row: Callable[[BaseModel], list]) -> StreamingResponse:
+    # The session is opened inside the generator: the request-scoped one is
+    # closed before the response body is sent
+    async def body() -> AsyncIterator[bytes]:
+        if export_format == "csv":
+            yield _encode_csv([csv_header])
+
+        async with async_session_maker() as session:
+            use_replica(session)
+            async for chunk in stream_all(session, EXPORT_CHUNK_SIZE):
+                if export_format == "csv":
+                    yield _encode_csv(to_csv_row(item) for item in chunk)
+                else:
+                    yield _encode_ndjson(chunk)
+
+    return StreamingResponse(
+        body(),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
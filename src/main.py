@@ -1,26 +1,47 @@
+import json
 from contextlib import asynccontextmanager
+from pathlib import Path
 from typing import Annotated
 
-from fastapi import Depends, FastAPI, Request
+from fastapi import Depends, FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-
-from currencies.models import CurrencyORM
-from currencies.router import get_currencies, router as router_currencies
-from currencies.schemas import CurrencyWithID
-from database import async_session_maker, create_all_tables, drop_all_tables
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import rate_cache
+from conditional import not_modified
+from config import SEED_FILE, SQL_PROFILE_SAMPLE_RATE, STARTUP_MODE
+from currencies.router import router as router_currencies
+from currencies.schemas import Currency, CurrencyWithID
+from database import (async_session_maker, create_all_tables, drop_all_tables, get_async_session,
+                      replica_set, run_migrations)
 from exchange.router import router as router_exchange
-from exchange_rates.models import ExchangeRateORM
-from exchange_rates.router import get_exchange_rates, router as router_exchange_rates
-from exchange_rates.schemas import ExchangeRateWithCurrencies, ExchangeRateWithID
+from exchange_rates.anomalies import anomaly_detector
+from exchange_rates.router import router as router_exchange_rates
+from exchange_rates.schemas import ExchangeRate, ExchangeRateWithCurrencies
+from exchange_rates.snapshot import rate_snapshot
+from metrics import MetricsMiddleware
+from page_cache import PageCache, page_response
+from profiler import SQLProfilerMiddleware, recent_profiles
+from responses import json_response
+from storage import CurrencyRepository, ExchangeRateRepository
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    # The working set is in memory before the first request is accepted
+    await rate_cache.start(load_rates)
+    await rate_snapshot.start()
+    await replica_set.start()
     yield
+    await replica_set.stop()
+    await rate_snapshot.stop()
+    await rate_cache.stop()
+    anomaly_detector.close()
 
 
 app = FastAPI(title="Currency Exchange", lifespan=lifespan)
@@ -31,6 +52,7 @@ app.include_router(router_exchange)
 
 app.mount("/static", StaticFiles(directory="../static"), name="static")
 templates = Jinja2Templates(directory="../templates")
+index_pages = PageCache()
 
 origins = ["http://localhost"]
 
@@ -41,43 +63,77 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+if SQL_PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(SQLProfilerMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+if SQL_PROFILE_SAMPLE_RATE > 0:
+    @app.get("/debug/sql-profiles", include_in_schema=False)
+    async def get_sql_profiles():
+        return json_response(recent_profiles())
 
 
 @app.get("/", response_class=HTMLResponse)
 async def main(request: Request,
-               currencies: Annotated[list[CurrencyWithID], Depends(get_currencies)],
-               exchange_rates: Annotated[list[ExchangeRateWithCurrencies], Depends(get_exchange_rates)]):
-    return templates.TemplateResponse(
-        "index.html", {"request": request, "currencies": currencies, "exchangeRates": exchange_rates}
-    )
+               response: Response,
+               session: Annotated[AsyncSession, Depends(get_async_session)]):
+    if not rate_cache.ready:
+        currencies = await CurrencyRepository.get_all(session)
+        exchange_rates = await ExchangeRateRepository.get_all(session)
+        return templates.TemplateResponse(
+            "index.html", {"request": request, "currencies": currencies, "exchangeRates": exchange_rates}
+        )
+
+    not_modified_response = not_modified(request, response, "currency", "exchange_rate", weak=True)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    # Rendered once per version of the data. Links are absolute, so pages are kept per base URL
+    tag, _ = rate_cache.get_table_version("currency", "exchange_rate")
+    page = await index_pages.get(str(request.base_url), tag, lambda: _render_index(request))
+    return page_response(request, response, page, "text/html")
+
+
+# The page is cached under the primary's version, so it is read from the primary too, not
+# with the request's session that may read from a lagging replica
+async def _render_index(request: Request) -> bytes:
+    async with async_session_maker() as session:
+        exchange_rates = await ExchangeRateRepository.get_all(session)
+    context = {"request": request, "currencies": rate_cache.get_currencies(), "exchangeRates": exchange_rates}
+    return templates.get_template("index.html").render(context).encode()
 
 
 async def init_db():
-    await drop_all_tables()
-    await create_all_tables()
-
-    currencies = [
-        {"name": "US Dollar", "code": "USD", "sign": "$"},
-        {"name": "Russian Ruble", "code": "RUB", "sign": "₽"},
-        {"name": "Euro", "code": "EUR", "sign": "€"},
-        {"name": "Kazakhstani Tenge", "code": "KZT", "sign": "₸"},
-        {"name": "Japanese yen", "code": "JPY", "sign": "¥"},
-    ]
-
-    exchange_rates = [
-        {"base_currency_id": 1, "target_currency_id": 2, "rate": 92.35},
-        {"base_currency_id": 3, "target_currency_id": 2, "rate": 100.3},
-        {"base_currency_id": 4, "target_currency_id": 2, "rate": 0.19},
-        {"base_currency_id": 5, "target_currency_id": 2, "rate": 0.61},
-        {"base_currency_id": 1, "target_currency_id": 3, "rate": 0.91},
-    ]
+    if STARTUP_MODE == "reset":
+        await drop_all_tables()
+        await create_all_tables()
+    elif STARTUP_MODE == "migrate":
+        await run_migrations()
+    else:
+        raise ValueError(f"Unknown STARTUP_MODE: {STARTUP_MODE}")
 
+    seed = json.loads(Path(SEED_FILE).read_text(encoding="utf-8"))
+
+    # Only missing rows are inserted, so every worker can seed on startup
     async with async_session_maker() as session:
-        for currency in currencies:
-            session.add(CurrencyORM(**currency))
+        await CurrencyRepository.add_missing(
+            session,
+            [Currency(**currency) for currency in seed["currencies"]]
+        )
+        await ExchangeRateRepository.add_missing(
+            session,
+            [ExchangeRate(**exchange_rate) for exchange_rate in seed["exchangeRates"]]
+        )
 
-        for exchange_rate in exchange_rates:
-            session.add(ExchangeRateORM(**exchange_rate))
 
-        await session.flush()
-        await session.commit()
+async def load_rates() -> tuple[list[CurrencyWithID], list[ExchangeRateWithCurrencies]]:
+    async with async_session_maker() as session:
+        currencies = await CurrencyRepository.get_all(session)
+        exchange_rates = await ExchangeRateRepository.get_all(session)
+    return currencies, exchange_rates
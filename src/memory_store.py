@@ -0,0 +1,37 @@
+import datetime
+import itertools
+from typing import NamedTuple
+
+from currencies.schemas import CurrencyWithID
+
+
+class StoredExchangeRate(NamedTuple):
+    id: int
+    rate: float
+
+
+class HistoryEntry(NamedTuple):
+    valid_from: datetime.datetime
+    # None when the pair was deleted
+    rate: float | None
+
+
+class MemoryStore:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.currencies: dict[int, CurrencyWithID] = {}
+        self.currency_ids: dict[str, int] = {}
+        # Keyed by (base_currency_id, target_currency_id), in insertion (= id) order
+        self.exchange_rates: dict[tuple[int, int], StoredExchangeRate] = {}
+        self.history: dict[tuple[int, int], list[HistoryEntry]] = {}
+        self.currency_id_sequence = itertools.count(1)
+        self.exchange_rate_id_sequence = itertools.count(1)
+
+    def add_history(self, pair: tuple[int, int], rate: float | None) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.history.setdefault(pair, []).append(HistoryEntry(now, rate))
+
+
+memory_store = MemoryStore()
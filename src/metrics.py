@@ -0,0 +1,128 @@
+import contextvars
+import time
+from functools import lru_cache
+
+from prometheus_client import Counter, Gauge, Histogram
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+LABELS = ["method", "route"]
+
+request_latency = Histogram("http_request_duration_seconds", "Request latency", LABELS)
+requests_in_flight = Gauge("http_requests_in_flight", "Requests being served", LABELS)
+request_errors = Counter("http_request_errors_total", "Errors by exception type",
+                         LABELS + ["exception"])
+request_db_queries = Histogram("http_request_db_queries", "Database queries per request", LABELS,
+                               buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+request_db_time = Histogram("http_request_db_duration_seconds", "Time spent in database queries per request",
+                            LABELS)
+
+pool_checkout_wait = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection",
+                               buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+pool_size = Gauge("db_pool_size", "Connections kept in the pool")
+pool_checked_out = Gauge("db_pool_checked_out", "Connections currently checked out")
+pool_utilisation = Gauge("db_pool_utilisation", "Checked out connections over pool size plus max overflow")
+
+
+class _RouteMetrics:
+    __slots__ = ("labels", "latency", "in_flight", "db_queries", "db_time")
+
+    def __init__(self, method: str, route: str):
+        # Children are bound once per route, labels() takes a lock on every call
+        self.labels = (method, route)
+        self.latency = request_latency.labels(method, route)
+        self.in_flight = requests_in_flight.labels(method, route)
+        self.db_queries = request_db_queries.labels(method, route)
+        self.db_time = request_db_time.labels(method, route)
+
+    def count_error(self, exception: str) -> None:
+        request_errors.labels(*self.labels, exception).inc()
+
+
+class _RequestStats:
+    __slots__ = ("route_metrics", "queries", "db_time")
+
+    def __init__(self, route_metrics: _RouteMetrics):
+        self.route_metrics = route_metrics
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_request_stats: contextvars.ContextVar[_RequestStats | None] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def _route_path(routes: list, method: str, path: str) -> str:
+    scope = {"type": "http", "method": method, "path": path, "root_path": ""}
+    partial = None
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    # Unmatched paths share one label
+    return partial or "<unmatched>"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.routes = None
+        # Routes are matched again here so in-flight requests are labelled before routing,
+        # the cache keeps that off the hot path
+        self.route_metrics = lru_cache(maxsize=4096)(self._route_metrics)
+
+    def _route_metrics(self, method: str, path: str) -> _RouteMetrics:
+        return _RouteMetrics(method, _route_path(self.routes, method, path))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.routes is None:
+            self.routes = scope["app"].routes
+        route_metrics = self.route_metrics(scope["method"], scope["path"])
+        stats = _RequestStats(route_metrics)
+        token = _request_stats.set(stats)
+        route_metrics.in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        except BaseException as exc:
+            route_metrics.count_error(type(exc).__name__)
+            raise
+        finally:
+            route_metrics.latency.observe(time.perf_counter() - started)
+            route_metrics.in_flight.dec()
+            route_metrics.db_queries.observe(stats.queries)
+            route_metrics.db_time.observe(stats.db_time)
+            _request_stats.reset(token)
+
+
+# Errors the routers turn into 404 and 409 responses never reach the middleware
+def record_error(exc: BaseException) -> None:
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.route_metrics.count_error(type(exc).__name__)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+
+def handle_error(exception_context):
+    # after_cursor_execute is skipped for failed statements
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
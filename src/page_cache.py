@@ -0,0 +1,59 @@
+import gzip
+from typing import Awaitable, Callable, Hashable, NamedTuple
+
+from fastapi import Request, Response
+
+from singleflight import SingleFlight
+
+GZIP_LEVEL = 6
+
+
+class CachedPage(NamedTuple):
+    tag: str
+    body: bytes
+    gzipped: bytes
+
+
+# Rendered pages kept until the data version they were rendered from changes. Concurrent
+# requests for a stale page wait for one render
+class PageCache:
+    def __init__(self, max_size: int = 16):
+        self.max_size = max_size
+        self._pages: dict[Hashable, CachedPage] = {}
+        self._renders = SingleFlight()
+
+    async def get(self, key: Hashable, tag: str, render: Callable[[], Awaitable[bytes]]) -> CachedPage:
+        page = self._pages.get(key)
+        if page is not None and page.tag == tag:
+            return page
+        return await self._renders.do((key, tag), lambda: self._render(key, tag, render))
+
+    async def _render(self, key: Hashable, tag: str, render: Callable[[], Awaitable[bytes]]) -> CachedPage:
+        body = await render()
+        page = CachedPage(tag, body, gzip.compress(body, GZIP_LEVEL))
+        if key not in self._pages and len(self._pages) >= self.max_size:
+            del self._pages[next(iter(self._pages))]
+        self._pages[key] = page
+        return page
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = params.strip().removeprefix("q=")
+        try:
+            return not params or float(quality) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def page_response(request: Request, response: Response, page: CachedPage, media_type: str) -> Response:
+    headers = dict(response.headers)
+    headers["Vary"] = "Accept-Encoding"
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=page.gzipped, media_type=media_type, headers=headers)
+    return Response(content=page.body, media_type=media_type, headers=headers)
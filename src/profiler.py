@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import random
+import sys
+import time
+from typing import Iterator, NamedTuple
+
+import greenlet
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import (SQL_PROFILE_HISTORY, SQL_PROFILE_N_PLUS_ONE_THRESHOLD, SQL_PROFILE_SAMPLE_RATE,
+                    SQL_SLOW_QUERY_THRESHOLD)
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-SQL-Profile"
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+
+class QueryRecord(NamedTuple):
+    statement: str
+    source: str
+    duration: float
+
+
+class RequestProfile:
+    def __init__(self, profile_id: int, method: str, path: str):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.queries: list[QueryRecord] = []
+
+    def n_plus_one(self) -> list[dict]:
+        # The same statement from the same place many times in one request is
+        # almost always a loop that should have been a single query
+        counts = collections.Counter((query.source, query.statement) for query in self.queries)
+        return [
+            {"source": source, "statement": statement, "count": count}
+            for (source, statement), count in counts.items()
+            if count >= SQL_PROFILE_N_PLUS_ONE_THRESHOLD
+        ]
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "queries": len(self.queries),
+            "db_time_ms": round(sum(query.duration for query in self.queries) * 1000, 3),
+            "n_plus_one": self.n_plus_one(),
+            "statements": [
+                {"source": query.source, "statement": query.statement,
+                 "duration_ms": round(query.duration * 1000, 3)}
+                for query in self.queries
+            ],
+        }
+
+    def header(self) -> str:
+        db_time = sum(query.duration for query in self.queries) * 1000
+        return (f"id={self.id}; queries={len(self.queries)}; db_time_ms={db_time:.3f}; "
+                f"n_plus_one={len(self.n_plus_one())}")
+
+
+_profile: contextvars.ContextVar[RequestProfile | None] = contextvars.ContextVar("sql_profile", default=None)
+_profile_ids = itertools.count(1)
+_recent_profiles: collections.deque[RequestProfile] = collections.deque(maxlen=SQL_PROFILE_HISTORY)
+_explaining: contextvars.ContextVar[bool] = contextvars.ContextVar("sql_explaining", default=False)
+_engines: dict = {}
+_explain_tasks: set[asyncio.Task] = set()
+
+
+def recent_profiles() -> list[dict]:
+    return [profile.summary() for profile in reversed(_recent_profiles)]
+
+
+@contextlib.contextmanager
+def profile_request(method: str, path: str) -> Iterator[RequestProfile]:
+    profile = RequestProfile(next(_profile_ids), method, path)
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+        _recent_profiles.append(profile)
+        for n_plus_one in profile.n_plus_one():
+            logger.warning("Possible N+1 in %s %s: %s ran %d times from %s", method, path,
+                           n_plus_one["statement"], n_plus_one["count"], n_plus_one["source"])
+
+
+class SQLProfilerMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not _sampled(scope):
+            await self.app(scope, receive, send)
+            return
+
+        with profile_request(scope["method"], scope["path"]) as profile:
+            # Statements after the response has started, like streamed bodies, only
+            # show up in the recent profiles
+            async def send_with_profile(message: Message):
+                if message["type"] == "http.response.start":
+                    MutableHeaders(scope=message).append(PROFILE_HEADER, profile.header())
+                await send(message)
+
+            await self.app(scope, receive, send_with_profile)
+
+
+def _sampled(scope: Scope) -> bool:
+    # Clients can ask for a profile of a specific request
+    if any(name == b"x-sql-profile" for name, _ in scope["headers"]):
+        return True
+    return random.random() < SQL_PROFILE_SAMPLE_RATE
+
+
+def _source() -> str:
+    # Async sessions run statements in a greenlet, the awaiting coroutines are in its parent
+    parent = greenlet.getcurrent().parent
+    frame = parent.gr_frame if parent is not None else sys._getframe()
+    source = "unknown"
+    # The outermost repository frame is the method the caller used, not a private helper
+    while frame is not None:
+        if frame.f_globals.get("__name__", "").endswith("repository"):
+            source = frame.f_code.co_qualname
+        frame = frame.f_back
+    return source
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["profiler_started"].pop()
+    profile = _profile.get()
+    slow = SQL_SLOW_QUERY_THRESHOLD > 0 and duration >= SQL_SLOW_QUERY_THRESHOLD and not _explaining.get()
+    if profile is None and not slow:
+        return
+
+    source = _source()
+    if profile is not None:
+        profile.queries.append(QueryRecord(statement, source, duration))
+    if slow:
+        if executemany or not statement.lstrip().upper().startswith(EXPLAINABLE):
+            logger.warning("Slow query %.1f ms from %s\n%s", duration * 1000, source, statement)
+            return
+        # On its own connection after this statement, the current one is still in use.
+        # A fresh context keeps the EXPLAIN out of the request's profile and metrics
+        task = asyncio.get_running_loop().create_task(
+            _log_slow_query(_engines[conn.engine], statement, parameters, source, duration),
+            context=contextvars.Context()
+        )
+        _explain_tasks.add(task)
+        task.add_done_callback(_explain_tasks.discard)
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("profiler_started"):
+        connection.info["profiler_started"].pop()
+
+
+async def _log_slow_query(engine: AsyncEngine, statement: str, parameters, source: str, duration: float):
+    _explaining.set(True)
+    explain = "EXPLAIN " if engine.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    try:
+        # On the engine that ran the statement, replicas can plan differently
+        async with engine.connect() as conn:
+            result = await conn.exec_driver_sql(explain + statement, parameters)
+            plan = "\n".join(" ".join(str(column) for column in row) for row in result)
+    except Exception as exc:
+        plan = f"EXPLAIN failed: {exc!r}"
+    logger.warning("Slow query %.1f ms from %s\n%s\n%s", duration * 1000, source, statement, plan)
+
+
+def install(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+    _engines[sync_engine] = engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
@@ -0,0 +1,79 @@
+import asyncio
+import itertools
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import DB_REPLICA_HEALTH_CHECK_INTERVAL, DB_REPLICA_MAX_LAG
+
+logger = logging.getLogger(__name__)
+
+# Seconds behind the primary. A replica that has replayed everything it received is
+# current even if the primary has been idle since the last replayed transaction
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReplicaSet:
+    def __init__(self, engines: list[AsyncEngine]):
+        self.engines = engines
+        self.healthy: list[AsyncEngine] = []
+        self._turn = itertools.count()
+        self._checker: asyncio.Task | None = None
+
+    # Round-robin over the replicas that passed the last check, None sends the read to the primary
+    def choose(self) -> AsyncEngine | None:
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    async def _lag(self, engine: AsyncEngine) -> float:
+        async with engine.connect() as conn:
+            lag = (await conn.execute(LAG_QUERY)).scalar_one()
+        return float(lag or 0)
+
+    async def check(self) -> None:
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self._lag(engine), DB_REPLICA_HEALTH_CHECK_INTERVAL) for engine in self.engines),
+            return_exceptions=True
+        )
+
+        healthy = []
+        for engine, lag in zip(self.engines, results):
+            was_healthy = engine in self.healthy
+            if isinstance(lag, Exception):
+                if was_healthy:
+                    logger.warning("Replica %s is unreachable, reading from the primary", engine.url.host)
+            elif lag > DB_REPLICA_MAX_LAG:
+                if was_healthy:
+                    logger.warning("Replica %s is %.1f s behind, reading from the primary", engine.url.host, lag)
+            else:
+                if not was_healthy:
+                    logger.info("Replica %s is serving reads", engine.url.host)
+                healthy.append(engine)
+        self.healthy = healthy
+
+    async def start(self) -> None:
+        if not self.engines:
+            return
+        await self.check()
+        self._checker = asyncio.create_task(self._check_periodically())
+
+    async def stop(self) -> None:
+        if self._checker is not None:
+            self._checker.cancel()
+            try:
+                await self._checker
+            except asyncio.CancelledError:
+                pass
+            self._checker = None
+        self.healthy = []
+
+    async def _check_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(DB_REPLICA_HEALTH_CHECK_INTERVAL)
+            await self.check()
@@ -0,0 +1,12 @@
+from fastapi import Response
+from pydantic_core import to_json
+
+
+# Skips the response_model validation and serialization round trip, content is
+# either encoded with pydantic_core (models and plain dicts alike) or already encoded
+def json_response(content, response: Response | None = None) -> Response:
+    if not isinstance(content, bytes):
+        content = to_json(content)
+
+    headers = dict(response.headers) if response is not None else None
+    return Response(content=content, media_type="application/json", headers=headers)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from config import LOOKUP_CACHE_MAX_SIZE, LOOKUP_CACHE_TTL
+from exchange_rates.graph import rate_graph
+
+T = TypeVar("T")
+
+
+# Concurrent lookups of the same key share one fetch. With a ttl the results are also
+# kept for that many seconds, and dropped as soon as anything is written
+class SingleFlight:
+    def __init__(self, ttl: float = 0, max_size: int = 10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self._results: dict[Hashable, tuple[float, object]] = {}
+        self._generation = 0
+
+    def invalidate(self, *_) -> None:
+        self._generation += 1
+        self._results.clear()
+
+    async def do(self, key: Hashable, fetch: Callable[[], Awaitable[T]]) -> T:
+        while True:
+            if self.ttl:
+                cached = self._results.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    return cached[1]
+
+            call = self._calls.get(key)
+            if call is None:
+                return await self._lead(key, fetch)
+
+            try:
+                return await asyncio.shield(call)
+            except asyncio.CancelledError:
+                # Only the leader was cancelled, one of the waiters takes over
+                if call.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+    async def _lead(self, key: Hashable, fetch: Callable[[], Awaitable[T]]) -> T:
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        generation = self._generation
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as exc:
+            call.set_exception(exc)
+            # Marks the exception as retrieved when nobody was waiting
+            call.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+        call.set_result(result)
+        # A fetch that overlapped a write may have read the old value
+        if self.ttl and generation == self._generation:
+            if len(self._results) >= self.max_size:
+                del self._results[next(iter(self._results))]
+            self._results[key] = (time.monotonic() + self.ttl, result)
+        return result
+
+
+pair_lookups = SingleFlight(LOOKUP_CACHE_TTL, LOOKUP_CACHE_MAX_SIZE)
+currency_lookups = SingleFlight(LOOKUP_CACHE_TTL, LOOKUP_CACHE_MAX_SIZE)
+
+# Local writes and the ones other workers NOTIFY about all end up in the rate graph
+rate_graph.subscribe(pair_lookups.invalidate)
+rate_graph.subscribe(currency_lookups.invalidate)
@@ -0,0 +1,11 @@
+from config import STORAGE_BACKEND
+
+# Repositories of the configured backend, both implement the same contract
+if STORAGE_BACKEND == "memory":
+    from currencies.memory_repository import InMemoryCurrencyRepository as CurrencyRepository
+    from exchange_rates.memory_repository import InMemoryExchangeRateRepository as ExchangeRateRepository
+else:
+    from currencies.repository import CurrencyRepository
+    from exchange_rates.repository import ExchangeRateRepository
+
+__all__ = ["CurrencyRepository", "ExchangeRateRepository"]
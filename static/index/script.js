@@ -109,7 +109,14 @@ async function addExchangeRate() {
   if (response.ok === true) {
     const exchangeRate = await response.json();
     const rows = document.querySelector("#exchangeTBody");
-    rows.append(exchangeRateRow(exchangeRate));
+    // the stream may have added the row already
+    const row = rows.querySelector(`tr[data-pair='${exchangeRate.base_currency.code + exchangeRate.target_currency.code}']`);
+    if (row === null) {
+      rows.append(exchangeRateRow(exchangeRate));
+    }
+    else {
+      row.replaceWith(exchangeRateRow(exchangeRate));
+    }
     
     baseCurrencyCodeInput.value = "";
     targetCurrencyCodeInput.value = "";
@@ -181,6 +188,40 @@ async function exchange(event) {
   }
 }
 
+// Exchange rates stream
+
+function subscribeExchangeRates() {
+  const source = new EventSource("/exchangeRates/stream");
+  source.addEventListener("rates", event => {
+    const update = JSON.parse(event.data);
+    if (update.resync === true) {
+      location.reload();
+      return;
+    }
+
+    const rows = document.querySelector("#exchangeTBody");
+    for (const delta of update.rates) {
+      const row = document.querySelector(`tr[data-pair='${delta.base + delta.target}']`);
+      if (row === null) {
+        // new pair, removals of pairs not on the page are ignored
+        if (delta.rate !== null) {
+          rows.append(exchangeRateRow({
+            base_currency: { code: delta.base },
+            target_currency: { code: delta.target },
+            rate: delta.rate
+          }));
+        }
+      }
+      else if (delta.rate === null) {
+        row.remove();
+      }
+      else {
+        row.querySelector(".rate").textContent = delta.rate;
+      }
+    }
+  });
+}
+
 // Helper functions
 
 async function addOrEditExchangeRate(event) {
@@ -241,12 +282,14 @@ function currencyRow(currency) {
 function exchangeRateRow(exchangeRate) {
   const tr = document.createElement("tr");
   tr.setAttribute("data-rowid", "exchangeRate" + exchangeRate.id);
+  tr.setAttribute("data-pair", exchangeRate.base_currency.code + exchangeRate.target_currency.code);
 
   const pairTd = document.createElement("td");
   pairTd.innerHTML = `<a href="/exchangeRates/${exchangeRate.base_currency.code + exchangeRate.target_currency.code}">${exchangeRate.base_currency.code}/${exchangeRate.target_currency.code}</a>`;
   tr.append(pairTd);
 
   const rateTd = document.createElement("td");
+  rateTd.className = "rate";
   rateTd.append(exchangeRate.rate);
   tr.append(rateTd);
 
@@ -275,4 +318,6 @@ document.addEventListener("DOMContentLoaded", function() {
     document.getElementById("exchangeButton").addEventListener("click", exchange);
     document.getElementById("addCurrency").addEventListener("click", addCurrency);
     document.getElementById("addExchangeRate").addEventListener("click", addOrEditExchangeRate);
+
+    subscribeExchangeRates();
 })
@@ -1,3 +1,5 @@
+import json
+
 import requests
 
 
@@ -47,12 +49,43 @@ def test_create_exchange_rate():
     response = requests.post("http://localhost:8000/exchangeRates", json=data_invalid)
     assert response.status_code == 404
 
+    response = requests.post("http://localhost:8000/exchangeRates", json={**data_valid, "rate": 0})
+    assert response.status_code == 422
+
+
+def test_put_exchange_rates_bulk():
+    data = [
+        {"rate": 12.34, "baseCurrencyCode": "LOL", "targetCurrencyCode": "KEK"},
+        {"rate": 12.34, "baseCurrencyCode": "LOL", "targetCurrencyCode": "NNN"},
+        {"rate": "abc", "baseCurrencyCode": "LOL", "targetCurrencyCode": "KEK"},
+    ]
+    ndjson = b'{"rate": 12.34, "baseCurrencyCode": "LOL", "targetCurrencyCode": "KEK"}\n'
+
+    response = requests.put("http://localhost:8000/exchangeRates/bulk", json=data)
+    assert response.status_code == 200
+    assert [row["status"] for row in response.json()] == ["updated", "currency_not_found", "invalid"]
+
+    response = requests.put("http://localhost:8000/exchangeRates/bulk", data=ndjson,
+                            headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert [row["status"] for row in response.json()] == ["updated"]
+
 
 def test_get_currencies():
     response = requests.get("http://localhost:8000/currencies")
     assert response.status_code == 200
 
 
+def test_export_currencies():
+    response = requests.get("http://localhost:8000/currencies/export")
+    assert response.status_code == 200
+    assert any(json.loads(line)["code"] == "LOL" for line in response.text.splitlines())
+
+    response = requests.get("http://localhost:8000/currencies/export?format=csv")
+    assert response.status_code == 200
+    assert response.text.splitlines()[0] == "id,code,name,sign"
+
+
 def test_get_currency():
     response = requests.get("http://localhost:8000/currencies/LOL")
     assert response.status_code == 200
@@ -66,6 +99,28 @@ def test_get_exchange_rates():
     response = requests.get("http://localhost:8000/exchangeRates")
     assert response.status_code == 200
 
+    response = requests.get("http://localhost:8000/exchangeRates?limit=1")
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert "next" in response.links
+
+    response = requests.get(response.links["next"]["url"])
+    assert response.status_code == 200
+
+    response = requests.get("http://localhost:8000/exchangeRates?base=LOL&target=KEK")
+    assert response.status_code == 200
+    assert [rate["rate"] for rate in response.json()] == [12.34]
+
+
+def test_export_exchange_rates():
+    response = requests.get("http://localhost:8000/exchangeRates/export")
+    assert response.status_code == 200
+    assert any(json.loads(line)["rate"] == 12.34 for line in response.text.splitlines())
+
+    response = requests.get("http://localhost:8000/exchangeRates/export?format=csv")
+    assert response.status_code == 200
+    assert "LOL,KEK,12.34" in response.text.splitlines()
+
 
 def test_get_exchange_rate():
     response = requests.get("http://localhost:8000/exchangeRates/LOLKEK")
@@ -80,6 +135,23 @@ def test_get_exchange_rate():
     response = requests.get("http://localhost:8000/exchangeRates/NNNZZZ")
     assert response.status_code == 404
 
+    # Rate in effect at a point in time
+    response = requests.get("http://localhost:8000/exchangeRates/LOLKEK?at=2100-01-01T00:00:00Z")
+    assert response.status_code == 200
+    assert response.json()["rate"] == 12.34
+
+    response = requests.get("http://localhost:8000/exchangeRates/LOLKEK?at=2000-01-01T00:00:00Z")
+    assert response.status_code == 404
+
+
+def test_get_exchange_rate_history():
+    response = requests.get(
+        "http://localhost:8000/exchangeRates/LOLKEK/history"
+        "?start=2000-01-01T00:00:00Z&end=2100-01-01T00:00:00Z&interval=day"
+    )
+    assert response.status_code == 200
+    assert response.json()[-1]["close"] == 12.34
+
 
 def test_get_exchange():
     response = requests.get(
@@ -88,11 +160,32 @@ def test_get_exchange():
     assert response.status_code == 200
     assert response.json()["converted_amount"] == round(12.34 * 43.21, 2)
 
-    # For existing currencies
+    # Inverse of the stored pair
     response = requests.get(
         "http://localhost:8000/exchange?baseCode=KEK&targetCode=LOL&amount=43.21"
     )
-    assert response.status_code == 404
+    assert response.status_code == 200
+    assert response.json()["converted_amount"] == round(43.21 / 12.34, 2)
+
+    # Cross rate through a common currency (USD -> RUB -> JPY), yen have no minor units
+    response = requests.get(
+        "http://localhost:8000/exchange?baseCode=USD&targetCode=JPY&amount=10"
+    )
+    assert response.status_code == 200
+    assert response.json()["converted_amount"] == round(92.35 / 0.61 * 10)
+
+    # 12.34 * 1.005 = 12.4017
+    response = requests.get(
+        "http://localhost:8000/exchange?baseCode=LOL&targetCode=KEK&amount=1.005&rounding=floor"
+    )
+    assert response.status_code == 200
+    assert response.json()["converted_amount"] == 12.40
+
+    response = requests.get(
+        "http://localhost:8000/exchange?baseCode=LOL&targetCode=KEK&amount=1.005&rounding=ceiling"
+    )
+    assert response.status_code == 200
+    assert response.json()["converted_amount"] == 12.41
 
     # For non-existent currency / currencies
     response = requests.get(
@@ -100,6 +193,183 @@ def test_get_exchange():
     )
     assert response.status_code == 404
 
+    # Amounts are bounded at 10^15
+    response = requests.get(
+        "http://localhost:8000/exchange?baseCode=LOL&targetCode=KEK&amount=1e15"
+    )
+    assert response.status_code == 200
+    assert response.json()["converted_amount"] == 12.34e15
+
+    for amount in ("1.000000000000001e15", "1e400", "-1e400"):
+        response = requests.get(
+            f"http://localhost:8000/exchange?baseCode=LOL&targetCode=KEK&amount={amount}"
+        )
+        assert response.status_code == 422
+
+
+def test_post_exchange_batch():
+    data_items = {
+        "items": [
+            {"baseCode": "LOL", "targetCode": "KEK", "amount": 43.21},
+            {"baseCode": "KEK", "targetCode": "LOL", "amount": 43.21},
+        ]
+    }
+    data_amounts = {"baseCode": "LOL", "targetCode": "KEK", "amounts": [1, 43.21]}
+    data_invalid = {"baseCode": "NNN", "targetCode": "ZZZ", "amounts": [1]}
+
+    response = requests.post("http://localhost:8000/exchange/batch", json=data_items)
+    assert response.status_code == 200
+    assert [item["converted_amount"] for item in response.json()] == [
+        round(12.34 * 43.21, 2), round(43.21 / 12.34, 2)
+    ]
+
+    response = requests.post("http://localhost:8000/exchange/batch", json=data_amounts)
+    assert response.status_code == 200
+    assert [item["converted_amount"] for item in response.json()] == [12.34, round(12.34 * 43.21, 2)]
+
+    response = requests.post("http://localhost:8000/exchange/batch", json=data_invalid)
+    assert response.status_code == 404
+
+    # Amounts are bounded at 10^15
+    response = requests.post("http://localhost:8000/exchange/batch",
+                             json={"baseCode": "LOL", "targetCode": "KEK", "amounts": [1e15, -1e15]})
+    assert response.status_code == 200
+    assert [item["converted_amount"] for item in response.json()] == [12.34e15, -12.34e15]
+
+    for amount in (5e16, 1e17, 1e300):
+        response = requests.post("http://localhost:8000/exchange/batch",
+                                 json={"baseCode": "LOL", "targetCode": "KEK", "amounts": [amount]})
+        assert response.status_code == 422
+
+        response = requests.post("http://localhost:8000/exchange/batch",
+                                 json={"items": [{"baseCode": "LOL", "targetCode": "KEK", "amount": amount}]})
+        assert response.status_code == 422
+
+
+def test_exchange_extreme_rates():
+    for code in ("XBT", "XJP", "XUS"):
+        requests.post("http://localhost:8000/currencies", json={"code": code, "name": code, "sign": code[0]})
+    # Scaled to 9 decimal places the first rate does not fit in int64, the inverse and the
+    # last one would round to 0
+    for base_code, target_code, rate in (("XBT", "XJP", 1e10), ("XUS", "XBT", 1e-11)):
+        response = requests.post("http://localhost:8000/exchangeRates",
+                                 json={"rate": rate, "baseCurrencyCode": base_code, "targetCurrencyCode": target_code})
+        assert response.status_code == 200
+
+    conversions = [("XBT", "XJP", 1.5, 1.5e10), ("XJP", "XBT", 1e12, 100), ("XUS", "XBT", 1e13, 100)]
+    for base_code, target_code, amount, converted_amount in conversions:
+        response = requests.get(
+            f"http://localhost:8000/exchange?baseCode={base_code}&targetCode={target_code}&amount={amount}"
+        )
+        assert response.status_code == 200
+        assert response.json()["converted_amount"] == converted_amount
+
+    response = requests.post("http://localhost:8000/exchange/batch", json={"items": [
+        {"baseCode": base_code, "targetCode": target_code, "amount": amount}
+        for base_code, target_code, amount, _ in conversions
+    ]})
+    assert response.status_code == 200
+    assert [item["converted_amount"] for item in response.json()] == [
+        converted_amount for _, _, _, converted_amount in conversions
+    ]
+
+    for pair in ("XBTXJP", "XUSXBT"):
+        requests.delete(f"http://localhost:8000/exchangeRates/{pair}")
+    for code in ("XBT", "XJP", "XUS"):
+        requests.delete(f"http://localhost:8000/currencies/{code}")
+
+
+def test_get_exchange_rate_matrix():
+    response = requests.get("http://localhost:8000/exchangeRates/matrix?codes=LOL,KEK")
+    assert response.status_code == 200
+    assert response.json()["rates"] == [[1.0, 12.34], [1 / 12.34, 1.0]]
+
+    response = requests.get("http://localhost:8000/exchangeRates/matrix?codes=LOL,KEK&format=binary")
+    assert response.status_code == 200
+    assert len(response.content) == 4 * 8
+
+    response = requests.get("http://localhost:8000/exchangeRates/matrix?codes=LOL,NNN")
+    assert response.status_code == 404
+
+    # Repeated codes are returned once
+    response = requests.get("http://localhost:8000/exchangeRates/matrix?codes=LOL,LOL,KEK")
+    assert response.status_code == 200
+    assert response.json()["codes"] == ["LOL", "KEK"]
+
+    response = requests.get("http://localhost:8000/exchangeRates/matrix?codes="
+                            + ",".join(f"C{index:03}" for index in range(1000)))
+    assert response.status_code == 422
+
+
+def test_get_exchange_rate_anomalies():
+    response = requests.get("http://localhost:8000/exchangeRates/anomalies")
+    assert response.status_code == 200
+    for anomaly in response.json():
+        assert anomaly["codes"][0] == anomaly["codes"][-1]
+        assert anomaly["profit"] > 0
+
+
+def test_stream_exchange_rates():
+    with requests.get("http://localhost:8000/exchangeRates/stream", stream=True, timeout=5) as stream:
+        assert stream.status_code == 200
+        assert stream.headers["content-type"].startswith("text/event-stream")
+
+        response = requests.patch("http://localhost:8000/exchangeRates/LOLKEK",
+                                  data=str(12.34).encode())
+        assert response.status_code == 200
+
+        for line in stream.iter_lines():
+            if line.startswith(b"data: "):
+                event = json.loads(line[len(b"data: "):])
+                break
+
+    assert event["resync"] is False
+    assert event["rates"] == [{"base": "LOL", "target": "KEK", "rate": 12.34}]
+
+
+def test_conditional_get():
+    response = requests.get("http://localhost:8000/exchangeRates/LOLKEK")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+
+    response = requests.get("http://localhost:8000/exchangeRates/LOLKEK",
+                            headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    response = requests.get("http://localhost:8000/currencies")
+    assert response.status_code == 200
+    response = requests.get("http://localhost:8000/currencies",
+                            headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+    requests.patch("http://localhost:8000/exchangeRates/LOLKEK", data=str(12.34).encode())
+    response = requests.get("http://localhost:8000/exchangeRates/LOLKEK",
+                            headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_index_page_is_cached():
+    response = requests.get("http://localhost:8000/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "LOLKEK" in response.text
+    etag = response.headers["ETag"]
+
+    response = requests.get("http://localhost:8000/", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["ETag"] == etag
+
+    response = requests.get("http://localhost:8000/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    requests.patch("http://localhost:8000/exchangeRates/LOLKEK", data=str(43.21).encode())
+    response = requests.get("http://localhost:8000/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "43.21" in response.text
+
 
 def test_patch_exchange_rate():
     response = requests.patch("http://localhost:8000/exchangeRates/LOLKEK",
@@ -117,6 +387,13 @@ def test_patch_exchange_rate():
                               data=str(23.45).encode())
     assert response.status_code == 404
 
+    # Rates must be positive
+    for rate in (-5, 0):
+        response = requests.patch("http://localhost:8000/exchangeRates/LOLKEK",
+                                  data=str(rate).encode())
+        assert response.status_code == 422
+    assert requests.get("http://localhost:8000/exchangeRates/LOLKEK").json()["rate"] == 23.45
+
 
 def test_delete_exchange_rate():
     response = requests.delete("http://localhost:8000/exchangeRates/LOLKEK")
@@ -133,6 +410,13 @@ def test_delete_exchange_rate():
 
 
 def test_delete_currency():
+    # Not while an exchange rate uses it
+    requests.post("http://localhost:8000/exchangeRates",
+                  json={"rate": 1.5, "baseCurrencyCode": "LOL", "targetCurrencyCode": "KEK"})
+    response = requests.delete("http://localhost:8000/currencies/LOL")
+    assert response.status_code == 409
+    requests.delete("http://localhost:8000/exchangeRates/LOLKEK")
+
     response = requests.delete("http://localhost:8000/currencies/LOL")
     assert response.status_code == 200
     assert response.json()["code"] == "LOL"
@@ -143,3 +427,15 @@ def test_delete_currency():
 
     response = requests.delete("http://localhost:8000/currencies/KEK")
     assert response.status_code == 404
+
+
+def test_metrics():
+    response = requests.get("http://localhost:8000/currencies/ZZZ")
+    assert response.status_code == 404
+
+    response = requests.get("http://localhost:8000/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/currencies/{code}"}' in response.text
+    assert ('http_request_errors_total{exception="CurrencyNotFound",method="GET",route="/currencies/{code}"}'
+            in response.text)
+    assert 'http_request_db_queries_count{method="GET",route="/currencies/{code}"}' in response.text
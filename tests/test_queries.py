@@ -0,0 +1,444 @@
+import asyncio
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import event, select
+
+import cache
+import database
+import profiler
+from config import SQL_PROFILE_N_PLUS_ONE_THRESHOLD
+from currencies.memory_repository import InMemoryCurrencyRepository
+from currencies.repository import CurrencyRepository
+from currencies.schemas import Currency, CurrencyWithID
+from exceptions import CurrencyInUseError, ExchangeRateNotFound
+from exchange.conversion import INT64_MAX, MAX_AMOUNT, RATE_DECIMALS, RATE_SCALE, convert_many
+import exchange.router
+import exchange_rates.router
+from exchange.router import _get_exchange_rate
+from exchange_rates.graph import RateGraph
+from exchange_rates.matrix import RateMatrix
+from exchange_rates.memory_repository import InMemoryExchangeRateRepository
+from exchange_rates.models import ExchangeRateHistoryORM
+from exchange_rates.repository import ExchangeRateRepository
+from exchange_rates.schemas import ExchangeRate, ExchangeRateWithCurrencies
+from exchange_rates.snapshot import READ_ATTEMPTS, RateSnapshot, SnapshotView
+from memory_store import memory_store
+from singleflight import SingleFlight
+
+
+def run_counting_queries(coroutine_function, *args):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async def run():
+        try:
+            async with database.async_session_maker() as session:
+                return await coroutine_function(session, *args)
+        finally:
+            await database.engine.dispose()
+
+    sync_engine = database.engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = asyncio.run(run())
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", before_cursor_execute)
+    return result, statements
+
+
+def test_get_by_pair_is_one_query():
+    exchange_rate, statements = run_counting_queries(ExchangeRateRepository.get_by_pair,
+                                                     "USD", "RUB")
+    assert exchange_rate.base_currency.code == "USD"
+    assert exchange_rate.target_currency.code == "RUB"
+    assert len(statements) == 1
+
+
+def test_get_by_pair_not_found_is_one_query():
+    async def get_missing_pair(session):
+        try:
+            await ExchangeRateRepository.get_by_pair(session, "RUB", "USD")
+        except ExchangeRateNotFound:
+            return None
+
+    _, statements = run_counting_queries(get_missing_pair)
+    assert len(statements) == 1
+
+
+def test_get_all_is_one_query():
+    exchange_rates, statements = run_counting_queries(ExchangeRateRepository.get_all)
+    assert exchange_rates
+    assert len(statements) == 1
+
+
+def test_get_page_is_one_query():
+    (exchange_rates, _), statements = run_counting_queries(ExchangeRateRepository.get_page)
+    assert exchange_rates[0]["base_currency"]["code"] == "USD"
+    assert isinstance(exchange_rates[0]["rate"], float)
+    assert len(statements) == 1
+
+
+def test_add_missing_keeps_existing_pairs():
+    exchange_rates, statements = run_counting_queries(
+        ExchangeRateRepository.add_missing,
+        [ExchangeRate(baseCurrencyCode="USD", targetCurrencyCode="RUB", rate=1)]
+    )
+    assert exchange_rates == []
+    # Currency lookup and a single insert that skips the existing pair
+    assert len(statements) == 2
+
+
+def test_patch_by_pair_stores_the_decimal_rate():
+    async def patch(session):
+        stored_rates = []
+
+        def before_flush(sync_session, flush_context, instances):
+            stored_rates.extend(history.rate for history in sync_session.new
+                                if isinstance(history, ExchangeRateHistoryORM))
+
+        exchange_rate = await ExchangeRateRepository.get_by_pair(session, "USD", "RUB")
+        event.listen(session.sync_session, "before_flush", before_flush)
+        await ExchangeRateRepository.patch_by_pair(session, "USD", "RUB", 1.1)
+        event.remove(session.sync_session, "before_flush", before_flush)
+        await ExchangeRateRepository.patch_by_pair(session, "USD", "RUB", exchange_rate.rate)
+        return stored_rates
+
+    stored_rates, _ = run_counting_queries(patch)
+    assert stored_rates == [Decimal("1.1")]
+
+
+def test_replica_session_reads_from_one_replica(monkeypatch):
+    class Replica:
+        def __init__(self, name):
+            self.sync_engine = name
+
+    replicas = [Replica("first"), Replica("second")]
+    monkeypatch.setattr(database.replica_set, "healthy", replicas)
+    primary = database.engine.sync_engine
+
+    session = database.RoutingSession(bind=primary)
+    session.info["replica"] = True
+    statement = select(ExchangeRateHistoryORM)
+    binds = {session.get_bind(clause=statement) for _ in range(5)}
+    assert len(binds) == 1 and binds <= {"first", "second"}
+
+    monkeypatch.setattr(database.replica_set, "healthy", [
+        replica for replica in replicas if replica.sync_engine not in binds
+    ])
+    assert session.get_bind(clause=statement) is primary
+    assert session.get_bind(clause=statement) is primary
+
+
+def test_profiler_flags_repeated_statements():
+    async def get_pair_repeatedly(session):
+        for _ in range(SQL_PROFILE_N_PLUS_ONE_THRESHOLD):
+            await ExchangeRateRepository.get_by_pair(session, "USD", "RUB")
+
+    profiler.install(database.engine)
+    with profiler.profile_request("GET", "/test") as profile:
+        run_counting_queries(get_pair_repeatedly)
+
+    assert len(profile.queries) == SQL_PROFILE_N_PLUS_ONE_THRESHOLD
+    [n_plus_one] = profile.n_plus_one()
+    assert n_plus_one["source"] == "ExchangeRateRepository.get_by_pair"
+    assert n_plus_one["count"] == SQL_PROFILE_N_PLUS_ONE_THRESHOLD
+
+
+def test_single_flight_shares_concurrent_lookups():
+    lookups = SingleFlight()
+
+    async def get_pair_concurrently(session):
+        return await asyncio.gather(*(
+            lookups.do(("USD", "RUB"), lambda: ExchangeRateRepository.get_by_pair(session, "USD", "RUB"))
+            for _ in range(10)
+        ))
+
+    exchange_rates, statements = run_counting_queries(get_pair_concurrently)
+    assert len(exchange_rates) == 10
+    assert len(statements) == 1
+
+
+def test_concurrent_pair_loads_are_one_query():
+    pairs = [("USD", "RUB"), ("USD", "EUR"), ("EUR", "RUB"), ("RUB", "USD")]
+
+    async def load_pairs_concurrently(session):
+        return await asyncio.gather(
+            *(ExchangeRateRepository.load_by_pair(base, target) for base, target in pairs),
+            return_exceptions=True
+        )
+
+    exchange_rates, statements = run_counting_queries(load_pairs_concurrently)
+    assert exchange_rates[0].target_currency.code == "RUB"
+    assert isinstance(exchange_rates[-1], ExchangeRateNotFound)
+    assert len(statements) == 1
+
+
+def test_rate_matrix_agrees_with_exchange():
+    usd, eur, rub, kzt, gel = (CurrencyWithID(id=index, name=code, code=code, sign=code[0])
+                               for index, code in enumerate(["USD", "EUR", "RUB", "KZT", "GEL"], start=1))
+    graph = RateGraph(pivots=["USD"])
+    # Two inconsistent two-hop paths from EUR to RUB, /exchange goes through the pivot.
+    # GEL is only reached by the breadth-first search
+    graph.load([usd, eur, rub, kzt, gel], [
+        ExchangeRateWithCurrencies(base_currency=usd, target_currency=eur, rate=0.5),
+        ExchangeRateWithCurrencies(base_currency=usd, target_currency=rub, rate=90),
+        ExchangeRateWithCurrencies(base_currency=eur, target_currency=kzt, rate=2),
+        ExchangeRateWithCurrencies(base_currency=kzt, target_currency=rub, rate=50),
+        ExchangeRateWithCurrencies(base_currency=gel, target_currency=kzt, rate=0.3),
+    ])
+
+    codes = ("EUR", "RUB", "KZT", "GEL", "EUR")
+    matrix = asyncio.run(RateMatrix(graph).get(codes))
+    assert matrix[0][1] == graph.get_by_pair("EUR", "RUB").rate == 180
+    for row, base_code in enumerate(codes):
+        for column, target_code in enumerate(codes):
+            expected = 1.0 if base_code == target_code else graph.get_by_pair(base_code, target_code).rate
+            assert matrix[row][column] == expected
+
+
+def test_failing_rate_graph_listener_does_not_stop_the_others():
+    usd, eur = (CurrencyWithID(id=index, name=code, code=code, sign=code[0])
+                for index, code in enumerate(["USD", "EUR"], start=1))
+    graph = RateGraph(pivots=["USD"])
+    received = []
+
+    def failing_listener(changes):
+        raise ValueError("listener failed")
+
+    graph.subscribe(failing_listener)
+    graph.subscribe(received.append)
+    graph.set_rate(ExchangeRateWithCurrencies(base_currency=usd, target_currency=eur, rate=0.5))
+    assert len(received) == 1
+    assert graph.get_by_pair("EUR", "USD").rate == 2
+
+
+def test_exchange_without_rate_cache_loads_both_directions_at_once():
+    async def get_inverse_rate(session):
+        return await _get_exchange_rate("RUB", "EUR")
+
+    exchange_rate, statements = run_counting_queries(get_inverse_rate)
+    assert exchange_rate.base_currency.code == "RUB"
+    assert exchange_rate.rate == 1 / 100.3
+    assert len(statements) == 1
+
+
+def test_convert_many_keeps_results_beyond_int64():
+    # 10^15 with three minor digits at a rate of 10^6 into a currency with two
+    amounts = np.array([MAX_AMOUNT * 1000, 1000], dtype=np.int64)
+    rates = np.array([10 ** 6 * RATE_SCALE] * 2, dtype=np.int64)
+    converted = convert_many(amounts, np.array([3, 3]), rates, np.array([RATE_DECIMALS] * 2), np.array([2, 2]))
+    assert converted.tolist() == [MAX_AMOUNT * 10 ** 8, 10 ** 8]
+    assert converted[0] > INT64_MAX
+
+
+def test_rate_cache_retries_a_failing_reload(monkeypatch):
+    class Connection:
+        def add_termination_listener(self, callback):
+            pass
+
+        async def add_listener(self, channel, callback):
+            pass
+
+        async def fetchval(self, query):
+            return 1
+
+        def terminate(self):
+            pass
+
+    async def connect(**kwargs):
+        return Connection()
+
+    loads = []
+
+    async def load_rates():
+        loads.append(None)
+        if len(loads) == 1:
+            raise ValueError("reload failed")
+        return [], []
+
+    monkeypatch.setattr(cache, "STORAGE_BACKEND", "postgres")
+    monkeypatch.setattr(cache.asyncpg, "connect", connect)
+    rate_cache = cache.RateCache(RateGraph(pivots=["USD"]), channel="test", health_check_interval=0.01)
+
+    async def run():
+        try:
+            await asyncio.wait_for(rate_cache.start(load_rates), 5)
+            assert rate_cache.ready
+        finally:
+            await rate_cache.stop()
+            await database.engine.dispose()
+
+    asyncio.run(run())
+    assert len(loads) == 2
+
+
+def test_rate_caches_agree_on_versions_after_a_reload():
+    usd, eur = (CurrencyWithID(id=index, name=code, code=code, sign=code[0])
+                for index, code in enumerate(["USD", "EUR"], start=1))
+    table_versions = {}
+
+    async def read_table_versions():
+        return dict(table_versions)
+
+    async def load_rates():
+        return [usd, eur], [ExchangeRateWithCurrencies(base_currency=usd, target_currency=eur, rate=0.5)]
+
+    # One worker applies the notifications, the other reloads after them
+    notified, reloaded = (cache.RateCache(RateGraph(pivots=["USD"]), channel="test", health_check_interval=1)
+                          for _ in range(2))
+    for rate_cache in (notified, reloaded):
+        rate_cache._loader = load_rates
+        rate_cache._read_table_versions = read_table_versions
+
+    async def run():
+        await notified.resync()
+        notified.add_currency(eur, 5)
+        notified.set_rates([ExchangeRateWithCurrencies(base_currency=usd, target_currency=eur, rate=0.5)], 9)
+        table_versions.update({"currency": 5, "exchange_rate": 9})
+        await reloaded.resync()
+
+    asyncio.run(run())
+    for tables in (("currency",), ("exchange_rate",), ("currency", "exchange_rate")):
+        assert notified.get_table_version(*tables)[0] == reloaded.get_table_version(*tables)[0]
+
+
+@pytest.mark.parametrize("currency_repository, exchange_rate_repository", [
+    (CurrencyRepository, ExchangeRateRepository),
+    (InMemoryCurrencyRepository, InMemoryExchangeRateRepository),
+])
+def test_currency_used_by_a_rate_is_not_deleted(currency_repository, exchange_rate_repository):
+    async def delete_currencies(session):
+        for code in ("DLA", "DLB"):
+            await currency_repository.add(session, Currency(code=code, name=code, sign=code[0]))
+        await exchange_rate_repository.add(
+            session, ExchangeRate(baseCurrencyCode="DLA", targetCurrencyCode="DLB", rate=2)
+        )
+        with pytest.raises(CurrencyInUseError):
+            await currency_repository.delete(session, "DLA")
+        assert await currency_repository.exists_by_code(session, "DLA")
+
+        await exchange_rate_repository.delete_by_pair(session, "DLA", "DLB")
+        return [(await currency_repository.delete(session, code)).code for code in ("DLA", "DLB")]
+
+    try:
+        deleted_codes, _ = run_counting_queries(delete_currencies)
+    finally:
+        memory_store.clear()
+    assert deleted_codes == ["DLA", "DLB"]
+
+
+def test_naive_datetimes_are_utc_on_the_memory_backend(monkeypatch):
+    for router_module in (exchange.router, exchange_rates.router):
+        monkeypatch.setattr(router_module, "ExchangeRateRepository", InMemoryExchangeRateRepository)
+    app = FastAPI()
+    app.include_router(exchange.router.router)
+    app.include_router(exchange_rates.router.router)
+
+    async def add_rate():
+        for code in ("NVA", "NVB"):
+            await InMemoryCurrencyRepository.add(None, Currency(code=code, name=code, sign=code[0]))
+        await InMemoryExchangeRateRepository.add(
+            None, ExchangeRate(baseCurrencyCode="NVA", targetCurrencyCode="NVB", rate=2)
+        )
+
+    asyncio.run(add_rate())
+    try:
+        client = TestClient(app)
+        response = client.get("/exchangeRates/NVANVB?at=2100-01-01T00:00:00")
+        assert response.status_code == 200
+        assert response.json()["rate"] == 2
+
+        response = client.get("/exchange?baseCode=NVA&targetCode=NVB&amount=1&at=2100-01-01T00:00:00")
+        assert response.status_code == 200
+        assert response.json()["converted_amount"] == 2
+
+        response = client.get("/exchangeRates/NVANVB/history?start=2000-01-01T00:00:00&end=2100-01-01T00:00:00")
+        assert response.status_code == 200
+        assert response.json()[-1]["close"] == 2
+    finally:
+        memory_store.clear()
+
+
+def make_snapshot_rates():
+    usd, eur, rub, kzt = (CurrencyWithID(id=index, name=code, code=code, sign=code[0])
+                          for index, code in enumerate(["USD", "EUR", "RUB", "KZT"], start=1))
+    return [usd, eur, rub, kzt], [
+        ExchangeRateWithCurrencies(base_currency=usd, target_currency=eur, rate=0.5),
+        ExchangeRateWithCurrencies(base_currency=usd, target_currency=rub, rate=90),
+        ExchangeRateWithCurrencies(base_currency=kzt, target_currency=rub, rate=0.2),
+    ]
+
+
+def test_rate_snapshot_is_shared_between_workers(tmp_path):
+    currencies, exchange_rates = make_snapshot_rates()
+    usd, _, rub, _ = currencies
+    writer_graph = RateGraph(pivots=["USD"])
+    writer_graph.load(currencies, exchange_rates)
+    writer_cache = cache.RateCache(writer_graph, channel="test", health_check_interval=1)
+    # The reader's own graph is empty, everything it answers comes from the file
+    reader_graph = RateGraph(pivots=["USD"])
+    reader_cache = cache.RateCache(reader_graph, channel="test", health_check_interval=1)
+    writer_cache.version = reader_cache.version = 1
+    path = str(tmp_path / "rates")
+    writer = RateSnapshot(writer_graph, writer_cache, path, 1 << 16)
+    reader = RateSnapshot(reader_graph, reader_cache, path, 1 << 16)
+
+    async def run():
+        writer.open()
+        reader.open()
+        assert writer.leading and not reader.leading
+        assert reader.get_rate("USD", "RUB").rate == 90
+        assert reader.get_by_pair("EUR", "RUB").rate == writer_graph.get_by_pair("EUR", "RUB").rate
+        assert reader.get_by_pair("EUR", "KZT").rate == writer_graph.get_by_pair("EUR", "KZT").rate
+        with pytest.raises(ExchangeRateNotFound):
+            reader.get_rate("RUB", "USD")
+
+        writer_cache.set_rates([ExchangeRateWithCurrencies(base_currency=usd, target_currency=rub, rate=95)], 2)
+        await asyncio.sleep(0)
+        assert reader.get_rate("USD", "RUB").rate == 95
+
+        # A reader whose cache is ahead of the snapshot answers from its own graph
+        reader_cache.version = 3
+        with pytest.raises(ExchangeRateNotFound):
+            reader.get_rate("USD", "RUB")
+
+        await writer.stop()
+        await reader.stop()
+
+    asyncio.run(run())
+
+
+def test_rate_snapshot_discards_reads_of_a_rewritten_slot(tmp_path, monkeypatch):
+    currencies, exchange_rates = make_snapshot_rates()
+    writer_graph = RateGraph(pivots=["USD"])
+    writer_graph.load(currencies, exchange_rates)
+    reader_graph = RateGraph(pivots=["USD"])
+    reader_graph.load(currencies, [exchange_rates[0]])
+    writer_cache = cache.RateCache(writer_graph, channel="test", health_check_interval=1)
+    reader_cache = cache.RateCache(reader_graph, channel="test", health_check_interval=1)
+    path = str(tmp_path / "rates")
+    writer = RateSnapshot(writer_graph, writer_cache, path, 1 << 16)
+    reader = RateSnapshot(reader_graph, reader_cache, path, 1 << 16)
+    writer.open()
+    reader.open()
+    lookups = []
+
+    def get_rate_while_rewritten(view, base_currency_code, target_currency_code):
+        lookups.append((base_currency_code, target_currency_code))
+        # Two publishes rewrite the slot the lookup reads
+        writer._publish()
+        writer._publish()
+        raise ExchangeRateNotFound("Exchange rate for this pair not found")
+
+    monkeypatch.setattr(SnapshotView, "get_rate", get_rate_while_rewritten)
+    # The half read not found is retried, and the graph answers once the attempts run out
+    assert reader.get_rate("USD", "EUR").rate == 0.5
+    assert len(lookups) == READ_ATTEMPTS
+    asyncio.run(writer.stop())
+    asyncio.run(reader.stop())